@@ -110,6 +110,14 @@ check_dependencies() {
         log_success "PyMySQL установлен"
     fi
 
+    # TOML-конфигурация: tomllib (Python 3.11+) или tomli
+    if ! /opt/hiddify-manager/.venv313/bin/python -c "import tomllib" 2>/dev/null &&
+       ! /opt/hiddify-manager/.venv313/bin/python -c "import tomli" 2>/dev/null; then
+        log_warning "Python ниже 3.11, устанавливаем tomli для чтения config.toml..."
+        /opt/hiddify-manager/.venv313/bin/pip install tomli --quiet
+        log_success "tomli установлен"
+    fi
+
     log_success "Все зависимости найдены"
 }
 
@@ -200,9 +208,17 @@ download_files() {
     log_info "Загрузка deactivate_users_direct.py..."
     curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/src/deactivate_users_direct.py" -o "$temp_dir/deactivate_users_direct.py"
 
+    log_info "Загрузка sync_config.py, sync_db.py, usage_ring.py, xray_direct.py и config.example.toml..."
+    curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/src/sync_config.py" -o "$temp_dir/sync_config.py"
+    curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/src/sync_db.py" -o "$temp_dir/sync_db.py"
+    curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/src/usage_ring.py" -o "$temp_dir/usage_ring.py"
+    curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/src/xray_direct.py" -o "$temp_dir/xray_direct.py"
+    curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/src/config.example.toml" -o "$temp_dir/config.example.toml"
+
     log_info "Загрузка systemd файлов..."
     curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/systemd/hiddify-child-sync.service" -o "$temp_dir/hiddify-child-sync.service"
     curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/systemd/hiddify-child-sync.timer" -o "$temp_dir/hiddify-child-sync.timer"
+    curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/systemd/hiddify-child-sync-daemon.service" -o "$temp_dir/hiddify-child-sync-daemon.service"
     curl -fsSL --retry 4 --retry-delay 2 --retry-connrefused "${RAW_URL}/systemd/hiddify-sync-api.service" -o "$temp_dir/hiddify-sync-api.service"
 
     log_info "Загрузка hiddify-patch-celery-rollback.py..."
@@ -238,6 +254,16 @@ install_scripts() {
     cp "$temp_dir/deactivate_users_direct.py" /opt/hiddify-manager/
     chmod +x /opt/hiddify-manager/deactivate_users_direct.py
 
+    log_info "Копирование sync_config.py, sync_db.py, usage_ring.py и xray_direct.py..."
+    cp "$temp_dir/sync_config.py" /opt/hiddify-manager/
+    cp "$temp_dir/sync_db.py" /opt/hiddify-manager/
+    cp "$temp_dir/usage_ring.py" /opt/hiddify-manager/
+    cp "$temp_dir/xray_direct.py" /opt/hiddify-manager/
+
+    log_info "Копирование config.example.toml..."
+    mkdir -p /etc/hiddify-child-sync
+    cp "$temp_dir/config.example.toml" /etc/hiddify-child-sync/
+
     log_info "Копирование hiddify-patch-celery-rollback.py..."
     cp "$temp_dir/hiddify-patch-celery-rollback.py" /usr/local/bin/
     chmod +x /usr/local/bin/hiddify-patch-celery-rollback.py
@@ -247,6 +273,10 @@ install_scripts() {
     chown root:hiddify-common /opt/hiddify-manager/sync_health_api.py
     chown root:hiddify-common /opt/hiddify-manager/activate_new_users_direct.py
     chown root:hiddify-common /opt/hiddify-manager/deactivate_users_direct.py
+    chown root:hiddify-common /opt/hiddify-manager/sync_config.py
+    chown root:hiddify-common /opt/hiddify-manager/sync_db.py
+    chown root:hiddify-common /opt/hiddify-manager/usage_ring.py
+    chown root:hiddify-common /opt/hiddify-manager/xray_direct.py
 
     log_success "Скрипты установлены"
 }
@@ -254,11 +284,19 @@ install_scripts() {
 configure_scripts() {
     print_header "Настройка параметров"
 
-    log_info "Обновление PARENT_URL..."
-    sed -i "s|PARENT_URL = \".*\"|PARENT_URL = \"$PARENT_URL\"|" /opt/hiddify-manager/stable_sync.py
+    local config_file="/etc/hiddify-child-sync/config.toml"
+
+    # Скрипты больше не правятся: параметры живут в общем конфигурационном файле,
+    # остальные настройки существующего файла сохраняются
+    if [ ! -f "$config_file" ]; then
+        log_info "Создание $config_file..."
+        cp /etc/hiddify-child-sync/config.example.toml "$config_file"
+    fi
+    chmod 600 "$config_file"
 
-    log_info "Обновление API_KEY..."
-    sed -i "s|API_KEY = \".*\"|API_KEY = \"$API_KEY\"|" /opt/hiddify-manager/stable_sync.py
+    log_info "Обновление [parent] url и api_key..."
+    sed -i "0,/^url = .*/s||url = \"$PARENT_URL\"|" "$config_file"
+    sed -i "0,/^api_key = .*/s||api_key = \"$API_KEY\"|" "$config_file"
 
     log_success "Параметры обновлены"
 }
@@ -271,6 +309,8 @@ install_systemd_services() {
     log_info "Копирование systemd файлов..."
     cp "$temp_dir/hiddify-child-sync.service" /etc/systemd/system/
     cp "$temp_dir/hiddify-child-sync.timer" /etc/systemd/system/
+    # Альтернативный режим (--daemon, независимые конвейеры) — устанавливается, но не включается
+    cp "$temp_dir/hiddify-child-sync-daemon.service" /etc/systemd/system/
     cp "$temp_dir/hiddify-sync-api.service" /etc/systemd/system/
 
     # Устанавливаем drop-in для автопатча Celery (переживает обновления Hiddify)
@@ -334,6 +374,11 @@ verify_installation() {
                 "/opt/hiddify-manager/sync_health_api.py" \
                 "/opt/hiddify-manager/activate_new_users_direct.py" \
                 "/opt/hiddify-manager/deactivate_users_direct.py" \
+                "/opt/hiddify-manager/sync_config.py" \
+                "/opt/hiddify-manager/sync_db.py" \
+                "/opt/hiddify-manager/usage_ring.py" \
+                "/opt/hiddify-manager/xray_direct.py" \
+                "/etc/hiddify-child-sync/config.toml" \
                 "/usr/local/bin/hiddify-patch-celery-rollback.py" \
                 "/etc/systemd/system/hiddify-child-sync.service" \
                 "/etc/systemd/system/hiddify-child-sync.timer" \
@@ -410,7 +455,7 @@ print_usage_info() {
     echo ""
     echo -e "${BLUE}⏱️  Автоматическая синхронизация:${NC}"
     echo ""
-    echo -e "  • Запускается каждые ${GREEN}5 минут${NC}"
+    echo -e "  • Запускается каждые ${GREEN}2 минуты${NC}"
     echo -e "  • Первый запуск через ${GREEN}2 минуты${NC} после загрузки"
     echo -e "  • Случайная задержка до ${GREEN}30 секунд${NC} (избежание коллизий)"
     echo ""
@@ -6,18 +6,30 @@ Helper скрипт для активации новых пользовател
 
 Использование:
     python activate_new_users_direct.py UUID1 UUID2 UUID3 ...
+    python activate_new_users_direct.py --enabled UUID1 ...   # без проверки в БД
+    python activate_new_users_direct.py --reprovision         # все enable=1 (после перезапуска Xray)
+
+--enabled: вызывающий (stable_sync.py) только что сам закоммитил enable=1 для этих
+UUID — helper не открывает отдельное подключение к MySQL ради повторной проверки.
+
+--reprovision: перезапуск Xray сбросил клиентов, добавленных через API; helper
+возвращает всех включённых пользователей параллельными gRPC-вызовами.
+
+Код выхода (протокол xray_direct): 0 — все UUID обработаны; EXIT_PARTIAL —
+не добавленные перечислены строками FAILED_PREFIX; 1 — Xray или БД недоступны.
+--reprovision, вернувший не всех, завершается с 1: восстановление повторяется.
+
+Теги inbound'ов, протоколы и параллельное добавление — xray_direct.py.
 
 Автор: Claude Sonnet 4.5 (Anthropic)
 Дата: 2025-12-18
 """
 
 import sys
-import pymysql
-
-# Добавляем путь к модулям для xtlsapi
-sys.path.insert(0, '/opt/hiddify-manager/.venv313/lib/python3.13/site-packages')
+import time
 
-import xtlsapi
+import sync_config
+import xray_direct
 
 # Конфигурация БД (аналогично stable_sync.py)
 DB_CONFIG = {
@@ -25,163 +37,163 @@ DB_CONFIG = {
     'user': 'root',
     'password': '',
     'database': 'hiddifypanel',
-    'charset': 'utf8mb4',
-    'cursorclass': pymysql.cursors.DictCursor
+    'charset': 'utf8mb4'
 }
 
+# Секция [database] общего конфигурационного файла (sync_config.py);
+# параметры Xray API — секция [xray] (xray_direct.py)
+sync_config.configure_module(globals(), ('database',))
+
 def get_db_connection():
-    """Подключение к БД"""
+    """Подключение к БД (pymysql загружается только здесь: --enabled обходится без БД)"""
     try:
-        conn = pymysql.connect(**DB_CONFIG)
+        import pymysql
+        conn = pymysql.connect(cursorclass=pymysql.cursors.DictCursor, **DB_CONFIG)
         return conn
     except Exception as e:
         print(f"❌ Ошибка подключения к БД: {e}")
         return None
 
-def get_inbound_tags(xray_client):
-    """Получает список inbound tags из Xray"""
-    try:
-        inbounds = {inb.name.split(">>>")[1] for inb in xray_client.stats_query('inbound')}
-        return list(inbounds)
-    except Exception as e:
-        print(f"⚠️ Ошибка получения inbound tags: {e}")
-        return []
-
-def add_uuid_to_tag(xray_client, uuid, tag, debug=False):
-    """Добавляет UUID в конкретный inbound tag (логика из Hiddify xray_api.py)"""
-    try:
-        # Карта определения протокола по ключевым словам в теге (из Hiddify)
-        proto_map = {
-            'vless': 'vless',
-            'realityin': 'vless',
-            'xtls': 'vless',
-            'quic': 'vless',
-            'reality': 'vless',
-            'kcp': 'vless',
-            'trojan': 'trojan',
-            'dispatcher': 'trojan',
-            'vmess': 'vmess',
-            'ss': 'shadowsocks',
-            'v2ray': 'shadowsocks',
-        }
-
-        # Определяем протокол по первому совпадению в теге
-        protocol = None
-        for keyword, proto in proto_map.items():
-            if keyword in tag.lower():
-                protocol = proto
-                break
-
-        if not protocol:
-            raise ValueError(f"Unknown protocol for tag: {tag}")
-
-        # flow='xtls-rprx-vision' только для realityin_tcp, для остальных - null byte
-        flow = 'xtls-rprx-vision' if 'realityin_tcp' in tag.lower() else '\0'
-
-        xray_client.add_client(
-            tag,
-            uuid,
-            f'{uuid}@hiddify.com',
-            protocol=protocol,
-            flow=flow,
-            alter_id=0,
-            cipher='chacha20_poly1305'
-        )
-        return True
-    except xtlsapi.xtlsapi.exceptions.EmailAlreadyExists:
-        # UUID уже существует в этом inbound - это нормально
-        return True
-    except Exception as e:
-        # Пропускаем невалидные теги
-        if debug:
-            print(f"  DEBUG: Не удалось добавить в {tag}: {e}")
-        return False
-
-def activate_users(uuids):
+def activate_users(uuids, check_db=True):
     """
     Активирует пользователей в Xray через прямой вызов API
 
     Args:
         uuids: Список UUID пользователей для активации
+        check_db: проверять существование и enable в БД (False — UUID уже проверены
+                  вызывающим, подключение к БД не открывается)
 
     Returns:
-        int: Количество успешно активированных пользователей
+        tuple | None: (число активированных; список UUID, не добавленных ни в один
+        inbound) или None — Xray или БД недоступны. Отсутствующие в БД и отключённые
+        пропускаются и ошибкой не считаются.
     """
-    conn = get_db_connection()
-    if not conn:
-        return 0
+    conn = None
+    if check_db:
+        conn = get_db_connection()
+        if not conn:
+            return None
 
     try:
         # Подключаемся к Xray API
-        xray_client = xtlsapi.XrayClient('127.0.0.1', 10085)
+        xray_client = xray_direct.get_client()
 
-        # Получаем список inbound tags
-        tags = get_inbound_tags(xray_client)
+        # Inbound tags (кэш, перечитывается после перезапуска Xray)
+        tags = xray_direct.get_inbound_tags(xray_client)
         if not tags:
             print("❌ Не удалось получить inbound tags из Xray")
-            return 0
+            return None
 
         print(f"📋 Найдено inbound tags: {len(tags)}")
 
-        activated_count = 0
-
-        with conn.cursor() as cursor:
+        names = {uuid: uuid[:8] for uuid in uuids}
+        if conn:
+            # Проверяем существование и enable пользователей в БД одним запросом
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT uuid, name, enable FROM user WHERE uuid IN ({})".format(
+                        ', '.join(['%s'] * len(uuids))),
+                    list(uuids))
+                users = {row['uuid']: row for row in cursor.fetchall()}
+            names = {}
             for uuid in uuids:
-                # Проверяем существование пользователя в БД
-                cursor.execute("""
-                    SELECT name, enable, usage_limit, current_usage, package_days, start_date
-                    FROM user
-                    WHERE uuid = %s
-                """, (uuid,))
-                user = cursor.fetchone()
-
+                user = users.get(uuid)
                 if not user:
                     print(f"⚠️ UUID {uuid} не найден в БД")
-                    continue
-
-                if not user['enable']:
+                elif not user['enable']:
                     print(f"⚠️ Пользователь {user['name']} ({uuid}) отключен (enable=0)")
-                    continue
-
-                # Добавляем UUID во все inbound tags
-                added_to_any = False
-                added_tags = []
-                for tag in tags:
-                    if add_uuid_to_tag(xray_client, uuid, tag, debug=False):
-                        added_to_any = True
-                        added_tags.append(tag)
-
-                if added_to_any:
-                    activated_count += 1
-                    print(f"✅ Активирован: {user['name']} ({uuid}) в {len(added_tags)} inbound(s)")
                 else:
-                    print(f"⚠️ Не удалось активировать {user['name']} ({uuid}) ни в одном inbound")
+                    names[uuid] = user['name']
 
-        return activated_count
+        # Добавляем UUID во все inbound tags (параллельно)
+        activated_count = 0
+        failed = []
+        for uuid, added in xray_direct.add_users_bulk(xray_client, list(names), tags).items():
+            if added:
+                activated_count += 1
+                print(f"✅ Активирован: {names[uuid]} ({uuid}) в {added} inbound(s)")
+            else:
+                failed.append(uuid)
+                print(f"{xray_direct.FAILED_PREFIX}{uuid}")
+
+        return activated_count, failed
 
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
         import traceback
         traceback.print_exc()
-        return 0
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def reprovision_enabled_users():
+    """
+    Возвращает в Xray всех включённых пользователей (enable=1) после перезапуска
+    Xray. Теги перечитываются заново, пользователи добавляются параллельно.
+
+    Returns:
+        tuple: (восстановлено, всего включённых) или None при ошибке
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT uuid FROM user WHERE enable = 1")
+            uuids = [row['uuid'] for row in cursor.fetchall()]
     finally:
         conn.close()
 
+    try:
+        xray_client = xray_direct.get_client()
+        tags = xray_direct.get_inbound_tags(xray_client, refresh=True)
+        if not tags:
+            print("❌ Не удалось получить inbound tags из Xray")
+            return None
+        started = time.monotonic()
+        added = xray_direct.add_users_bulk(xray_client, uuids, tags)
+        restored = 0
+        for uuid, count in added.items():
+            if count:
+                restored += 1
+            else:
+                print(f"{xray_direct.FAILED_PREFIX}{uuid}")
+        print(f"📋 {len(tags)} inbound(s), {time.monotonic() - started:.1f}с")
+        return restored, len(uuids)
+    except Exception as e:
+        print(f"❌ Критическая ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == '--reprovision':
+        result = reprovision_enabled_users()
+        if result is None:
+            sys.exit(1)
+        restored, total = result
+        print(f"Восстановлено в Xray: {restored}/{total}")
+        sys.exit(0 if restored == total else 1)
+
     if len(sys.argv) < 2:
-        print("Использование: python activate_new_users_direct.py UUID1 [UUID2 UUID3 ...]")
+        print("Использование: python activate_new_users_direct.py [--enabled] UUID1 [UUID2 UUID3 ...]")
+        print("               python activate_new_users_direct.py --reprovision")
         print("\nПример:")
         print("  python activate_new_users_direct.py 75498599-9c8b-4665-af53-e7a8a34ddab8")
         sys.exit(1)
 
     uuids = sys.argv[1:]
+    check_db = uuids[0] != '--enabled'
+    if not check_db:
+        uuids = uuids[1:]
     print(f"🔧 Активация {len(uuids)} новых пользователей в Xray...")
 
-    activated = activate_users(uuids)
-
-    if activated > 0:
-        print(f"\n✅ Активировано пользователей: {activated}/{len(uuids)}")
-        sys.exit(0)
-    else:
+    result = activate_users(uuids, check_db=check_db)
+    if result is None:
         print(f"\n❌ Не удалось активировать пользователей")
         sys.exit(1)
+    activated, failed = result
+    print(f"\n✅ Активировано пользователей: {activated}/{len(uuids)}"
+          + (f", ошибок: {len(failed)}" if failed else ""))
+    sys.exit(xray_direct.EXIT_PARTIAL if failed else 0)
@@ -9,8 +9,13 @@ Helper для ДЕАКТИВАЦИИ пользователей в работа
 ручная блокировка / исчерпание трафика / истечение срока). Без этого юзер
 продолжал бы получать трафик на child до фоновой реконсиляции Hiddify.
 
+Теги inbound'ов и параллельное удаление — xray_direct.py (секция [xray]
+конфигурационного файла).
+
 Идемпотентно: удаление отсутствующего клиента (EmailNotFound) трактуется как no-op.
 Возвращает (через stdout) число пользователей, реально удалённых хотя бы из 1 inbound.
+Код выхода: 0 — все UUID обработаны; xray_direct.EXIT_PARTIAL — не обработанные
+перечислены строками xray_direct.FAILED_PREFIX; 1 — Xray недоступен, не обработан никто.
 
 Использование:
     python deactivate_users_direct.py UUID1 [UUID2 UUID3 ...]
@@ -18,60 +23,44 @@ Helper для ДЕАКТИВАЦИИ пользователей в работа
 
 import sys
 
-# Путь к модулям venv для xtlsapi (как в activate_new_users_direct.py)
-sys.path.insert(0, '/opt/hiddify-manager/.venv313/lib/python3.13/site-packages')
-
-import xtlsapi
-
-
-def get_inbound_tags(xray_client):
-    """Получает список inbound tags из работающего Xray."""
-    try:
-        inbounds = {inb.name.split(">>>")[1] for inb in xray_client.stats_query('inbound')}
-        return list(inbounds)
-    except Exception as e:
-        print(f"⚠️ Ошибка получения inbound tags: {e}")
-        return []
+import xray_direct
 
 
 def deactivate_users(uuids):
     """
-    Удаляет пользователей из всех inbound'ов работающего Xray.
+    Удаляет пользователей из всех inbound'ов работающего Xray (параллельно,
+    теги — из кэша xray_direct).
 
     Args:
         uuids: список UUID для деактивации
 
     Returns:
-        int: число пользователей, реально удалённых хотя бы из одного inbound
-             (уже отсутствующие не считаются — операция для них no-op)
+        tuple | None: (число реально удалённых хотя бы из одного inbound — уже
+        отсутствующие не считаются, операция для них no-op; список UUID, удаление
+        которых не подтверждено) или None — Xray недоступен
     """
     try:
-        xray_client = xtlsapi.XrayClient('127.0.0.1', 10085)
+        xray_client = xray_direct.get_client()
     except Exception as e:
         print(f"❌ Не удалось подключиться к Xray API: {e}")
-        return 0
+        return None
 
-    tags = get_inbound_tags(xray_client)
+    tags = xray_direct.get_inbound_tags(xray_client)
     if not tags:
         print("❌ Не удалось получить inbound tags из Xray")
-        return 0
+        return None
 
     removed_count = 0
-    for uuid in uuids:
-        email = f'{uuid}@hiddify.com'
-        removed_any = False
-        for tag in tags:
-            try:
-                xray_client.remove_client(tag, email)
-                removed_any = True  # клиент был и удалён
-            except Exception:
-                # EmailNotFound (клиента нет в этом inbound) или несовместимый тег — норм
-                pass
-        if removed_any:
+    failed = []
+    for uuid, removed in xray_direct.remove_users_bulk(xray_client, uuids, tags).items():
+        if removed is None:
+            failed.append(uuid)
+            print(f"{xray_direct.FAILED_PREFIX}{uuid}")
+        elif removed:
             removed_count += 1
             print(f"🔌 Деактивирован в Xray: {uuid}")
 
-    return removed_count
+    return removed_count, failed
 
 
 if __name__ == "__main__":
@@ -80,6 +69,10 @@ if __name__ == "__main__":
         sys.exit(1)
 
     uuids = sys.argv[1:]
-    deactivated = deactivate_users(uuids)
-    print(f"Деактивировано в Xray: {deactivated}/{len(uuids)}")
-    sys.exit(0)
+    result = deactivate_users(uuids)
+    if result is None:
+        sys.exit(1)
+    deactivated, failed = result
+    print(f"Деактивировано в Xray: {deactivated}/{len(uuids)}"
+          + (f", ошибок: {len(failed)}" if failed else ""))
+    sys.exit(xray_direct.EXIT_PARTIAL if failed else 0)
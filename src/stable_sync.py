@@ -15,10 +15,24 @@ Hiddify Manager Child-Parent User Synchronization v4.3
   - Автоматическое обнуление локального трафика после успешной отправки
   - Двунаправленная синхронизация last_online (child ↔ parent)
   - Мгновенная активация новых пользователей в Xray (без перезапуска)
+  - Независимые конвейеры users (parent → child) и traffic (child → parent)
+    со своими интервалами, таймаутами и блокировками (режим --daemon)
+  - Локальное ограничение между циклами (конвейер enforce): превысившие квоту
+    или с истёкшим пакетом убираются из Xray до подтверждения parent
+
+ЗАПУСК:
+  stable_sync.py                     # один цикл обоих конвейеров (systemd timer)
+  stable_sync.py --pipeline users    # один цикл только указанного конвейера
+  stable_sync.py --daemon            # постоянный процесс, конвейеры по своим интервалам
+
+КОНФИГУРАЦИЯ:
+  /etc/hiddify-child-sync/config.toml (см. sync_config.py, config.example.toml)
+  переопределяет константы ниже; в режиме --daemon перечитывается по SIGHUP
+  или при изменении файла без перезапуска и без сброса HTTP-пулов.
 
 ТРЕБОВАНИЯ:
   - Hiddify Manager v11+ (child panel mode)
-  - Python 3.10+
+  - Python 3.11+ (на 3.10 — пакет tomli для конфигурационного файла)
   - PyMySQL
   - Доступ к parent панели через API
 
@@ -28,19 +42,32 @@ Hiddify Manager Child-Parent User Synchronization v4.3
 
 import sys
 import os
-import requests
-import pymysql
+import time
+import fcntl
+import random
+import struct
+import marshal
+import zlib
+import mmap
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import socket
+import signal
+import argparse
+import threading
 from datetime import datetime, date
-import urllib3
+from contextlib import contextmanager
 import traceback
 import json
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import sync_config
+import sync_db
+import usage_ring
+import xray_direct
 
 # ============================================================================
 # КОНФИГУРАЦИЯ
-# Эти значения заменяются install.sh при установке.
-# Для ручной установки укажите свои значения.
+# Значения по умолчанию. Переопределяются файлом /etc/hiddify-child-sync/config.toml
+# ([parent], [database], [sync] — см. sync_config.py), который пишет install.sh.
 # ============================================================================
 
 # URL родительской панели (включая admin proxy path)
@@ -51,6 +78,14 @@ PARENT_URL = "https://your-parent-panel.example.com/ADMIN_PATH"
 # Получите в: Admin Panel → Settings → API Keys
 API_KEY = "your-api-key-here"
 
+# Несколько parent панелей (например, по одной на регион): список источников
+#   {'name': 'eu', 'url': 'https://eu.example.com/ADMIN_PATH', 'api_key': '...'}
+# Списки запрашиваются параллельно и объединяются; трафик и last_online каждого
+# пользователя отправляются на его parent (карта владельцев UUID → источник).
+# Пустой список — один источник PARENT_URL/API_KEY (PARENT_URL по-прежнему задаёт
+# admin proxy-path локальной панели, см. CHILD_URL).
+PARENT_SOURCES = []
+
 # URL ЛОКАЛЬНОЙ (child) панели для УДАЛЕНИЯ отсутствующих на parent юзеров.
 # admin proxy-path идентичен parent -> деривируем из PARENT_URL. Удаление через Hiddify-API
 # (а не прямой SQL) делает каскад БД (user_detail) + удаление из работающего Xray (gRPC RemoveUser).
@@ -65,590 +100,3655 @@ DB_CONFIG = {
     'charset': 'utf8mb4'
 }
 
+# Политика отправки трафика на parent (collect_local_usage_delta):
 # Минимальный объём трафика для отправки на parent (в байтах).
 # Трафик ниже этого порога накапливается локально до следующего цикла.
 # 1MB = 1000000 байт. Это предотвращает лишние API-запросы при малых объёмах.
 MIN_TRAFFIC_THRESHOLD = 1000000
 
+# Максимальный возраст неотправленного трафика (секунды): трафик ниже порога,
+# который копится дольше, отправляется принудительно (0 — без принудительной отправки).
+TRAFFIC_MAX_AGE = 3600
+
+# Максимум пользователей за один traffic-цикл (0 — без ограничения).
+# Первыми идут просроченные по TRAFFIC_MAX_AGE, затем по убыванию дельты.
+TRAFFIC_MAX_USERS_PER_CYCLE = 0
+
+# Общий бюджет запросов к parent за traffic-цикл (0 — без ограничения).
+# Считается каждый отправленный запрос, включая повторы: отправка трафика начинается
+# при запасе в 3 запроса (GET, PATCH, контрольный GET), last_online — в 1; повторы
+# после 429/5xx и CAS-конфликтов расходуют бюджет сверх этого. Не уложившееся
+# откладывается на следующий цикл.
+TRAFFIC_PUSH_BUDGET = 0
+
+# Независимые конвейеры синхронизации (секунды).
+# users   — parent → child: создание/блокировка/удаление + активация в Xray;
+# traffic — child → parent: сбор и отправка дельты трафика, сброс, last_online.
+# Интервал учитывается только в режиме --daemon; таймаут — во всех режимах
+# (ограничивает HTTP-таймауты и прерывает цикл конвейера между пользователями).
+USERS_SYNC_INTERVAL = 30
+USERS_SYNC_TIMEOUT = 120
+TRAFFIC_SYNC_INTERVAL = 300
+TRAFFIC_SYNC_TIMEOUT = 240
+
+# Локальное ограничение между циклами (конвейер enforce): пользователь, превысивший
+# квоту по снимку parent + локальному current_usage или с истёкшим пакетом, сразу
+# убирается из Xray, не дожидаясь is_active=False от parent. Проверяются только
+# пользователи, которым до лимита осталось меньше ENFORCE_HEADROOM_GB (один запрос
+# по индексу uuid). ENFORCE_SYNC_INTERVAL = 0 — отключено.
+ENFORCE_SYNC_INTERVAL = 15
+ENFORCE_SYNC_TIMEOUT = 30
+ENFORCE_HEADROOM_GB = 5.0
+
+# Общий дедлайн однократного запуска (таймер, секунды; 0 — только таймауты конвейеров).
+# Шаги (получение списка, traffic, enforce, users) получают дедлайн не позже конца
+# цикла; получение списка, traffic и enforce — не позже конца цикла минус
+# CYCLE_USERS_RESERVE, чтобы на users-конвейер всегда оставалось время. Не уложившееся
+# (отправки last_online, обновление полей, пачки удаления, дельты трафика)
+# откладывается до следующего цикла и попадает в отчёт (STATE_DIR/cycle.json).
+# Должен быть меньше интервала таймера (OnUnitActiveSec=2min).
+CYCLE_BUDGET = 110
+CYCLE_USERS_RESERVE = 30
+
+# Максимальный возраст общего снимка пользователей parent, который traffic-конвейер
+# может переиспользовать вместо собственного GET (секунды).
+PARENT_SNAPSHOT_MAX_AGE = 600
+
+# Размер пула HTTP-соединений к parent/child (общий для всех конвейеров)
+HTTP_POOL_SIZE = 8
+
+# Сколько соединений с локальной MySQL держать открытыми между шагами (sync_db.py).
+# Шаги цикла берут соединение из пула вместо connect/close на каждый шаг.
+DB_POOL_SIZE = 2
+
+# Запись синхронизации пользователей — транзакциями по N пользователей (коммит после
+# каждого чанка): блокировки строк user не держатся всю синхронизацию, панель и
+# Celery не ждут её окончания.
+SYNC_CHUNK_SIZE = 500
+
+# Шардированная синхронизация пользователей: пространство UUID делится на SYNC_SHARDS
+# частей (crc32 UUID), каждую пишет в БД и доводит до Xray свой процесс. 1 — без
+# шардирования, 0 — по числу CPU. Меньше SYNC_SHARD_MIN_USERS пользователей parent —
+# всегда в одном процессе (запуск пула дороже выигрыша).
+SYNC_SHARDS = 1
+SYNC_SHARD_MIN_USERS = 10000
+# Ожидание результата шарда: до дедлайна класса + SYNC_SHARD_GRACE секунд, без
+# дедлайна — SYNC_SHARD_TIMEOUT. Не ответивший шард считается зависшим: пул
+# останавливается, класс завершается ошибкой (записанное доводится в следующем цикле).
+SYNC_SHARD_TIMEOUT = 300
+SYNC_SHARD_GRACE = 30
+
+# Последний успешный снимок parent сохраняется в STATE_DIR. Если parent недоступен,
+# traffic-конвейер (отправка трафика, last_online) работает по нему, пока он не
+# старше PARENT_SNAPSHOT_FALLBACK_MAX_AGE секунд. users-конвейер по устаревшим
+# данным НЕ работает (никаких блокировок/удалений).
+PARENT_SNAPSHOT_FALLBACK_MAX_AGE = 86400
+
+# Проверка списка parent до любой работы с БД/Xray (validate_parent_users).
+# Поля, без которых запись не принимается (их использует синхронизация)
+PARENT_REQUIRED_FIELDS = ('uuid', 'name', 'enable', 'usage_limit_GB', 'package_days', 'mode')
+# Список, уменьшившийся относительно прошлого снимка больше чем на долю и на
+# абсолютное число, считается усечённым (частичный ответ / пагинация) и отклоняется...
+PARENT_MAX_SHRINK_RATIO = 0.25
+PARENT_MAX_SHRINK_ABS = 10
+# ...пока тот же самый набор UUID (контрольная сумма) не придёт N раз подряд
+PARENT_SHRINK_CONFIRMATIONS = 2
+
+# После неудачного GET списка parent повторять его не раньше чем через N секунд
+# (иначе следующий шаг цикла снова ждал бы полный таймаут)
+PARENT_RETRY_AFTER = 60
+
+# Верхняя граница времени получения списка пользователей одного источника (секунды)
+PARENT_FETCH_TIMEOUT = 60
+
+# Постраничное получение списка (опционально): PARENT_PAGE_SIZE > 0 — список
+# запрашивается страницами по N пользователей, параллельно в пределах адаптивного
+# лимита источника; неудачная страница повторяется отдельно (PARENT_PAGE_RETRIES),
+# а не весь список. Стандартный API v2 Hiddify отдаёт список целиком — включать
+# только для parent (или прокси перед ним), принимающего параметры PARENT_PAGE_PARAM
+# и PARENT_PAGE_SIZE_PARAM. Parent, игнорирующий их, распознаётся по первой странице.
+PARENT_PAGE_SIZE = 0
+PARENT_PAGE_PARAM = 'page'
+PARENT_PAGE_SIZE_PARAM = 'per_page'
+PARENT_PAGE_FIRST = 1
+PARENT_PAGE_RETRIES = 2
+PARENT_PAGE_TIMEOUT = 20
+# Предел числа страниц одного списка: parent, игнорирующий номер страницы или
+# отдающий неверный X-Total-Count, не должен держать цикл бесконечно
+PARENT_PAGE_MAX = 1000
+
+# Адаптивная нагрузка на parent (на каждый источник):
+#   - число одновременных запросов — AIMD: +1 за «окно» быстрых ответов, ×0.5 при
+#     латентности выше PARENT_LATENCY_TARGET, 429/5xx, обрыве или таймауте;
+#   - 429/502/503/504 и ошибки соединения повторяются с jitter-backoff, Retry-After
+#     соблюдается (дольше PARENT_RETRY_AFTER_CAP — запрос откладывается);
+#   - PARENT_BREAKER_FAILURES перегрузок подряд открывают circuit breaker: на
+#     PARENT_BREAKER_COOLDOWN (удваивается до PARENT_BREAKER_COOLDOWN_MAX при неудачной
+#     пробе) некритичные запросы (трафик, last_online) откладываются до следующего
+#     цикла, список пользователей запрашивается одной пробой.
+PARENT_CONCURRENCY_START = 2
+PARENT_CONCURRENCY_MAX = 8
+PARENT_LATENCY_TARGET = 2.0
+PARENT_REQUEST_RETRIES = 2
+PARENT_BACKOFF_BASE = 0.5
+PARENT_BACKOFF_MAX = 15.0
+PARENT_RETRY_AFTER_CAP = 30
+PARENT_BREAKER_FAILURES = 5
+PARENT_BREAKER_COOLDOWN = 60
+PARENT_BREAKER_COOLDOWN_MAX = 900
+# Таймаут запроса одного пользователя — PARENT_TIMEOUT_FACTOR × средняя латентность,
+# но не меньше PARENT_TIMEOUT_MIN и не больше прежних 30 с
+PARENT_TIMEOUT_FACTOR = 5.0
+PARENT_TIMEOUT_MIN = 5.0
+
+# Удаление отсутствующих на parent пользователей (_delete_missing_users).
+# DELETE_METHOD: 'api' — DELETE через локальный admin-API child (каскад Hiddify);
+#                'direct' — пачками прямым SQL (user_detail + user) и удаление
+#                из Xray по gRPC (deactivate_users_direct.py), без Flask.
+DELETE_METHOD = 'api'
+# Параллельных DELETE-запросов к локальной панели (режим 'api')
+DELETE_CONCURRENCY = 4
+# Не больше N удалений в секунду (0 — без ограничения, режим 'api')
+DELETE_RATE_PER_SEC = 10
+# Размер пачки SQL-удаления (режим 'direct')
+DELETE_BATCH_SIZE = 200
+
+# Карантин отсутствующих на parent (вместо «всё или ничего» safeguard):
+# пропавший пользователь сразу отключается (enable=0) и убирается из Xray — дёшево и
+# обратимо; удаляется, только если отсутствует QUARANTINE_FETCHES успешных полных
+# получений подряд, не более QUARANTINE_DELETE_BATCH за цикл.
+QUARANTINE_FETCHES = 3
+QUARANTINE_DELETE_BATCH = 100
+
+# Побочные эффекты users-цикла выполняются очередью по классам в порядке приоритета:
+#   activate   — запись новых/разблокированных + добавление в Xray;
+#   deactivate — запись ставших неактивными, карантин + удаление из Xray;
+#   delete     — удаление отсидевших карантин;
+#   update     — остальные поля существующих пользователей (имя, лимиты, ключи);
+#   sweep      — идемпотентная деактивация в Xray всех неактивных (самовосстановление).
+# Бюджет класса за цикл (секунды, 0 — только дедлайн конвейера): не уложившееся
+# откладывается до следующего цикла. activate и deactivate выполняются всегда
+# (переход не повторится), превышение их бюджета только логируется.
+OPS_BUDGET_ACTIVATE = 0
+OPS_BUDGET_DEACTIVATE = 0
+OPS_BUDGET_DELETE = 30
+OPS_BUDGET_UPDATE = 0
+OPS_BUDGET_SWEEP = 30
+# Сверка пропускается (helper не запускается), если набор неактивных и процесс Xray
+# не изменились после последней успешной сверки, но не дольше XRAY_SWEEP_INTERVAL секунд
+XRAY_SWEEP_INTERVAL = 600
+
+# Каталог состояния между запусками (очереди, спулы, снимки, блокировки запусков)
+STATE_DIR = '/var/lib/hiddify-child-sync'
+
+# Запуск конвейера, держащий блокировку дольше (секунды), health API помечает
+# как зависший (stale). Сама блокировка снимается ядром при завершении процесса.
+RUN_LOCK_STALE_AFTER = 900
+
+# Ёмкость журнала отправленного трафика (записей uuid/байты/время, по кругу;
+# 16 байт на запись). Отчёты: GET /api/v2/hiddify-sync/usage в health API.
+USAGE_RING_CAPACITY = 200000
+
+# Агрегация трафика нескольких child перед отправкой на parent:
+#   'direct'     — каждый child сам обновляет parent (по умолчанию);
+#   'client'     — child отправляет дельты на узел-агрегатор AGGREGATOR_URL;
+#   'aggregator' — узел принимает дельты от child (webhook-сервер sync_health_api.py,
+#                  POST /api/v2/hiddify-sync/usage-deltas), суммирует по UUID и раз
+#                  в traffic-цикл применяет к parent одно обновление на пользователя.
+TRAFFIC_AGGREGATION = 'direct'
+
+# Адрес webhook-сервера агрегатора и его WEBHOOK_TOKEN (для режима 'client')
+# Пример: http://10.0.0.5:8082
+AGGREGATOR_URL = ""
+AGGREGATOR_TOKEN = ""
+
+# Параметры, которые задаются конфигурационным файлом: блок выше и настройки шагов
+# ниже (USAGE_*, AGGREGATOR_BATCH_TTL); служебные константы (имена файлов
+# состояния, формат снимка) файлом не переопределяются.
+CONFIG_NAMES = frozenset(name for name in dir() if name.isupper()) | {
+    'USAGE_CAS_RETRIES', 'USAGE_EPSILON_GB', 'AGGREGATOR_BATCH_TTL',
+}
+
 # ============================================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ============================================================================
 
+_log_prefix = ""
+
+
 def log(message):
     """Логирование с временной меткой. Вывод через stdout для systemd journald."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
+    thread = threading.current_thread()
+    prefix = _log_prefix if thread is threading.main_thread() else f"[{thread.name}] "
+    print(f"[{timestamp}] {prefix}{message}")
     sys.stdout.flush()
 
 
-def get_db_connection():
-    """Получить подключение к локальной базе данных MySQL."""
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        return connection
-    except Exception as e:
-        log(f"❌ Ошибка подключения к БД: {e}")
-        return None
+_http_sessions = {}
+_http_session_lock = threading.Lock()
+
+
+def get_http_session(source=None):
+    """
+    Общая HTTP-сессия (пул keep-alive соединений) со своим API-ключом: для каждого
+    источника parent (source из get_parent_sources) и для локального admin-API / агрегатора
+    (source=None). Создаётся один раз на процесс и разделяется всеми конвейерами.
+    """
+    key = source['name'] if source else None
+    with _http_session_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            # requests/urllib3 загружаются при первом HTTP-запросе процесса, а не при запуске
+            import requests
+            import urllib3
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            session = requests.Session()
+            session.headers['Hiddify-API-Key'] = source['api_key'] if source else API_KEY
+            # gzip/deflate, а также br/zstd, если в venv есть их декодеры (brotli, zstandard):
+            # список пользователей parent сжимается в 10–20 раз
+            session.headers['Accept-Encoding'] = urllib3.util.make_headers(
+                accept_encoding=True)['accept-encoding']
+            session.verify = False
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=2, pool_maxsize=HTTP_POOL_SIZE
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[key] = session
+        return session
 
 
-def fetch_parent_users():
+def _refresh_http_sessions():
     """
-    Получает полный список пользователей с parent панели (один GET-запрос).
-    Результат используется несколькими шагами синхронизации,
-    чтобы не делать повторных запросов.
+    После перечитывания конфигурации: новые API-ключи — в заголовки существующих
+    сессий (прогретые соединения не закрываются). HTTP_POOL_SIZE действует для
+    сессий, созданных после изменения (новые источники), остальным — после перезапуска.
+    """
+    keys = {src['name']: src['api_key'] for src in get_parent_sources()}
+    with _http_session_lock:
+        for name, session in _http_sessions.items():
+            session.headers['Hiddify-API-Key'] = keys.get(name, API_KEY) if name else API_KEY
+
+
+def reload_config(quiet=False):
+    """
+    (Пере)читает конфигурационный файл и применяет [parent], [database], [sync].
+    Вызывается при импорте модуля и в режиме --daemon по SIGHUP / изменению файла.
 
     Returns:
-        list | None: Список пользователей или None при ошибке
+        set | None: изменившиеся параметры; None — файл не разобран, действуют прежние
     """
-    try:
-        response = requests.get(
-            f"{PARENT_URL}/api/v2/admin/user/",
-            headers={'Hiddify-API-Key': API_KEY},
-            verify=False,
-            timeout=60
-        )
-        if response.status_code != 200:
-            log(f"❌ Ошибка получения пользователей с parent: HTTP {response.status_code}")
-            return None
-        parent_users = response.json()
-        log(f"Получено {len(parent_users)} пользователей с parent панели")
-        return parent_users
-    except Exception as e:
-        log(f"❌ Ошибка запроса списка пользователей с parent: {e}")
+    global CHILD_URL
+    config = sync_config.load_config()
+    if config is None:
         return None
+    changed = sync_config.apply_config(globals(), config, ('parent', 'database', 'sync'), CONFIG_NAMES)
+    if not sync_config.is_configured(globals(), 'CHILD_URL'):
+        child_url = "http://127.0.0.1:9000/" + PARENT_URL.rstrip("/").rsplit("/", 1)[-1]
+        if child_url != CHILD_URL:
+            CHILD_URL = child_url
+            changed.add('CHILD_URL')
+    if changed:
+        _refresh_http_sessions()
+        if _db_pool is not None:
+            _db_pool.size = DB_POOL_SIZE
+            _db_pool.metrics_path = _state_path(DB_METRICS)
+        if not quiet:
+            log(f"⚙ Конфигурация применена, изменено: {', '.join(sorted(changed))}")
+    return changed
 
 
-def parse_datetime(dt_str):
-    """Парсит строку даты/времени из Hiddify API (формат: 'YYYY-MM-DD HH:MM:SS')."""
-    if not dt_str:
-        return None
-    try:
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
-    except (ValueError, TypeError):
-        return None
+def get_parent_sources():
+    """Источники пользователей: PARENT_SOURCES или единственный PARENT_URL/API_KEY."""
+    if PARENT_SOURCES:
+        return PARENT_SOURCES
+    return [{'name': 'parent', 'url': PARENT_URL, 'api_key': API_KEY}]
 
 
-# ============================================================================
-# СИНХРОНИЗАЦИЯ ТРАФИКА (CHILD → PARENT)
-#
-# Алгоритм накопительной синхронизации:
-# 1. Собираем локальный current_usage для пользователей > порога
-# 2. GET текущий трафик с parent для каждого пользователя
-# 3. new_usage = parent_usage + local_delta
-# 4. PATCH на parent с new_usage
-# 5. Обнуляем локальный current_usage (атомарная транзакция)
-#
-# Это гарантирует, что parent видит суммарный трафик со всех child-серверов.
-# ============================================================================
+def request_timeout(deadline, default):
+    """HTTP-таймаут с учётом дедлайна конвейера: не больше default и не позже deadline."""
+    if deadline is None:
+        return default
+    return max(1.0, min(default, deadline - time.monotonic()))
 
-def collect_local_usage_delta():
+
+def deadline_passed(deadline):
+    """True, если дедлайн конвейера истёк (deadline=None — без ограничения)."""
+    return deadline is not None and time.monotonic() >= deadline
+
+
+# Отложенная до следующего цикла работа текущего прохода конвейера: {вид: количество}.
+# Своя у каждого потока конвейера (режим --daemon), вне прохода не собирается.
+_run_context = threading.local()
+
+
+def note_deferred(kind, count):
+    """Учитывает работу, отложенную до следующего цикла, в отчёте прохода конвейера."""
+    deferred = getattr(_run_context, 'deferred', None)
+    if deferred is not None and count:
+        deferred[kind] = deferred.get(kind, 0) + count
+
+
+def _state_path(name):
+    return os.path.join(STATE_DIR, f"{name}.json")
+
+
+def load_state(name, default):
+    """Читает JSON-состояние STATE_DIR/<name>.json (без блокировки, только чтение)."""
+    try:
+        with open(_state_path(name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        log(f"⚠️ Состояние {name} не прочитано ({e}), используется пустое")
+        return default
+
+
+@contextmanager
+def update_state(name, default):
     """
-    Собирает локальную статистику трафика для отправки на parent.
-    Выбирает только пользователей с current_usage > MIN_TRAFFIC_THRESHOLD.
+    Изменение JSON-состояния под межпроцессной блокировкой (flock).
+    Отдаёт загруженный объект; при выходе без исключения атомарно записывает его
+    (tmp + fsync + rename), чтобы сбой не оставил полузаписанный файл.
     """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(_state_path(name) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        state = load_state(name, default)
+        yield state
+        save_state(name, state)
+
+
+def save_state(name, state):
+    """Атомарно записывает JSON-состояние (tmp + fsync + rename)."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = _state_path(name)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def clear_state(name):
+    """Удаляет файл состояния (если есть)."""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return []
+        os.remove(_state_path(name))
+    except FileNotFoundError:
+        pass
 
-        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute("""
-                SELECT uuid, name, current_usage, last_online
-                FROM user
-                WHERE current_usage > %s
-            """, (MIN_TRAFFIC_THRESHOLD,))
 
-            users_with_usage = cursor.fetchall()
-            usage_deltas = []
-
-            log(f"Найдено {len(users_with_usage)} пользователей с трафиком > {MIN_TRAFFIC_THRESHOLD/(1024**3):.3f}GB")
-
-            for user in users_with_usage:
-                usage_gb = user['current_usage'] / (1024**3)
-                if usage_gb > 0.001:
-                    usage_deltas.append({
-                        'uuid': user['uuid'],
-                        'usage_delta_GB': round(usage_gb, 6),
-                        'last_online': user['last_online'].isoformat() if user['last_online'] else None,
-                        'name': user['name']
-                    })
-                    log(f"  {user['name']}: +{usage_gb:.3f}GB")
-
-        conn.close()
-        return usage_deltas
-    except Exception as e:
-        log(f"❌ Ошибка сбора статистики: {e}")
-        traceback.print_exc()
-        return []
+# Межпроцессная блокировка запусков конвейеров (run_lock): STATE_DIR/run_<имя>.lock
+RUN_LOCK = 'run_{}.lock'
 
 
-def get_parent_user_usage(uuid):
-    """Получает текущий трафик пользователя с parent панели (в GB)."""
-    try:
-        response = requests.get(
-            f"{PARENT_URL}/api/v2/admin/user/{uuid}/",
-            headers={'Hiddify-API-Key': API_KEY},
-            verify=False,
-            timeout=30
-        )
-        if response.status_code == 200:
-            return response.json().get('current_usage_GB', 0)
-        elif response.status_code == 404:
-            log(f"⚠️  Пользователь {uuid[:8]}... не найден на parent")
-            return 0
-        else:
-            log(f"❌ Ошибка получения пользователя: HTTP {response.status_code}")
-            return None
-    except Exception as e:
-        log(f"❌ Ошибка запроса к parent: {e}")
-        return None
+def _run_lock_path(name):
+    return os.path.join(STATE_DIR, RUN_LOCK.format(name))
 
 
-def update_parent_user_usage(uuid, new_usage_gb, name="Unknown"):
-    """Обновляет суммарный трафик пользователя на parent панели через PATCH."""
+def _holder_alive(holder):
+    """Жив ли процесс-владелец (проверяется только на этом же хосте)."""
+    if holder.get('host') != socket.gethostname():
+        return True
     try:
-        data = {"current_usage_GB": new_usage_gb}
-        response = requests.patch(
-            f"{PARENT_URL}/api/v2/admin/user/{uuid}/",
-            headers={'Hiddify-API-Key': API_KEY},
-            json=data,
-            verify=False,
-            timeout=30
-        )
-        if response.status_code == 200:
-            log(f"✅ Обновлён трафик {name}: {new_usage_gb:.3f}GB")
-            return True
-        else:
-            log(f"❌ Ошибка обновления {name}: HTTP {response.status_code} - {response.text[:200]}")
-            return False
-    except Exception as e:
-        log(f"❌ Ошибка обновления пользователя {name}: {e}")
+        os.kill(holder['pid'], 0)
+    except ProcessLookupError:
         return False
+    except PermissionError:
+        pass
+    return True
 
 
-def send_usage_deltas_to_parent(usage_deltas):
-    """
-    Отправляет накопленную дельту трафика на parent панель.
-    Для каждого пользователя: new_usage = parent_usage + local_delta.
+def read_run_lock(name):
     """
-    if not usage_deltas:
-        return True, 0
-
-    log(f"Отправка дельта статистики для {len(usage_deltas)} пользователей...")
+    Владелец блокировки конвейера для health API (без захвата блокировки).
 
-    successful_updates = 0
-    for delta in usage_deltas:
-        uuid = delta['uuid']
-        local_delta = delta['usage_delta_GB']
-        name = delta.get('name', 'Unknown')
+    Returns:
+        dict | None: {'pid', 'host', 'started', 'age_seconds', 'stale'} или None — свободна.
+        stale — процесс умер, не сняв блокировку (flock уже снят ядром), либо
+        выполняется дольше RUN_LOCK_STALE_AFTER.
+    """
+    try:
+        with open(_run_lock_path(name)) as f:
+            holder = json.loads(f.read() or 'null')
+    except (OSError, ValueError):
+        return None
+    if not holder:
+        return None
+    holder['age_seconds'] = round(time.time() - holder['started'])
+    holder['stale'] = not _holder_alive(holder) or holder['age_seconds'] > RUN_LOCK_STALE_AFTER
+    return holder
 
-        parent_usage = get_parent_user_usage(uuid)
-        if parent_usage is None:
-            continue
 
-        new_usage = parent_usage + local_delta
-        log(f"Пользователь {name}: parent={parent_usage:.3f}GB + local={local_delta:.3f}GB = {new_usage:.3f}GB")
+@contextmanager
+def run_lock(name):
+    """
+    Межпроцессная блокировка запуска конвейера (flock на STATE_DIR/run_<имя>.lock):
+    ручной запуск, таймер и daemon не выполнят один конвейер одновременно (иначе
+    один и тот же current_usage ушёл бы на parent дважды).
+
+    Отдаёт True, если блокировка захвачена, иначе False (конвейер уже выполняется).
+    В файл пишется владелец (pid, хост, время старта) для health API. Ядро снимает
+    flock при смерти процесса, поэтому «зависшей» блокировки не бывает: следующий
+    запуск захватывает её и сообщает об аварийном завершении предыдущего.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    fd = os.open(_run_lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        previous = os.read(fd, 4096)
+        if previous.strip():
+            log(f"⚠️ Предыдущий запуск конвейера {name} завершился аварийно "
+                f"({previous.decode(errors='replace')}) — блокировка восстановлена")
+        holder = {'pid': os.getpid(), 'host': socket.gethostname(), 'started': time.time(),
+                  'command': ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:])}
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, json.dumps(holder).encode(), 0)
+        try:
+            yield True
+        finally:
+            os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)
 
-        if update_parent_user_usage(uuid, new_usage, name):
-            successful_updates += 1
 
-    success_rate = successful_updates == len(usage_deltas)
-    log(f"{'✅' if success_rate else '⚠️'} {'Полностью' if success_rate else 'Частично'} успешно: {successful_updates}/{len(usage_deltas)} пользователей обновлено")
+DB_METRICS = 'db_metrics'
 
-    return success_rate, successful_updates
+_db_pool = None
+_db_pool_lock = threading.Lock()
 
 
-def reset_local_usage(usage_deltas):
+def get_db():
     """
-    Сбрасывает локальный current_usage в 0 после успешной отправки на parent.
-    Это критично: без сброса трафик будет отправлен повторно.
+    Общий пул соединений с локальной MySQL (sync_db.DatabasePool): соединения
+    переиспользуются шагами и конвейерами, каждый шаг — своя транзакция
+    (`with get_db().step('имя') as conn`). Метрики шагов — в STATE_DIR/db_metrics.json.
     """
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = sync_db.DatabasePool(lambda: DB_CONFIG, DB_POOL_SIZE, _state_path(DB_METRICS))
+        return _db_pool
 
-        with conn.cursor() as cursor:
-            reset_count = 0
-            for delta in usage_deltas:
-                cursor.execute(
-                    "UPDATE user SET current_usage = 0 WHERE uuid = %s AND current_usage > 0",
-                    (delta['uuid'],)
-                )
-                if cursor.rowcount > 0:
-                    reset_count += 1
-                    log(f"Сброшен трафик для {delta['name']}: {delta['usage_delta_GB']:.3f}GB → 0GB")
 
-            conn.commit()
-            log(f"✅ Сброшен локальный трафик для {reset_count} пользователей")
+USAGE_RING = 'usage_ring.bin'
 
-        conn.close()
-        return True
-    except Exception as e:
-        log(f"❌ Ошибка сброса локальной статистики: {e}")
-        traceback.print_exc()
-        return False
+
+def get_usage_ring():
+    """Поколоночный журнал отправленного трафика (usage_ring.UsageRing в STATE_DIR)."""
+    return usage_ring.UsageRing(os.path.join(STATE_DIR, USAGE_RING), USAGE_RING_CAPACITY)
 
 
 # ============================================================================
-# СИНХРОНИЗАЦИЯ LAST_ONLINE (CHILD ↔ PARENT)
+# АДАПТИВНЫЙ КЛИЕНТ PARENT (BACKPRESSURE)
 #
-# Двунаправленная синхронизация: выигрывает более свежее значение.
-# Это важно, т.к. пользователь может подключаться через разные child-серверы,
-# а parent должен видеть самое актуальное время последнего подключения.
+# Все запросы к parent идут через parent_request(): у каждого источника свой
+# ParentGate — AIMD-лимит одновременных запросов, средняя латентность (адаптивный
+# таймаут), Retry-After и circuit breaker. Перегруженный parent получает меньше
+# запросов, а не тот же поток с повторами от каждого child. Открытый breaker и
+# Retry-After сохраняются в STATE_DIR/parent_health.json: запуски по таймеру
+# (отдельные процессы) их соблюдают.
 # ============================================================================
 
-def sync_last_online(parent_users):
-    """
-    Двунаправленная синхронизация last_online между child и parent.
+PARENT_HEALTH = 'parent_health'
+
+# Ответы «parent перегружен»: повтор с backoff, уменьшение лимита, счёт breaker'а
+OVERLOAD_STATUSES = frozenset({429, 502, 503, 504})
+
+
+class ParentDeferred(Exception):
+    """Запрос не отправлен: parent перегружен (breaker открыт, Retry-After, нет слота)."""
+
+
+class ParentGate:
+    """Лимит параллельности, латентность, Retry-After и circuit breaker одного источника."""
+
+    def __init__(self, name, saved=None):
+        saved = saved or {}
+        self.name = name
+        self.limit = float(PARENT_CONCURRENCY_START)
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.latency = None
+        self.last_decrease = 0.0
+        self.failures = 0
+        self.probing = False
+        self.open_until = saved.get('open_until', 0.0)
+        self.blocked_until = saved.get('blocked_until', 0.0)
+        self.cooldown = saved.get('cooldown', PARENT_BREAKER_COOLDOWN)
+        self.stats = {'requests': 0, 'overloads': 0, 'errors': 0, 'deferred': 0, 'opened': 0,
+                      'wire_bytes': 0, 'decoded_bytes': 0}
+
+    def breaker_state(self, now=None):
+        now = now or time.time()
+        if now < self.open_until:
+            return 'open'
+        return 'half-open' if self.open_until else 'closed'
+
+    def accepts(self, critical=False):
+        """Можно ли сейчас отправить запрос (без ожидания слота)."""
+        now = time.time()
+        if self.breaker_state(now) == 'open' or now < self.blocked_until:
+            return critical
+        return not (self.probing and not critical)
+
+    def timeout(self, default):
+        """Таймаут по средней латентности (до default)."""
+        if self.latency is None:
+            return default
+        return min(default, max(PARENT_TIMEOUT_MIN, self.latency * PARENT_TIMEOUT_FACTOR))
+
+    def enter(self, critical, deadline):
+        """
+        Занимает слот. Returns: True — запрос является пробой после открытого
+        breaker'а. ParentDeferred — запрос нужно отложить.
+        """
+        now = time.time()
+        if not self.accepts(critical):
+            with self.cond:
+                self.stats['deferred'] += 1
+            raise ParentDeferred(f"parent {self.name} перегружен — запрос отложен")
+        wait = self.blocked_until - now
+        if wait > 0:
+            # Критичный запрос ждёт Retry-After, если он укладывается в дедлайн
+            if wait > PARENT_RETRY_AFTER_CAP or (deadline is not None and time.monotonic() + wait >= deadline):
+                raise ParentDeferred(f"parent {self.name}: Retry-After {wait:.0f}с")
+            time.sleep(wait)
+        with self.cond:
+            probe = self.breaker_state() == 'half-open'
+            if probe:
+                # Одна проба за раз: остальные ждут её результата
+                if self.probing:
+                    self.stats['deferred'] += 1
+                    raise ParentDeferred(f"parent {self.name}: идёт проба после перегрузки")
+                self.probing = True
+            while self.in_flight >= max(1, int(self.limit)):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.probing = self.probing and not probe
+                    raise ParentDeferred(f"parent {self.name}: нет свободного слота до дедлайна")
+                self.cond.wait(remaining)
+            self.in_flight += 1
+            self.stats['requests'] += 1
+        return probe
+
+    def leave(self, probe, outcome, elapsed, retry_after=None):
+        """
+        Итог запроса (probe — результат enter): 'ok' (parent ответил), 'overload'
+        (429/502/503/504, обрыв, таймаут) или 'error' (прочие 5xx).
+        """
+        now = time.time()
+        changed = False
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+            if probe:
+                self.probing = False
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            if outcome == 'ok':
+                self.failures = 0
+                if elapsed > PARENT_LATENCY_TARGET:
+                    self._decrease(now)
+                else:
+                    # Аддитивный рост: примерно +1 за окно из limit быстрых ответов
+                    self.limit = min(float(PARENT_CONCURRENCY_MAX), self.limit + 1.0 / self.limit)
+                if self.open_until:
+                    log(f"✅ parent {self.name}: отвечает, circuit breaker закрыт")
+                    self.open_until, self.cooldown = 0.0, PARENT_BREAKER_COOLDOWN
+                    changed = True
+            else:
+                self.failures += 1
+                self.stats['overloads' if outcome == 'overload' else 'errors'] += 1
+                self._decrease(now)
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+                    changed = True
+                if probe or (self.failures >= PARENT_BREAKER_FAILURES
+                             and self.breaker_state(now) != 'open'):
+                    if probe:
+                        self.cooldown = min(self.cooldown * 2, PARENT_BREAKER_COOLDOWN_MAX)
+                    self.open_until = now + self.cooldown * random.uniform(0.8, 1.2)
+                    self.failures = 0
+                    self.stats['opened'] += 1
+                    changed = True
+                    log(f"⛔ parent {self.name}: перегружен, circuit breaker открыт на "
+                        f"{self.open_until - now:.0f}с — трафик и last_online отложены")
+        if changed:
+            save_parent_health()
+
+    def record_transfer(self, wire, decoded):
+        """Байты ответа по сети и после распаковки (экономия от gzip/br)."""
+        with self.cond:
+            self.stats['wire_bytes'] += wire
+            self.stats['decoded_bytes'] += decoded
+
+    def _decrease(self, now):
+        """Мультипликативное уменьшение — не чаще раза за среднюю латентность."""
+        if now - self.last_decrease >= (self.latency or 1.0):
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+    def snapshot(self):
+        return {
+            'breaker': self.breaker_state(),
+            'open_until': self.open_until,
+            'blocked_until': self.blocked_until,
+            'cooldown': self.cooldown,
+            'concurrency': round(self.limit, 2),
+            'latency_ms': None if self.latency is None else round(self.latency * 1000),
+            'stats': dict(self.stats),
+        }
+
+
+_parent_gates = {}
+_parent_gates_lock = threading.Lock()
+
+
+def parent_gate(source):
+    """ParentGate источника (создаётся один раз на процесс, breaker — из STATE_DIR)."""
+    with _parent_gates_lock:
+        gate = _parent_gates.get(source['name'])
+        if gate is None:
+            saved = load_state(PARENT_HEALTH, {}).get(source['name'])
+            gate = _parent_gates[source['name']] = ParentGate(source['name'], saved)
+        return gate
+
+
+def save_parent_health():
+    """Состояние источников для /health и следующих запусков."""
+    with _parent_gates_lock:
+        gates = list(_parent_gates.values())
+    try:
+        with update_state(PARENT_HEALTH, {}) as state:
+            for gate in gates:
+                state[gate.name] = gate.snapshot()
+    except OSError:
+        pass
 
-    Для каждого пользователя сравнивает временные метки:
-      - Если local > parent → PATCH на parent (пользователь был активен здесь)
-      - Если parent > local → UPDATE в локальной БД (был активен на другом child)
+
+def _retry_after(response):
+    """Retry-After (секунды или HTTP-дата) или None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def transfer_sizes(response):
+    """
+    Размер ответа: (байт по сети, байт после распаковки, Content-Encoding).
+    urllib3 считает байты, прочитанные из сокета до распаковки (raw.tell()).
     """
+    encoding = response.headers.get('Content-Encoding')
+    decoded = len(response.content or b'')
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        wire = response.raw.tell()
+    except Exception:
+        wire = 0
+    return (wire or (0 if encoding else decoded)), decoded, encoding
 
-        # Строим карту parent last_online {uuid: {last_online, name}}
-        parent_online_map = {}
-        for pu in parent_users:
-            parent_online_map[pu['uuid']] = {
-                'last_online': parse_datetime(pu.get('last_online')),
-                'name': pu['name']
-            }
 
-        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute("SELECT uuid, name, last_online FROM user")
-            local_users = cursor.fetchall()
+def _backoff(attempt, deadline, at_least=0.0):
+    """Full jitter: случайная пауза до min(BACKOFF_MAX, BASE·2^attempt); False — не успеть до дедлайна."""
+    pause = max(at_least, random.uniform(0, min(PARENT_BACKOFF_MAX, PARENT_BACKOFF_BASE * 2 ** attempt)))
+    if deadline is not None and time.monotonic() + pause >= deadline:
+        return False
+    time.sleep(pause)
+    return True
 
-            pushed_count = 0
-            pulled_count = 0
 
-            for local_user in local_users:
-                uuid = local_user['uuid']
-                local_online = local_user['last_online']
-                name = local_user['name']
+def parent_request(source, method, path, critical=False, deadline=None, timeout=30, budget=None,
+                   **kwargs):
+    """
+    HTTP-запрос к источнику parent через его ParentGate.
 
-                if uuid not in parent_online_map:
-                    continue
+    critical=True — запрос нужен для работы цикла (список пользователей, точечная
+    синхронизация): проходит и при открытом breaker'е. Некритичные при перегрузке
+    не отправляются (ParentDeferred) — данные остаются локально до следующего цикла.
+    budget — PushBudget/BudgetShare: каждая попытка (и повтор) расходует запрос,
+    при исчерпании — ParentDeferred.
 
-                parent_online = parent_online_map[uuid]['last_online']
+    Returns:
+        requests.Response (в том числе 429/5xx после исчерпания повторов)
 
-                if local_online and parent_online:
-                    if local_online > parent_online:
-                        if _push_last_online_to_parent(uuid, local_online, name):
-                            pushed_count += 1
-                    elif parent_online > local_online:
-                        cursor.execute(
-                            "UPDATE user SET last_online = %s WHERE uuid = %s",
-                            (parent_online, uuid)
-                        )
-                        pulled_count += 1
-                elif local_online and not parent_online:
-                    if _push_last_online_to_parent(uuid, local_online, name):
-                        pushed_count += 1
-                elif parent_online and not local_online:
-                    cursor.execute(
-                        "UPDATE user SET last_online = %s WHERE uuid = %s",
-                        (parent_online, uuid)
-                    )
-                    pulled_count += 1
+    Raises:
+        ParentDeferred, requests.RequestException
+    """
+    import requests
+    gate = parent_gate(source)
+    url = f"{source['url']}{path}"
+    for attempt in range(PARENT_REQUEST_RETRIES + 1):
+        if budget is not None and not budget.take():
+            raise ParentDeferred(f"parent {source['name']}: бюджет запросов цикла исчерпан")
+        try:
+            probe = gate.enter(critical, deadline)
+        except ParentDeferred:
+            if budget is not None:
+                budget.give_back(1)   # запрос не отправлен
+            raise
+        started = time.monotonic()
+        try:
+            response = get_http_session(source).request(
+                method, url, timeout=request_timeout(deadline, gate.timeout(timeout) if not critical else timeout),
+                **kwargs
+            )
+        except requests.exceptions.ReadTimeout:
+            # Исход неизвестен (PATCH мог примениться) — решает вызывающий
+            gate.leave(probe, 'overload', time.monotonic() - started)
+            raise
+        except requests.exceptions.ConnectionError:
+            gate.leave(probe, 'overload', time.monotonic() - started)
+            if attempt == PARENT_REQUEST_RETRIES or not _backoff(attempt, deadline):
+                raise
+            continue
+        except Exception:
+            gate.leave(probe, 'error', time.monotonic() - started)
+            raise
+
+        elapsed = time.monotonic() - started
+        if response.status_code in OVERLOAD_STATUSES:
+            retry_after = _retry_after(response)
+            gate.leave(probe, 'overload', elapsed, retry_after)
+            if (attempt == PARENT_REQUEST_RETRIES or (retry_after or 0) > PARENT_RETRY_AFTER_CAP
+                    or not _backoff(attempt, deadline, retry_after or 0.0)):
+                return response
+            continue
+        gate.record_transfer(*transfer_sizes(response)[:2])
+        gate.leave(probe, 'error' if response.status_code >= 500 else 'ok', elapsed)
+        return response
+    return response
+
+
+# Общий снимок пользователей parent: заполняется fetch_parent_users() и
+# переиспользуется конвейерами, чтобы не делать повторных GET-запросов.
+# owners — карта владельцев {uuid: имя источника} для отправки трафика/last_online.
+_parent_snapshot = {'users': None, 'fetched_at': 0.0, 'failed_at': 0.0, 'owners': {},
+                    'requested_at': None}
+_parent_snapshot_lock = threading.Lock()
+
+# Формат файла снимка (STATE_DIR/parent_snapshot.bin):
+#   заголовок <4sHIdIIQ: magic, версия, число пользователей, время получения (unix),
+#                        CRC32 и длина данных, контрольная сумма набора UUID;
+#   индекс — count записей SNAPSHOT_INDEX (ключ UUID 16 байт, отпечаток строки 8 байт),
+#            отсортированных по ключу;
+#   строки — marshal списка кортежей по полям SNAPSHOT_FIELDS в порядке индекса.
+# Файл читается через mmap: сравнение со следующим получением использует только
+# индекс (24 байта на пользователя) без разбора строк;
+# словари строятся лениво при обходе (SnapshotUsers). Снимок версии 2 (без индекса)
+# не читается и перезаписывается при следующем получении.
+SNAPSHOT_FILE = 'parent_snapshot.bin'
+SNAPSHOT_MAGIC = b'HCSS'
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct('<4sHIdIIQ')
+SNAPSHOT_INDEX = struct.Struct('<16s8s')
+SNAPSHOT_FIELDS = (
+    'uuid', 'name', 'enable', 'is_active', 'last_online', 'current_usage_GB',
+    'usage_limit_GB', 'package_days', 'start_date', 'last_reset_time', 'mode', '_parent',
+)
+
+
+class SnapshotUsers:
+    """
+    Пользователи из файла снимка: последовательность словарей (как ответ parent,
+    только поля SNAPSHOT_FIELDS), создаваемых при обращении.
+    """
 
-            conn.commit()
+    def __init__(self, rows):
+        self.rows = rows
 
-            if pushed_count or pulled_count:
-                log(f"✅ last_online: ↑{pushed_count} → parent, ↓{pulled_count} ← parent")
-            else:
-                log(f"last_online: всё актуально, обновлений не требуется")
+    def __len__(self):
+        return len(self.rows)
 
-        conn.close()
-        return True
-    except Exception as e:
-        log(f"❌ Ошибка синхронизации last_online: {e}")
-        traceback.print_exc()
-        return False
+    def __iter__(self):
+        for row in self.rows:
+            yield dict(zip(SNAPSHOT_FIELDS, row))
 
+    def __getitem__(self, index):
+        return dict(zip(SNAPSHOT_FIELDS, self.rows[index]))
 
-def _push_last_online_to_parent(uuid, local_online, name):
-    """Отправляет last_online одного пользователя на parent через PATCH."""
+
+def _snapshot_key(uuid):
+    """Ключ индекса: 16 байт UUID (для нестандартных значений — BLAKE2b)."""
+    uuid = str(uuid)
     try:
-        data = {"last_online": local_online.strftime("%Y-%m-%d %H:%M:%S")}
-        response = requests.patch(
-            f"{PARENT_URL}/api/v2/admin/user/{uuid}/",
-            headers={'Hiddify-API-Key': API_KEY},
-            json=data,
-            verify=False,
-            timeout=30
-        )
-        if response.status_code == 200:
-            return True
-        else:
-            log(f"  ⚠️ {name}: не удалось обновить last_online на parent: HTTP {response.status_code}")
-            return False
-    except Exception as e:
-        log(f"  ⚠️ {name}: ошибка отправки last_online: {e}")
-        return False
+        key = bytes.fromhex(uuid.replace('-', ''))
+        if len(key) == 16:
+            return key
+    except ValueError:
+        pass
+    return hashlib.blake2b(uuid.encode(), digest_size=16).digest()
 
 
-def _delete_missing_users(missing_uuids):
-    """Удаляет юзеров, отсутствующих на parent, через ЛОКАЛЬНЫЙ admin-API child.
-    Hiddify сам делает каскад БД (user_detail) + удаление из работающего Xray (gRPC RemoveUser).
-    Раньше таких БЛОКИРОВАЛИ (enable=0) -> они висели на child и попадали в агрегацию подписки."""
-    deleted = 0
-    for uuid in missing_uuids:
-        try:
-            response = requests.delete(
-                f"{CHILD_URL}/api/v2/admin/user/{uuid}/",
-                # Без явного Host: локальный admin-API (127.0.0.1:9000) принимает
-                # дефолтный Host запроса — механизм не привязан к конкретному домену.
-                headers={'Hiddify-API-Key': API_KEY},
-                verify=False,
-                timeout=30
-            )
-            if response.status_code in (200, 204):
-                deleted += 1
-                log(f"🗑️  Удалён отсутствующий на parent: {uuid[:8]}…")
-            else:
-                log(f"  ⚠️ Не удалён {uuid[:8]}…: HTTP {response.status_code}")
-        except Exception as e:
-            log(f"  ⚠️ Ошибка удаления {uuid[:8]}…: {e}")
-    return deleted
+class SnapshotBuilder:
+    """
+    Строки и индекс снимка, накапливаемые по мере получения списка (страницами или
+    источниками, из нескольких потоков): ключи и отпечатки считаются, пока
+    остальные страницы ещё в пути, после получения остаётся только сортировка.
+    Отпечаток — BLAKE2b от repr строки: значения из JSON (str/int/float/bool/None)
+    дают стабильный repr, в отличие от marshal с его ссылками на общие объекты.
+    """
 
+    def __init__(self):
+        self.keyed = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keyed)
+
+    def add(self, users):
+        blake2b = hashlib.blake2b
+        keyed = []
+        for user in users:
+            if not isinstance(user, dict):
+                continue  # отклонит validate_parent_users
+            row = tuple([user.get(f) for f in SNAPSHOT_FIELDS])
+            keyed.append((_snapshot_key(row[0]),
+                          blake2b(repr(row).encode(), digest_size=8).digest(), row))
+        with self.lock:
+            self.keyed.extend(keyed)
+
+    def finish(self):
+        """
+        Returns:
+            tuple(list, bytes): (строки в порядке ключей, индекс)
+        """
+        with self.lock:
+            keyed = sorted(self.keyed, key=lambda item: item[0])
+        pack = SNAPSHOT_INDEX.pack
+        return ([row for _, _, row in keyed],
+                b''.join([pack(key, fingerprint) for key, fingerprint, _ in keyed]))
+
+
+def build_snapshot(parent_users):
+    """Строки снимка в порядке ключей и индекс (ключ, отпечаток строки)."""
+    builder = SnapshotBuilder()
+    builder.add(parent_users)
+    return builder.finish()
+
+
+def diff_snapshot_index(old_index, new_index):
+    """
+    Сравнение двух индексов снимка без разбора строк.
 
-def _run_xray_helper(script_path, uuids, label):
+    Returns:
+        dict: {'added', 'removed', 'changed', 'unchanged'} — число пользователей
     """
-    Запускает helper активации/деактивации Xray (subprocess; venv-питон в shebang скрипта).
-    Идемпотентные операции над работающим Xray по gRPC. uuids — список UUID.
+    old = dict(SNAPSHOT_INDEX.iter_unpack(old_index))
+    added = removed = changed = 0
+    for key, fingerprint in SNAPSHOT_INDEX.iter_unpack(new_index):
+        previous = old.pop(key, None)
+        if previous is None:
+            added += 1
+        elif previous != fingerprint:
+            changed += 1
+    removed = len(old)
+    unchanged = len(new_index) // SNAPSHOT_INDEX.size - added - changed
+    return {'added': added, 'removed': removed, 'changed': changed, 'unchanged': unchanged}
+
+
+@contextmanager
+def _mapped_snapshot():
     """
-    if not uuids:
+    Файл снимка через mmap с проверкой magic/версии/длины/CRC32.
+    Отдаёт (count, fetched_at, checksum, index, rows) — memoryview, действительные
+    внутри with. None — файла нет.
+    """
+    try:
+        f = open(os.path.join(STATE_DIR, SNAPSHOT_FILE), 'rb')
+    except FileNotFoundError:
+        yield None
         return
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+            memoryview(mapped) as view:
+        magic, version, count, fetched_at, crc, length, checksum = SNAPSHOT_HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("неизвестный формат")
+        with view[SNAPSHOT_HEADER.size:] as payload:
+            index_size = count * SNAPSHOT_INDEX.size
+            if len(payload) != length or length < index_size or zlib.crc32(payload) != crc:
+                raise ValueError("повреждён (длина/CRC32)")
+            with payload[:index_size] as index, payload[index_size:] as rows:
+                yield count, fetched_at, checksum, index, rows
+
+
+def save_parent_snapshot(parent_users, fetched_at, uuid_checksum, builder=None):
+    """
+    Атомарно сохраняет снимок parent в STATE_DIR (компактно, с индексом и CRC32).
+    Новый список сравнивается с сохранённым по индексу; без изменений — файл не
+    перезаписывается, обновляется только время получения в заголовке.
+    builder — SnapshotBuilder, заполненный при получении списка (иначе строится здесь).
+
+    Returns:
+        dict | None: результат diff_snapshot_index (None — прошлого снимка нет)
+    """
     try:
-        import subprocess
-        result = subprocess.run(
-            [script_path] + list(uuids),
-            capture_output=True, text=True, timeout=120
-        )
-        if result.returncode == 0:
-            summary = (result.stdout.strip().splitlines() or [''])[-1]
-            log(f"✅ Xray {label}: {summary}")
+        if builder is not None and len(builder) == len(parent_users):
+            rows, index = builder.finish()
         else:
-            log(f"⚠️ Ошибка {label} в Xray: {result.stderr[:200]}")
+            rows, index = build_snapshot(parent_users)
+        diff = None
+        try:
+            with _mapped_snapshot() as saved:
+                if saved is not None:
+                    diff = diff_snapshot_index(saved[3], index)
+        except (ValueError, struct.error, OSError):
+            pass
+
+        os.makedirs(STATE_DIR, exist_ok=True)
+        path = os.path.join(STATE_DIR, SNAPSHOT_FILE)
+        if diff is not None and not (diff['added'] or diff['removed'] or diff['changed']):
+            with open(path, 'r+b') as f:
+                header = bytearray(f.read(SNAPSHOT_HEADER.size))
+                values = list(SNAPSHOT_HEADER.unpack(header))
+                values[3] = fetched_at
+                f.seek(0)
+                f.write(SNAPSHOT_HEADER.pack(*values))
+            return diff
+
+        payload = index + marshal.dumps(rows)
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(rows), fetched_at,
+                                      zlib.crc32(payload), len(payload), uuid_checksum)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return diff
     except Exception as e:
-        log(f"⚠️ Сбой {label} в Xray: {e}")
-
+        log(f"⚠️ Не удалось сохранить снимок parent: {e}")
+        return None
 
-# ============================================================================
-# СИНХРОНИЗАЦИЯ ПОЛЬЗОВАТЕЛЕЙ (PARENT → CHILD)
-#
-# Parent — единственный источник истины для:
-#   - Списка пользователей (создание/блокировка)
-#   - Лимитов, пакетов, статусов, ключей
-#
-# Child управляет локально:
-#   - current_usage (сбрасывается после отправки на parent)
-#   - last_online (синхронизируется отдельно в sync_last_online)
-# ============================================================================
 
-def sync_users_from_parent(parent_users):
+def read_parent_snapshot_header():
     """
-    Полная синхронизация пользователей с parent панели.
-
-    Создаёт новых, обновляет существующих, УДАЛЯЕТ отсутствующих на parent.
-    Состояние child-enable и членство в работающем Xray определяются по parent.is_active
-    (ground-truth: учитывает блокировку, исчерпание трафика и истечение срока):
-      - is_active=True  → enable=1, юзер ДОБАВЛЯЕТСЯ в Xray (activate_new_users_direct.py);
-      - is_active=False → enable=0, юзер УДАЛЯЕТСЯ из Xray (deactivate_users_direct.py),
-        соединение рвётся немедленно, не дожидаясь фоновой реконсиляции Hiddify.
+    Заголовок файла снимка без чтения данных (для health API).
 
-    Args:
-        parent_users: Список пользователей с parent (из fetch_parent_users)
+    Returns:
+        dict | None: {'users', 'fetched_at', 'age_seconds', 'uuid_checksum', 'size_bytes'}
+        или None, если снимка нет
     """
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        with open(os.path.join(STATE_DIR, SNAPSHOT_FILE), 'rb') as f:
+            magic, version, count, fetched_at, _, length, checksum = SNAPSHOT_HEADER.unpack(
+                f.read(SNAPSHOT_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    return {'users': count, 'fetched_at': fetched_at,
+            'age_seconds': round(time.time() - fetched_at), 'uuid_checksum': checksum,
+            'size_bytes': SNAPSHOT_HEADER.size + length}
 
-        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute("SELECT uuid, name, enable FROM user")
-            local_users = cursor.fetchall()
-            local_uuids = {u['uuid'] for u in local_users}
-            parent_uuids = {u['uuid'] for u in parent_users}
-
-            synced_count = 0
-            blocked_count = 0
-            unblocked_count = 0
-            created_count = 0
-            created_uuids = []
-            activate_uuids = []   # созданные-активные + разблокированные (0→1) → добавить в Xray
-            inactive_uuids = []   # все is_active=False на parent → удалить из Xray (идемпотентно)
-
-            for parent_user in parent_users:
-                uuid = parent_user['uuid']
-
-                # is_active = ground-truth parent: enable И не истёк срок И не превышена квота.
-                # Именно он (а НЕ голый enable) определяет, должен ли юзер быть подключаем на child:
-                # при исчерпании трафика/дней parent оставляет enable=1, но is_active=False.
-                is_active = bool(parent_user.get('is_active', parent_user['enable']))
-                desired_enable = 1 if is_active else 0
-                if not is_active:
-                    inactive_uuids.append(uuid)
-
-                cursor.execute("SELECT id, enable FROM user WHERE uuid = %s", (uuid,))
-                existing_user = cursor.fetchone()
-
-                if not existing_user:
-                    # Создаём нового пользователя с пустыми username/password
-                    # (Hiddify использует UUID-авторизацию, НЕ генерируйте password!)
-                    cursor.execute("""
-                        INSERT INTO user (
-                            uuid, name, usage_limit, package_days, mode, enable,
-                            comment, start_date, last_reset_time, current_usage,
-                            telegram_id, ed25519_private_key, ed25519_public_key,
-                            wg_pk, wg_psk, wg_pub, added_by, last_online, max_ips,
-                            username, password
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 0, %s, %s, %s, %s, %s, %s, %s, NOW(), 2, '', '')
-                    """, (
-                        uuid, parent_user['name'], int(parent_user['usage_limit_GB'] * 1024**3),
-                        parent_user['package_days'], parent_user['mode'], desired_enable,
-                        parent_user.get('comment', ''), parent_user.get('start_date'),
-                        parent_user.get('last_reset_time'), parent_user.get('telegram_id'),
-                        parent_user.get('ed25519_private_key', ''), parent_user.get('ed25519_public_key', ''),
-                        parent_user.get('wg_pk', ''), parent_user.get('wg_psk', ''),
-                        parent_user.get('wg_pub', ''), 1
-                    ))
-                    created_count += 1
-                    created_uuids.append(uuid)
-                    if is_active:
-                        activate_uuids.append(uuid)   # сразу подключаем в Xray
-                    log(f"➕ Создан новый пользователь: {parent_user['name']}")
-                else:
-                    # Обновляем все поля кроме current_usage и last_online
-                    cursor.execute("""
-                        UPDATE user SET
-                            name = %s, usage_limit = %s, package_days = %s,
-                            mode = %s, enable = %s, comment = %s, start_date = %s,
-                            last_reset_time = %s, telegram_id = %s,
-                            ed25519_private_key = %s, ed25519_public_key = %s,
-                            wg_pk = %s, wg_psk = %s, wg_pub = %s, added_by = %s
-                        WHERE uuid = %s
-                    """, (
-                        parent_user['name'], int(parent_user['usage_limit_GB'] * 1024**3), parent_user['package_days'],
-                        parent_user['mode'], desired_enable, parent_user.get('comment', ''),
-                        parent_user.get('start_date'), parent_user.get('last_reset_time'),
-                        parent_user.get('telegram_id'),
-                        parent_user.get('ed25519_private_key', ''), parent_user.get('ed25519_public_key', ''),
-                        parent_user.get('wg_pk', ''), parent_user.get('wg_psk', ''),
-                        parent_user.get('wg_pub', ''), 1,
-                        uuid
-                    ))
-
-                    if existing_user['enable'] != desired_enable:
-                        if desired_enable:
-                            unblocked_count += 1
-                            activate_uuids.append(uuid)   # 0→1: вернуть в Xray
-                            log(f"✅ Разблокирован: {parent_user['name']}")
-                        else:
-                            blocked_count += 1
-                            log(f"🚫 Заблокирован: {parent_user['name']}")
-                            # удаление из Xray — ниже, через inactive_uuids (он уже там)
-
-                synced_count += 1
-
-            # Отсутствующих на parent — НЕ блокируем (раньше висели как disabled и попадали в
-            # агрегацию подписки), а УДАЛЯЕМ после коммита через admin-API child.
-            # SAFEGUARD: защита от mass-delete при сбое fetch_parent_users (пустой/частичный список):
-            # не удаляем, если parent пуст ИЛИ к удалению >25% локальных (>10 шт).
-            missing_uuids = list(local_uuids - parent_uuids)
-            if not parent_uuids or len(missing_uuids) > max(10, int(len(local_uuids) * 0.25)):
-                log(f"⚠️ Удаление ПРОПУЩЕНО (safeguard): missing={len(missing_uuids)}, "
-                    f"parent={len(parent_uuids)}, local={len(local_uuids)} — подозрение на сбой fetch")
-                missing_uuids = []
-
-            conn.commit()
-            log(f"✅ Синхронизация: {synced_count} синхр, {created_count} создано, "
-                f"{blocked_count} заблок, {unblocked_count} разблок")
-
-        conn.close()
-
-        # Удаление отсутствующих на parent через admin-API child (каскад БД + Xray), ВНЕ транзакции
-        deleted_count = _delete_missing_users(missing_uuids)
-        if deleted_count:
-            log(f"🗑️  Удалено отсутствующих на parent: {deleted_count}")
-
-        # Деактивация в Xray всех неактивных (is_active=False: блокировка/квота/срок).
-        # Идемпотентно и КАЖДЫЙ цикл (самовосстановление) — child немедленно рвёт соединение,
-        # не дожидаясь фоновой реконсиляции Hiddify. Уже отсутствующие в Xray = no-op.
-        _run_xray_helper('/opt/hiddify-manager/deactivate_users_direct.py', inactive_uuids, 'деактивация')
-
-        # Мгновенная активация в Xray новых и разблокированных (is_active=True)
-        _run_xray_helper('/opt/hiddify-manager/activate_new_users_direct.py', activate_uuids, 'активация')
 
-        return True
+def load_parent_snapshot():
+    """
+    Загружает последний успешный снимок parent с проверкой magic/версии/длины/CRC32.
 
+    Returns:
+        tuple(SnapshotUsers, float) | tuple(None, None): пользователи и время получения
+    """
+    started = time.perf_counter()
+    try:
+        with _mapped_snapshot() as saved:
+            if saved is None:
+                return None, None
+            count, fetched_at, _, _, payload = saved
+            rows = marshal.loads(payload)
+        if len(rows) != count:
+            raise ValueError("число записей не совпадает с заголовком")
     except Exception as e:
-        log(f"❌ Ошибка синхронизации пользователей: {e}")
-        traceback.print_exc()
-        return False
+        log(f"⚠️ Снимок parent отклонён: {e}")
+        return None, None
+    log(f"Снимок parent загружен с диска: {count} пользователей за "
+        f"{(time.perf_counter() - started) * 1000:.0f}мс, возраст {time.time() - fetched_at:.0f}с")
+    return SnapshotUsers(rows), fetched_at
+
+
+# Отклонённое сокращение списка: {checksum, count} в STATE_DIR — подтверждения должны
+# переживать перезапуск (однократный запуск по таймеру — новый процесс каждый цикл)
+PARENT_SHRINK = 'parent_shrink'
+
+
+def validate_parent_users(parent_users):
+    """
+    Быстрая проверка списка parent до любой работы с БД/Xray — один проход по записям
+    без копирования: обязательные поля, дубликаты UUID, контрольная сумма набора UUID
+    и дрейф числа пользователей относительно прошлого снимка (заголовок файла).
+
+    Контрольная сумма — сумма по модулю 2^64 хешей UUID (crc32 << 32 | adler32):
+    не зависит от порядка, а одинаковый усечённый набор даёт одинаковую сумму —
+    сокращение списка принимается, только если тот же набор пришёл
+    PARENT_SHRINK_CONFIRMATIONS раз подряд (легитимная массовая чистка на parent).
+
+    Returns:
+        tuple(int | None, str | None): (контрольная сумма, None) или (None, причина отказа)
+    """
+    if not isinstance(parent_users, list):
+        return None, f"ожидался список, получен {type(parent_users).__name__}"
+
+    required = frozenset(PARENT_REQUIRED_FIELDS)
+    seen = set()
+    checksum = 0
+    for record in parent_users:
+        if not isinstance(record, dict) or not required <= record.keys():
+            missing = sorted(required - record.keys()) if isinstance(record, dict) else required
+            return None, f"запись без обязательных полей {', '.join(missing)}"
+        uuid = record['uuid']
+        if uuid in seen:
+            return None, f"дубликат UUID {str(uuid)[:8]}… (пересечение страниц или источников?)"
+        seen.add(uuid)
+        raw = str(uuid).encode()
+        checksum = (checksum + (zlib.crc32(raw) << 32 | zlib.adler32(raw))) & 0xFFFFFFFFFFFFFFFF
+
+    previous = read_parent_snapshot_header()
+    count = len(parent_users)
+    if previous is not None:
+        shrink = previous['users'] - count
+        if shrink > PARENT_MAX_SHRINK_ABS and shrink > previous['users'] * PARENT_MAX_SHRINK_RATIO:
+            with update_state(PARENT_SHRINK, {}) as rejected:
+                if rejected.get('checksum') == checksum:
+                    rejected['count'] = rejected.get('count', 0) + 1
+                else:
+                    rejected['checksum'], rejected['count'] = checksum, 1
+                confirmations = rejected['count']
+            if confirmations < PARENT_SHRINK_CONFIRMATIONS:
+                return None, (f"список сократился {previous['users']} → {count} "
+                              f"(подтверждение {confirmations}/{PARENT_SHRINK_CONFIRMATIONS})")
+            log(f"⚠️ Сокращение списка parent {previous['users']} → {count} подтверждено "
+                f"{confirmations} раз подряд — принято")
+        elif previous['uuid_checksum'] == checksum and previous['users'] == count:
+            log("Набор пользователей parent не изменился (контрольная сумма UUID)")
+    clear_state(PARENT_SHRINK)
+    return checksum, None
+
+
+def _set_parent_snapshot(users, fetched_at):
+    """Обновляет общий снимок и карту владельцев UUID (вызывать под _parent_snapshot_lock)."""
+    _parent_snapshot['users'] = users
+    _parent_snapshot['fetched_at'] = fetched_at
+    _parent_snapshot['owners'] = {u['uuid']: u.get('_parent') for u in users}
+
+
+def parent_source_for(uuid):
+    """
+    Источник parent, которому принадлежит пользователь (по карте владельцев снимка).
+    С одним источником — всегда он. None — владелец неизвестен (пользователя нет
+    в снимке): отправку надо отложить до следующего получения списков.
+    """
+    sources = get_parent_sources()
+    if len(sources) == 1:
+        return sources[0]
+    with _parent_snapshot_lock:
+        loaded = _parent_snapshot['users'] is not None
+    if not loaded:
+        # Процесс ещё не получал списки (например, сверка журнала в начале цикла) —
+        # владельцы из снимка на диске, без запроса к parent
+        users, fetched_at = load_parent_snapshot()
+        if users is not None:
+            with _parent_snapshot_lock:
+                if _parent_snapshot['users'] is None:
+                    _set_parent_snapshot(users, fetched_at)
+    with _parent_snapshot_lock:
+        owner = _parent_snapshot['owners'].get(uuid)
+    return next((s for s in sources if s['name'] == owner), None)
+
+
+def _fetch_source_users(source, deadline=None, builder=None):
+    """Полный список пользователей одного источника parent; записи помечаются '_parent'."""
+    deadline = min(deadline or float('inf'), time.monotonic() + PARENT_FETCH_TIMEOUT)
+    if PARENT_PAGE_SIZE > 0:
+        try:
+            return _fetch_source_pages(source, deadline, builder)
+        except Exception as e:
+            log(f"❌ Ошибка постраничного получения пользователей с parent {source['name']}: {e}")
+            return None
+    try:
+        response = parent_request(source, 'GET', '/api/v2/admin/user/', critical=True,
+                                  deadline=deadline, timeout=PARENT_FETCH_TIMEOUT)
+        if response.status_code != 200:
+            log(f"❌ Ошибка получения пользователей с parent {source['name']}: HTTP {response.status_code}")
+            return None
+        wire, decoded, encoding = transfer_sizes(response)
+        log(f"Список parent {source['name']}: {decoded / 1024:.0f} КБ JSON, "
+            f"{wire / 1024:.0f} КБ по сети ({encoding or 'без сжатия'})")
+        users = response.json()
+    except Exception as e:
+        log(f"❌ Ошибка запроса списка пользователей с parent {source['name']}: {e}")
+        return None
+    if not isinstance(users, list):
+        return users  # отклонит validate_parent_users
+    for user in users:
+        if isinstance(user, dict):
+            user['_parent'] = source['name']
+    if builder is not None:
+        builder.add(users)
+    return users
+
+
+def _check_repeated_pages(pages, numbers):
+    """
+    RuntimeError, если непустая страница из numbers повторяет другую (те же первый и
+    последний UUID): parent игнорирует номер страницы и отдаёт одну и ту же.
+    """
+    seen = {}
+    for number in sorted(pages):
+        users = pages[number][0]
+        if not users:
+            continue
+        key = tuple(u.get('uuid') if isinstance(u, dict) else repr(u) for u in (users[0], users[-1]))
+        if key in seen and (number in numbers or seen[key] in numbers):
+            raise RuntimeError(f"страница {number} повторяет страницу {seen[key]} — "
+                               f"parent игнорирует {PARENT_PAGE_PARAM}")
+        seen.setdefault(key, number)
+
+
+def _fetch_source_pages(source, deadline, builder=None):
+    """
+    Постраничное получение списка источника (PARENT_PAGE_SIZE > 0).
+
+    Первая страница запрашивается отдельно: по ней видно, поддерживает ли parent
+    пагинацию, и общее число (заголовок X-Total-Count, если parent его отдаёт).
+    Остальные — параллельно (одновременность ограничивает ParentGate источника):
+    все сразу при известном общем числе, иначе волнами, пока не придёт неполная
+    страница. Каждая страница повторяется отдельно; полученные сразу передаются
+    в builder снимка.
+
+    Проверка полноты: все страницы, кроме последней, полные; после неполной —
+    только пустые (без X-Total-Count запрашивается хотя бы одна страница после
+    неполной: parent, урезающий размер страницы, иначе выглядел бы как короткий
+    список); число записей совпадает с X-Total-Count, и он не менялся между
+    страницами (иначе список изменился во время получения — смещение страниц
+    могло пропустить или повторить пользователей). Страница, повторяющая уже
+    полученную (parent игнорирует номер страницы), дедлайн и PARENT_PAGE_MAX
+    прерывают получение.
+
+    Returns:
+        list: пользователи источника
+
+    Raises:
+        RuntimeError: страница не получена или список неполон
+    """
+    started = time.monotonic()
+    transfer = [0, 0]
+    transfer_lock = threading.Lock()
+
+    def fetch_page(number):
+        params = {PARENT_PAGE_PARAM: number, PARENT_PAGE_SIZE_PARAM: PARENT_PAGE_SIZE}
+        error = None
+        for attempt in range(PARENT_PAGE_RETRIES + 1):
+            try:
+                response = parent_request(source, 'GET', '/api/v2/admin/user/', critical=True,
+                                          deadline=deadline, timeout=PARENT_PAGE_TIMEOUT,
+                                          params=params)
+                if response.status_code == 200:
+                    users = response.json()
+                    if not isinstance(users, list):
+                        raise ValueError(f"ожидался список, получен {type(users).__name__}")
+                    wire, decoded, _ = transfer_sizes(response)
+                    with transfer_lock:
+                        transfer[0] += wire
+                        transfer[1] += decoded
+                    for user in users:
+                        if isinstance(user, dict):
+                            user['_parent'] = source['name']
+                    if builder is not None:
+                        builder.add(users)
+                    total = response.headers.get('X-Total-Count', '')
+                    return users, int(total) if total.isdigit() else None
+                error = f"HTTP {response.status_code}"
+            except ParentDeferred:
+                raise
+            except Exception as e:
+                error = str(e)
+            if attempt == PARENT_PAGE_RETRIES or not _backoff(attempt, deadline):
+                break
+        raise RuntimeError(f"страница {number}: {error}")
+
+    first, total = fetch_page(PARENT_PAGE_FIRST)
+    if len(first) > PARENT_PAGE_SIZE:
+        log(f"⚠️ parent {source['name']} не поддерживает пагинацию ({len(first)} записей "
+            f"на первой странице) — получен полный список")
+        return first
+
+    pages = {PARENT_PAGE_FIRST: (first, total)}
+    with ThreadPoolExecutor(max_workers=PARENT_CONCURRENCY_MAX, thread_name_prefix='page') as pool:
+        if total is not None:
+            count = max(1, -(-total // PARENT_PAGE_SIZE))
+            if count > PARENT_PAGE_MAX:
+                raise RuntimeError(f"X-Total-Count {total}: {count} страниц > PARENT_PAGE_MAX")
+            numbers = range(PARENT_PAGE_FIRST + 1, PARENT_PAGE_FIRST + count)
+            pages.update(zip(numbers, pool.map(fetch_page, numbers)))
+            _check_repeated_pages(pages, numbers)
+        else:
+            # Число страниц неизвестно: волнами по PARENT_CONCURRENCY_MAX до неполной
+            # и ещё одной после неё
+            number = PARENT_PAGE_FIRST + 1
+            while True:
+                short = min((n for n, (users, _) in pages.items() if len(users) < PARENT_PAGE_SIZE),
+                            default=None)
+                if short is not None and number > short + 1:
+                    break
+                if deadline_passed(deadline):
+                    raise RuntimeError(f"дедлайн: получено {len(pages)} страниц")
+                if number - PARENT_PAGE_FIRST >= PARENT_PAGE_MAX:
+                    raise RuntimeError(f"больше PARENT_PAGE_MAX ({PARENT_PAGE_MAX}) страниц")
+                wave = range(number, number + (1 if short is not None else PARENT_CONCURRENCY_MAX))
+                pages.update(zip(wave, pool.map(fetch_page, wave)))
+                _check_repeated_pages(pages, wave)
+                number += len(wave)
+
+    users = []
+    short = None
+    for number in sorted(pages):
+        page, page_total = pages[number]
+        if page_total != total:
+            raise RuntimeError(f"общее число изменилось во время получения ({total} → {page_total})")
+        if short is not None and page:
+            raise RuntimeError(f"страница {number} после неполной страницы {short}")
+        if len(page) < PARENT_PAGE_SIZE and short is None:
+            short = number
+        users.extend(page)
+    if total is not None and len(users) != total:
+        raise RuntimeError(f"получено {len(users)} из {total} (X-Total-Count)")
+
+    log(f"Список parent {source['name']}: {len(users)} пользователей, {len(pages)} страниц "
+        f"за {time.monotonic() - started:.1f}с, {transfer[1] / 1024:.0f} КБ JSON, "
+        f"{transfer[0] / 1024:.0f} КБ по сети")
+    return users
+
+
+def fetch_parent_users(deadline=None):
+    """
+    Получает полный список пользователей с parent панели (один GET-запрос на источник;
+    несколько источников PARENT_SOURCES запрашиваются параллельно и объединяются).
+    Успешный результат сохраняется в общий снимок (см. get_parent_snapshot)
+    и на диск (см. load_parent_snapshot), чтобы другие шаги и конвейеры не делали
+    повторных запросов, а при недоступности parent было с чем работать.
+
+    Ошибка любого источника — ошибка всего получения: неполный объединённый список
+    выглядел бы как пропажа пользователей другого parent.
+
+    Returns:
+        list | None: Список пользователей или None при ошибке
+    """
+    requested_at = time.time()
+    sources = get_parent_sources()
+    builder = SnapshotBuilder()
+    if len(sources) == 1:
+        parent_users = _fetch_source_users(sources[0], deadline, builder)
+    else:
+        with ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='parent') as pool:
+            results = list(pool.map(lambda src: _fetch_source_users(src, deadline, builder), sources))
+        parent_users = None
+        if all(isinstance(r, list) for r in results):
+            parent_users = [user for users in results for user in users]
+            log("Списки parent: " + ", ".join(
+                f"{src['name']}={len(users)}" for src, users in zip(sources, results)))
+        elif all(r is not None for r in results):
+            parent_users = next(r for r in results if not isinstance(r, list))
+
+    if parent_users is not None:
+        checksum, reason = validate_parent_users(parent_users)
+        if reason:
+            log(f"❌ Список пользователей parent отклонён: {reason}")
+            parent_users = None
+
+    now = time.time()
+    if parent_users is None:
+        with _parent_snapshot_lock:
+            _parent_snapshot['failed_at'] = now
+        return None
+
+    log(f"Получено {len(parent_users)} пользователей с parent панели")
+    with _parent_snapshot_lock:
+        _set_parent_snapshot(parent_users, now)
+        _parent_snapshot['requested_at'] = requested_at
+    diff = save_parent_snapshot(parent_users, now, checksum, builder)
+    if diff is not None:
+        log(f"Изменения относительно прошлого снимка: +{diff['added']} −{diff['removed']} "
+            f"~{diff['changed']} (без изменений {diff['unchanged']})")
+    return parent_users
+
+
+def get_parent_snapshot(max_age, deadline=None):
+    """
+    Возвращает общий снимок пользователей parent, если он не старше max_age секунд,
+    иначе запрашивает свежий список через fetch_parent_users().
+
+    Если parent недоступен — последний успешный снимок (из памяти или с диска),
+    не старше PARENT_SNAPSHOT_FALLBACK_MAX_AGE. Только для шагов, которым не нужны
+    свежие данные parent (traffic-конвейер).
+    """
+    with _parent_snapshot_lock:
+        users = _parent_snapshot['users']
+        fetched_at = _parent_snapshot['fetched_at']
+        recently_failed = time.time() - _parent_snapshot['failed_at'] < PARENT_RETRY_AFTER
+    age = time.time() - fetched_at
+    if users is not None and age <= max_age:
+        log(f"Используется снимок parent ({len(users)} пользователей, возраст {age:.0f}с)")
+        return users
+
+    if not recently_failed:
+        fresh = fetch_parent_users(deadline=deadline)
+        if fresh is not None:
+            return fresh
+
+    if users is None:
+        users, fetched_at = load_parent_snapshot()
+        if users is None:
+            return None
+        with _parent_snapshot_lock:
+            if _parent_snapshot['users'] is None:
+                _set_parent_snapshot(users, fetched_at)
+    age = time.time() - fetched_at
+    if age > PARENT_SNAPSHOT_FALLBACK_MAX_AGE:
+        log(f"❌ Снимок parent слишком старый для fallback ({age:.0f}с)")
+        return None
+    log(f"⚠️ parent недоступен — работа по снимку возрастом {age:.0f}с ({len(users)} пользователей)")
+    return users
+
+
+def parse_datetime(dt_str):
+    """Парсит строку даты/времени из Hiddify API (формат: 'YYYY-MM-DD HH:MM:SS')."""
+    if not dt_str:
+        return None
+    try:
+        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
+    except (ValueError, TypeError):
+        return None
+
+
+# ============================================================================
+# СИНХРОНИЗАЦИЯ ТРАФИКА (CHILD → PARENT)
+#
+# Алгоритм накопительной синхронизации:
+# 1. Собираем локальный current_usage для пользователей > порога
+# 2. GET текущий трафик с parent для каждого пользователя (+ ETag, если есть)
+# 3. new_usage = parent_usage + local_delta, намерение пишется в журнал
+# 4. PATCH на parent с new_usage (If-Match: ETag — условное обновление)
+# 5. Контрольное чтение: если значение на parent меньше ожидаемого, наш инкремент
+#    перезаписан конкурентом — повтор с шага 2 (ограниченно, с jitter)
+# 6. Вычитаем отправленное из локального current_usage, закрываем запись журнала
+#
+# Это гарантирует, что parent видит суммарный трафик со всех child-серверов.
+# Журнал делает отправку идемпотентной при сбое между PATCH и сбросом: при следующем
+# запуске незакрытые намерения сверяются с parent (recover_usage_journal) и
+# применённые только сбрасываются локально, а не отправляются повторно.
+# Hiddify API не поддерживает compare-and-set: If-Match работает, только если parent
+# отдаёт ETag (сам Hiddify его не отдаёт). Без ETag контрольное чтение ловит лишь часть
+# потерь (см. accumulate_parent_usage). Полностью исключает гонки child-vs-child
+# режим агрегатора (единственный писатель в parent).
+# ============================================================================
+
+# Число повторов накопительного обновления при обнаруженном конфликте
+USAGE_CAS_RETRIES = 3
+
+# Допуск сравнения current_usage_GB (API оперирует GB с плавающей точкой)
+USAGE_EPSILON_GB = 0.000001
+
+USAGE_JOURNAL = 'usage_journal.jsonl'
+# Отправка идёт параллельно (ParentGate): записи журнала дописываются под блокировкой
+_journal_lock = threading.Lock()
+
+
+TRAFFIC_PENDING = 'traffic_pending'
+
+
+class PushBudget:
+    """
+    Бюджет запросов к parent на один traffic-цикл (limit=0 — без ограничения).
+    Расходуется каждым отправленным HTTP-запросом, включая повторы parent_request
+    и CAS-попытки accumulate_parent_usage (передаётся в parent_request как budget).
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, requests_count=1):
+        """Резервирует запросы; False — бюджет исчерпан, операцию нужно отложить."""
+        with self._lock:
+            if self.limit and self.used + requests_count > self.limit:
+                return False
+            self.used += requests_count
+            return True
+
+    def reserve(self, requests_count):
+        """
+        Резерв под операцию из нескольких запросов (BudgetShare) или None — бюджет
+        исчерпан. Операция начинается, только если хватает на её обычный ход.
+        """
+        return BudgetShare(self, requests_count) if self.take(requests_count) else None
+
+    def give_back(self, requests_count):
+        with self._lock:
+            self.used -= requests_count
+
+
+class BudgetShare:
+    """
+    Резерв одной операции в PushBudget: запросы сверх резерва (повторы) берутся из
+    общего бюджета, неизрасходованный резерв возвращается (release).
+    """
+
+    def __init__(self, budget, reserved):
+        self.budget = budget
+        self.reserved = reserved
+
+    def take(self, requests_count=1):
+        if self.reserved >= requests_count:
+            self.reserved -= requests_count
+            return True
+        return self.budget.take(requests_count)
+
+    def give_back(self, requests_count):
+        self.reserved += requests_count
+
+    def release(self):
+        self.budget.give_back(self.reserved)
+        self.reserved = 0
+
+
+def select_usage_deltas(users_with_usage, pending_since, now):
+    """
+    Политика отправки: кого из пользователей с current_usage > 0 отправлять в этом цикле.
+
+    Отправляются пользователи с трафиком >= MIN_TRAFFIC_THRESHOLD и те, чей
+    трафик копится дольше TRAFFIC_MAX_AGE. Просроченные идут первыми, далее —
+    по убыванию дельты; список обрезается до TRAFFIC_MAX_USERS_PER_CYCLE.
+    """
+    selected = []
+    for user in users_with_usage:
+        age = now - pending_since.get(user['uuid'], now)
+        overdue = bool(TRAFFIC_MAX_AGE) and age >= TRAFFIC_MAX_AGE
+        if user['current_usage'] >= MIN_TRAFFIC_THRESHOLD or overdue:
+            selected.append((not overdue, -user['current_usage'], user))
+
+    selected.sort(key=lambda item: item[:2])
+    if TRAFFIC_MAX_USERS_PER_CYCLE and len(selected) > TRAFFIC_MAX_USERS_PER_CYCLE:
+        log(f"Лимит {TRAFFIC_MAX_USERS_PER_CYCLE} пользователей за цикл: "
+            f"{len(selected) - TRAFFIC_MAX_USERS_PER_CYCLE} отложено")
+        selected = selected[:TRAFFIC_MAX_USERS_PER_CYCLE]
+    return [user for _, _, user in selected]
+
+
+def collect_local_usage_delta():
+    """
+    Собирает локальную статистику трафика для отправки на parent
+    по политике select_usage_deltas (порог, максимальный возраст, лимит за цикл).
+
+    Время появления неотправленного трафика у пользователя хранится в
+    STATE_DIR (traffic_pending) и сбрасывается после отправки (reset_local_usage).
+    """
+    try:
+        with get_db().step('collect_usage') as conn, sync_db.dict_cursor(conn) as cursor:
+            cursor.execute("""
+                SELECT uuid, name, current_usage, last_online
+                FROM user
+                WHERE current_usage > 0
+            """)
+            users_with_usage = cursor.fetchall()
+
+        now = time.time()
+        with update_state(TRAFFIC_PENDING, {}) as pending_since:
+            active = {user['uuid'] for user in users_with_usage}
+            for uuid in list(pending_since):
+                if uuid not in active:
+                    del pending_since[uuid]
+            for uuid in active:
+                pending_since.setdefault(uuid, now)
+            selected = select_usage_deltas(users_with_usage, pending_since, now)
+
+        log(f"Найдено {len(users_with_usage)} пользователей с трафиком, к отправке {len(selected)} "
+            f"(порог {MIN_TRAFFIC_THRESHOLD/(1024**3):.3f}GB, возраст {TRAFFIC_MAX_AGE}с)")
+
+        usage_deltas = []
+        for user in selected:
+            usage_gb = user['current_usage'] / (1024**3)
+            usage_deltas.append({
+                'uuid': user['uuid'],
+                'usage_bytes': int(user['current_usage']),
+                'usage_delta_GB': round(usage_gb, 6),
+                'last_online': user['last_online'].isoformat() if user['last_online'] else None,
+                'name': user['name']
+            })
+
+        if usage_deltas:
+            # Сводка вместо строки на пользователя (подробности — GET /usage в health API)
+            largest = sorted(usage_deltas, key=lambda d: d['usage_bytes'], reverse=True)[:3]
+            total_gb = sum(d['usage_bytes'] for d in usage_deltas) / (1024**3)
+            log(f"  Итого к отправке: +{total_gb:.3f}GB, крупнейшие: " +
+                ", ".join(f"{d['name']} +{d['usage_delta_GB']:.3f}GB" for d in largest))
+
+        return usage_deltas
+    except Exception as e:
+        log(f"❌ Ошибка сбора статистики: {e}")
+        traceback.print_exc()
+        return []
+
+
+def get_parent_user_usage(uuid, deadline=None, with_etag=False, source=None, budget=None):
+    """
+    Получает текущий трафик пользователя с parent панели (в GB).
+    with_etag=True — возвращает (usage, etag) для условного обновления.
+    source — источник-владелец (по умолчанию parent_source_for); budget — см. parent_request.
+    """
+    etag = None
+    source = source or parent_source_for(uuid)
+    if source is None:
+        log(f"⚠️  Владелец пользователя {uuid[:8]}... среди parent неизвестен")
+        return (None, None) if with_etag else None
+    try:
+        response = parent_request(source, 'GET', f'/api/v2/admin/user/{uuid}/', deadline=deadline,
+                                  budget=budget)
+        if response.status_code == 200:
+            usage = response.json().get('current_usage_GB', 0)
+            etag = response.headers.get('ETag')
+        elif response.status_code == 404:
+            log(f"⚠️  Пользователь {uuid[:8]}... не найден на parent")
+            usage = 0
+        else:
+            log(f"❌ Ошибка получения пользователя: HTTP {response.status_code}")
+            usage = None
+    except ParentDeferred:
+        usage = None
+    except Exception as e:
+        log(f"❌ Ошибка запроса к parent: {e}")
+        usage = None
+    return (usage, etag) if with_etag else usage
+
+
+def update_parent_user_usage(uuid, new_usage_gb, name="Unknown", deadline=None, etag=None, source=None,
+                             budget=None):
+    """
+    Обновляет суммарный трафик пользователя на parent панели через PATCH.
+
+    Returns:
+        True — обновлено; False — ошибка; None — конфликт условия If-Match (412),
+        значение на parent изменилось после чтения.
+    """
+    source = source or parent_source_for(uuid)
+    if source is None:
+        return False
+    try:
+        data = {"current_usage_GB": new_usage_gb}
+        response = parent_request(
+            source, 'PATCH', f'/api/v2/admin/user/{uuid}/', deadline=deadline, budget=budget,
+            json=data, headers={'If-Match': etag} if etag else None
+        )
+        if response.status_code == 200:
+            log(f"✅ Обновлён трафик {name}: {new_usage_gb:.3f}GB")
+            return True
+        elif response.status_code == 412:
+            log(f"  ↻ {name}: значение на parent изменилось (412), повтор")
+            return None
+        else:
+            log(f"❌ Ошибка обновления {name}: HTTP {response.status_code} - {response.text[:200]}")
+            return False
+    except ParentDeferred:
+        return False
+    except Exception as e:
+        log(f"❌ Ошибка обновления пользователя {name}: {e}")
+        return False
+
+
+def _journal_append(records):
+    """
+    Дописывает записи в журнал отправки трафика (JSON lines).
+    flush без fsync: журнал защищает от падения/убийства процесса, не от потери питания.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with _journal_lock:
+        _journal_write(records)
+
+
+def _journal_write(records):
+    """Запись в журнал; вызывающий держит _journal_lock."""
+    with open(os.path.join(STATE_DIR, USAGE_JOURNAL), 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+
+
+def _journal_open_intents():
+    """Незакрытые намерения журнала: {uuid: последняя intent-запись без done}."""
+    intents = {}
+    try:
+        with open(os.path.join(STATE_DIR, USAGE_JOURNAL)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # недописанная строка при падении
+                if record['op'] == 'intent':
+                    intents[record['uuid']] = record
+                elif record['op'] == 'done':
+                    intents.pop(record['uuid'], None)
+    except FileNotFoundError:
+        pass
+    return intents
+
+
+def journal_usage_done(deltas):
+    """
+    Закрывает намерения отправленных дельт; пустой журнал усекается.
+    Проверка и усечение — под _journal_lock: вызывается и из потоков отправки, и
+    намерение, дописанное между ними другим потоком, иначе стёрлось бы.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with _journal_lock:
+        _journal_write([{'op': 'done', 'uuid': d['uuid']} for d in deltas])
+        if not _journal_open_intents():
+            open(os.path.join(STATE_DIR, USAGE_JOURNAL), 'w').close()
+
+
+def accumulate_parent_usage(delta, deadline=None, budget=None):
+    """
+    Накопительно добавляет дельту пользователя к current_usage_GB на parent.
+
+    Условное обновление по прочитанному значению (If-Match при наличии ETag)
+    и контрольное чтение после PATCH; если наш инкремент перезаписан конкурентом
+    (значение меньше ожидаемого) или условие не выполнено — повтор с jitter,
+    не более USAGE_CAS_RETRIES раз.
+
+    Без ETag (Hiddify его не отдаёт) защита неполная: конкурент, прочитавший то же
+    значение, перезаписывает нашу дельту, а контрольное чтение это замечает, только
+    если перезапись уже случилась и дельта конкурента меньше нашей. Иначе parent
+    недосчитывается трафика одного из писателей. Несколько child, пишущих одних
+    пользователей, должны работать через агрегатор (TRAFFIC_AGGREGATION).
+
+    budget — резерв BudgetShare: каждая попытка и повтор расходуют запросы.
+    """
+    uuid = delta['uuid']
+    local_delta = delta['usage_delta_GB']
+    name = delta.get('name', 'Unknown')
+    source = parent_source_for(uuid)
+    if source is None:
+        log(f"⚠️ {name}: владелец среди parent неизвестен — отправка отложена")
+        return False
+
+    for attempt in range(USAGE_CAS_RETRIES + 1):
+        if attempt:
+            time.sleep(min(random.uniform(0.2, 1.0) * attempt,
+                           max(0.0, request_timeout(deadline, 5) - 1)))
+        if deadline_passed(deadline):
+            return False
+
+        parent_usage, etag = get_parent_user_usage(uuid, deadline=deadline, with_etag=True, source=source,
+                                                   budget=budget)
+        if parent_usage is None:
+            return False
+
+        new_usage = parent_usage + local_delta
+        log(f"Пользователь {name}: parent={parent_usage:.3f}GB + local={local_delta:.3f}GB = {new_usage:.3f}GB")
+
+        _journal_append([{
+            'op': 'intent', 'uuid': uuid, 'name': name, 'parent': source['name'], 'expected': new_usage,
+            'usage_delta_GB': local_delta,
+            'local_bytes': delta.get('local_bytes', delta['usage_bytes']),
+            'spool_bytes': delta.get('spool_bytes', 0),
+        }])
+        updated = update_parent_user_usage(uuid, new_usage, name, deadline=deadline, etag=etag,
+                                           source=source, budget=budget)
+        if updated is None:
+            # 412: PATCH не применён. Намерение закрывается сразу — иначе при неудаче
+            # следующей попытки recover_usage_journal увидел бы значение, сдвинутое
+            # конкурентом, и сбросил бы локально недоставленную дельту
+            journal_usage_done([delta])
+            continue
+
+        actual = get_parent_user_usage(uuid, deadline=deadline, source=source, budget=budget)
+        if actual is None:
+            # Исход неизвестен. Принятый PATCH считаем применённым: дельта попадёт в
+            # pushed, и finalize_pushed_usage закроет намерение после сброса. Иначе
+            # намерение остаётся открытым: в следующем цикле recover_usage_journal
+            # сверит его с parent до новой отправки.
+            return bool(updated)
+        if actual >= new_usage - USAGE_EPSILON_GB:
+            # Применено (в т.ч. если ответ на PATCH потерялся по таймауту)
+            return True
+        # Не применено (в т.ч. перезаписано конкурентом) — намерение закрывается
+        journal_usage_done([delta])
+        if not updated:
+            return False
+        log(f"  ↻ {name}: инкремент перезаписан конкурентом "
+            f"(parent={actual:.3f}GB < {new_usage:.3f}GB), повтор")
+
+    log(f"❌ {name}: не удалось применить дельту за {USAGE_CAS_RETRIES + 1} попыток")
+    return False
+
+
+def send_usage_deltas_to_parent(usage_deltas, deadline=None, budget=None):
+    """
+    Отправляет накопленную дельту трафика на parent панель.
+    Для каждого пользователя: new_usage = parent_usage + local_delta
+    (см. accumulate_parent_usage). budget — PushBudget traffic-цикла.
+
+    Returns:
+        tuple(bool, list): (все ли отправлены, список успешно отправленных дельт).
+        Сбрасывать локально можно только успешно отправленные — иначе при частичном
+        успехе (или остановке по дедлайну) они ушли бы на parent повторно.
+    """
+    if not usage_deltas:
+        return True, []
+
+    log(f"Отправка дельта статистики для {len(usage_deltas)} пользователей...")
+
+    # Параллельно, но не больше текущего AIMD-лимита источника (ParentGate):
+    # при перегрузке parent параллельность падает, при открытом breaker'е
+    # оставшиеся дельты откладываются (трафик остаётся в current_usage)
+    pushed = []
+    deferred = 0
+    with ThreadPoolExecutor(max_workers=max(1, PARENT_CONCURRENCY_MAX)) as pool:
+        futures = {}
+        for delta in usage_deltas:
+            if deadline_passed(deadline):
+                log(f"⏱ Дедлайн traffic-конвейера: остаток ({len(usage_deltas) - len(futures)}) — в следующем цикле")
+                break
+            source = parent_source_for(delta['uuid'])
+            if source is not None and not parent_gate(source).accepts():
+                deferred += 1
+                continue
+            # Резерв на обычный ход (GET, PATCH, контрольный GET); повторы — сверх него
+            share = budget.reserve(3) if budget is not None else None
+            if budget is not None and share is None:
+                log(f"Бюджет запросов к parent исчерпан ({budget.limit}): остаток — в следующем цикле")
+                break
+            futures[pool.submit(accumulate_parent_usage, delta, deadline, share)] = (delta, share)
+        for future in as_completed(futures):
+            delta, share = futures[future]
+            if share is not None:
+                share.release()
+            try:
+                if future.result():
+                    pushed.append(delta)
+            except Exception as e:
+                # Только эта дельта не отправлена: принятые parent'ом должны дойти
+                # до finalize_pushed_usage, резервы остальных — освободиться
+                log(f"❌ Сбой отправки трафика {delta.get('name', delta['uuid'])}: {e}")
+    if deferred:
+        log(f"⏸ parent перегружен: отправка {deferred} дельт отложена до следующего цикла")
+    note_deferred('traffic', len(usage_deltas) - len(futures))
+
+    success_rate = len(pushed) == len(usage_deltas)
+    log(f"{'✅' if success_rate else '⚠️'} {'Полностью' if success_rate else 'Частично'} успешно: {len(pushed)}/{len(usage_deltas)} пользователей обновлено")
+
+    return success_rate, pushed
+
+
+def finalize_pushed_usage(pushed):
+    """
+    После применения на parent: вычитает отправленное из спула агрегатора и из
+    локального current_usage, затем закрывает записи журнала.
+    """
+    if not pushed:
+        return True
+    if TRAFFIC_AGGREGATION == 'aggregator':
+        drain_aggregator_spool(pushed)
+    local = [dict(d, usage_bytes=d.get('local_bytes', d['usage_bytes']))
+             for d in pushed if d.get('local_bytes', d['usage_bytes'])]
+    if local and not reset_local_usage(local):
+        return False
+    journal_usage_done(pushed)
+    if local:
+        log(f"✅ Локальная статистика сброшена для {len(local)} пользователей")
+    return True
+
+
+def recover_usage_journal(deadline=None):
+    """
+    Восстановление после сбоя между PATCH и сбросом: для незакрытых намерений
+    сверяет значение на parent с ожидаемым. Применённые (parent >= expected)
+    только сбрасываются локально; неприменённые закрываются — их трафик остался
+    в current_usage/спуле и уйдёт в текущем цикле.
+
+    Returns:
+        bool: False — parent недоступен, журнал сохранён до следующего цикла
+    """
+    intents = _journal_open_intents()
+    if not intents:
+        return True
+
+    log(f"Журнал трафика: {len(intents)} незавершённых отправок, сверка с parent...")
+    applied, not_applied = [], []
+    sources = {src['name']: src for src in get_parent_sources()}
+    for intent in intents.values():
+        # Намерение помнит владельца: сверка идёт с тем parent, куда ушёл PATCH
+        actual = get_parent_user_usage(intent['uuid'], deadline=deadline,
+                                       source=sources.get(intent.get('parent')))
+        if actual is None:
+            return False
+        if actual >= intent['expected'] - USAGE_EPSILON_GB:
+            applied.append(dict(intent, usage_bytes=intent['local_bytes']))
+        else:
+            not_applied.append(intent)
+
+    if not_applied:
+        journal_usage_done(not_applied)
+    log(f"Журнал трафика: применено ранее {len(applied)}, не применено {len(not_applied)}")
+    return finalize_pushed_usage(applied)
+
+
+def reset_local_usage(usage_deltas):
+    """
+    Вычитает отправленную дельту из локального current_usage после успешной отправки.
+    Это критично: без сброса трафик будет отправлен повторно.
+
+    Вычитается ровно отправленный объём (usage_bytes), а не обнуление: трафик,
+    накопленный Hiddify между сбором и сбросом, остаётся до следующего цикла.
+    """
+    try:
+        with get_db().step('reset_usage') as conn, conn.cursor() as cursor:
+            reset = []
+            for delta in usage_deltas:
+                cursor.execute(
+                    "UPDATE user SET current_usage = GREATEST(current_usage - %s, 0) "
+                    "WHERE uuid = %s AND current_usage > 0",
+                    (delta['usage_bytes'], delta['uuid'])
+                )
+                if cursor.rowcount > 0:
+                    reset.append((delta['uuid'], delta['name'], delta['usage_bytes']))
+
+        reset_bytes = sum(record[2] for record in reset)
+        log(f"✅ Сброшен локальный трафик для {len(reset)} пользователей: "
+            f"-{reset_bytes/(1024**3):.3f}GB")
+
+        # Вместо строки лога на пользователя — запись цикла в журнал трафика
+        try:
+            get_usage_ring().append(reset)
+        except OSError as e:
+            log(f"⚠️ Журнал трафика не записан: {e}")
+
+        # Остаток (трафик после сбора) — новый отсчёт возраста для TRAFFIC_MAX_AGE
+        with update_state(TRAFFIC_PENDING, {}) as pending_since:
+            for delta in usage_deltas:
+                pending_since.pop(delta['uuid'], None)
+        return True
+    except Exception as e:
+        log(f"❌ Ошибка сброса локальной статистики: {e}")
+        traceback.print_exc()
+        return False
+
+
+# ============================================================================
+# АГРЕГАЦИЯ ТРАФИКА (CHILD → АГРЕГАТОР → PARENT)
+#
+# client:     дельта уходит пачкой на агрегатор. Пачка с batch_id сохраняется в
+#             STATE_DIR до подтверждения и переотправляется с тем же batch_id —
+#             агрегатор не учтёт её дважды, даже если потерялся ответ.
+# aggregator: принятые пачки суммируются по UUID в спул (STATE_DIR), traffic-цикл
+#             агрегатора отправляет на parent спул + свою дельту одним обновлением
+#             на пользователя и вычитает из спула только отправленное.
+# ============================================================================
+
+AGGREGATOR_SPOOL = 'aggregator_spool'
+AGGREGATOR_PENDING = 'aggregator_pending'
+
+# Сколько помнить batch_id принятых пачек (секунды) для дедупликации повторов
+AGGREGATOR_BATCH_TTL = 86400
+
+
+def merge_aggregator_batch(node, batch_id, deltas):
+    """
+    Агрегатор: принимает пачку дельт от child и суммирует её в спул по UUID.
+
+    Returns:
+        bool: True — пачка учтена, False — дубликат (уже учтена ранее)
+    """
+    now = time.time()
+    with update_state(AGGREGATOR_SPOOL, {'users': {}, 'batches': {}}) as spool:
+        batches = spool['batches']
+        if batch_id in batches:
+            return False
+        for delta in deltas:
+            entry = spool['users'].setdefault(delta['uuid'], {'bytes': 0, 'name': delta.get('name', '')})
+            entry['bytes'] += int(delta['bytes'])
+        batches[batch_id] = now
+        for old_id in [b for b, ts in batches.items() if now - ts > AGGREGATOR_BATCH_TTL]:
+            del batches[old_id]
+    log(f"📥 Агрегатор: пачка {batch_id[:8]}… от {node} — {len(deltas)} пользователей")
+    return True
+
+
+def merge_with_aggregator_spool(usage_deltas):
+    """
+    Агрегатор: объединяет свою дельту со спулом в одно обновление на UUID.
+    В каждой записи сохраняются части local_bytes/spool_bytes для раздельного сброса.
+    """
+    spool = load_state(AGGREGATOR_SPOOL, {'users': {}, 'batches': {}})['users']
+    merged = {}
+    for delta in usage_deltas:
+        merged[delta['uuid']] = dict(delta, local_bytes=delta['usage_bytes'], spool_bytes=0)
+    for uuid, entry in spool.items():
+        if entry['bytes'] <= 0:
+            continue
+        item = merged.setdefault(uuid, {'uuid': uuid, 'name': entry['name'] or uuid[:8],
+                                        'usage_bytes': 0, 'local_bytes': 0})
+        item['spool_bytes'] = entry['bytes']
+        item['usage_bytes'] += entry['bytes']
+    for item in merged.values():
+        item['usage_delta_GB'] = round(item['usage_bytes'] / (1024**3), 6)
+    if spool:
+        log(f"Агрегатор: {len(spool)} пользователей из спула, итого {len(merged)} обновлений на parent")
+    return list(merged.values())
+
+
+def drain_aggregator_spool(pushed):
+    """Агрегатор: вычитает из спула объёмы, успешно отправленные на parent."""
+    with update_state(AGGREGATOR_SPOOL, {'users': {}, 'batches': {}}) as spool:
+        for item in pushed:
+            entry = spool['users'].get(item['uuid'])
+            if not entry or not item.get('spool_bytes'):
+                continue
+            entry['bytes'] -= item['spool_bytes']
+            if entry['bytes'] <= 0:
+                del spool['users'][item['uuid']]
+
+
+def _post_batch_to_aggregator(batch, deadline=None):
+    try:
+        response = get_http_session().post(
+            f"{AGGREGATOR_URL.rstrip('/')}/api/v2/hiddify-sync/usage-deltas",
+            headers={'X-Sync-Token': AGGREGATOR_TOKEN},
+            json=batch,
+            timeout=request_timeout(deadline, 30)
+        )
+        if response.status_code in (200, 202):
+            return True
+        log(f"❌ Агрегатор отклонил пачку {batch['batch_id'][:8]}…: HTTP {response.status_code}")
+    except Exception as e:
+        log(f"❌ Ошибка отправки на агрегатор: {e}")
+    return False
+
+
+def flush_pending_aggregator_batch(deadline=None):
+    """
+    Client: переотправляет неподтверждённую пачку (тот же batch_id) и после
+    подтверждения вычитает её из локального трафика.
+
+    Подтверждённая пачка с неудавшимся сбросом остаётся с пометкой acked: агрегатор
+    её уже учёл, поэтому повторяется только сброс — иначе тот же трафик ушёл бы
+    следующей пачкой с новым batch_id.
+
+    Returns:
+        bool: True — очередь пуста (можно формировать новую пачку)
+    """
+    batch = load_state(AGGREGATOR_PENDING, None)
+    if not batch:
+        return True
+    if batch.get('acked'):
+        log(f"Повторный сброс локального трафика подтверждённой пачки {batch['batch_id'][:8]}…")
+    else:
+        log(f"Повторная отправка пачки {batch['batch_id'][:8]}… на агрегатор...")
+        if not _post_batch_to_aggregator(batch, deadline):
+            return False
+    if not reset_local_usage(batch['local']):
+        if not batch.get('acked'):
+            batch['acked'] = True
+            save_state(AGGREGATOR_PENDING, batch)
+        log(f"⚠️ Пачка {batch['batch_id'][:8]}… учтена агрегатором, но локальный сброс не удался — повтор в следующем цикле")
+        return False
+    clear_state(AGGREGATOR_PENDING)
+    return True
+
+
+def push_deltas_to_aggregator(usage_deltas, deadline=None):
+    """
+    Client: отправляет дельту пачкой на агрегатор вместо parent.
+    Пачка сохраняется до отправки, чтобы при потере ответа переотправить её
+    с тем же batch_id (см. flush_pending_aggregator_batch).
+    """
+    import uuid as uuid_lib
+    batch = {
+        'node': socket.gethostname(),
+        'batch_id': str(uuid_lib.uuid4()),
+        'deltas': [{'uuid': d['uuid'], 'bytes': d['usage_bytes'], 'name': d['name']}
+                   for d in usage_deltas],
+        'local': usage_deltas,
+    }
+    save_state(AGGREGATOR_PENDING, batch)
+    log(f"Отправка пачки {batch['batch_id'][:8]}… ({len(usage_deltas)} пользователей) на агрегатор...")
+    return flush_pending_aggregator_batch(deadline)
+
+
+# ============================================================================
+# СИНХРОНИЗАЦИЯ LAST_ONLINE (CHILD ↔ PARENT)
+#
+# Двунаправленная синхронизация: выигрывает более свежее значение.
+# Это важно, т.к. пользователь может подключаться через разные child-серверы,
+# а parent должен видеть самое актуальное время последнего подключения.
+# ============================================================================
+
+def sync_last_online(parent_users, deadline=None, budget=None):
+    """
+    Двунаправленная синхронизация last_online между child и parent.
+
+    Для каждого пользователя сравнивает временные метки:
+      - Если local > parent → PATCH на parent (пользователь был активен здесь)
+      - Если parent > local → UPDATE в локальной БД (был активен на другом child)
+
+    PATCH на parent (и его повторы) расходует budget (PushBudget traffic-цикла); при
+    исчерпании отправка откладывается — более свежее local значение уйдёт в следующем цикле.
+    """
+    try:
+        # Строим карту parent last_online {uuid: {last_online, name}}
+        parent_online_map = {}
+        for pu in parent_users:
+            parent_online_map[pu['uuid']] = {
+                'last_online': parse_datetime(pu.get('last_online')),
+                'name': pu['name']
+            }
+
+        with get_db().step('last_online') as conn, sync_db.dict_cursor(conn) as cursor:
+            cursor.execute("SELECT uuid, name, last_online FROM user")
+            local_users = cursor.fetchall()
+
+            pushed_count = 0
+            pulled_count = 0
+            deferred_count = 0
+
+            for checked, local_user in enumerate(local_users):
+                if deadline_passed(deadline):
+                    log("⏱ Дедлайн traffic-конвейера: last_online досинхронизируется в следующем цикле")
+                    note_deferred('last_online_unchecked', len(local_users) - checked)
+                    break
+
+                uuid = local_user['uuid']
+                local_online = local_user['last_online']
+                name = local_user['name']
+
+                if uuid not in parent_online_map:
+                    continue
+
+                parent_online = parent_online_map[uuid]['last_online']
+
+                if local_online and (not parent_online or local_online > parent_online):
+                    source = parent_source_for(uuid)
+                    if source is not None and not parent_gate(source).accepts():
+                        deferred_count += 1
+                        continue
+                    share = budget.reserve(1) if budget is not None else None
+                    if budget is not None and share is None:
+                        deferred_count += 1
+                        continue
+                    if _push_last_online_to_parent(uuid, local_online, name, deadline, share):
+                        pushed_count += 1
+                    if share is not None:
+                        share.release()
+                elif parent_online and (not local_online or parent_online > local_online):
+                    cursor.execute(
+                        "UPDATE user SET last_online = %s WHERE uuid = %s",
+                        (parent_online, uuid)
+                    )
+                    pulled_count += 1
+
+            if deferred_count:
+                log(f"last_online: бюджет запросов исчерпан или parent перегружен, отложено отправок: {deferred_count}")
+                note_deferred('last_online', deferred_count)
+            if pushed_count or pulled_count:
+                log(f"✅ last_online: ↑{pushed_count} → parent, ↓{pulled_count} ← parent")
+            else:
+                log(f"last_online: всё актуально, обновлений не требуется")
+
+        return True
+    except Exception as e:
+        log(f"❌ Ошибка синхронизации last_online: {e}")
+        traceback.print_exc()
+        return False
+
+
+def _push_last_online_to_parent(uuid, local_online, name, deadline=None, budget=None):
+    """Отправляет last_online одного пользователя на его parent через PATCH."""
+    source = parent_source_for(uuid)
+    if source is None:
+        return False
+    try:
+        data = {"last_online": local_online.strftime("%Y-%m-%d %H:%M:%S")}
+        response = parent_request(source, 'PATCH', f'/api/v2/admin/user/{uuid}/',
+                                  deadline=deadline, budget=budget, json=data)
+        if response.status_code == 200:
+            return True
+        else:
+            log(f"  ⚠️ {name}: не удалось обновить last_online на parent: HTTP {response.status_code}")
+            return False
+    except ParentDeferred:
+        return False
+    except Exception as e:
+        log(f"  ⚠️ {name}: ошибка отправки last_online: {e}")
+        return False
+
+
+DELETE_QUEUE = 'delete_queue'
+QUARANTINE = 'quarantine'
+
+
+def _update_quarantine(missing, local_count):
+    """
+    Обновляет счётчики карантина по результату успешного полного получения с parent.
+
+    Счётчик пользователя — сколько полных получений подряд он отсутствует на parent;
+    вернувшиеся выбывают из карантина (синхронизация включит их обратно как
+    разблокированных). При подозрительно большой пропаже (> max(10, 25%) локальных —
+    прежний порог safeguard) отключение начинается со второго подтверждения подряд.
+
+    Returns:
+        tuple(list, list): (UUID в карантине — отключить и убрать из Xray,
+                            UUID к удалению в этом цикле — не больше QUARANTINE_DELETE_BATCH)
+    """
+    suspicious = len(missing) > max(10, int(local_count * 0.25))
+    with update_state(QUARANTINE, {}) as streaks:
+        for uuid in list(streaks):
+            if uuid not in missing:
+                del streaks[uuid]
+        for uuid in missing:
+            streaks[uuid] = streaks.get(uuid, 0) + 1
+        min_streak = 2 if suspicious else 1
+        quarantine = sorted(u for u, n in streaks.items() if n >= min_streak)
+        expired = sorted(u for u, n in streaks.items() if n >= QUARANTINE_FETCHES)
+
+    if suspicious:
+        log(f"⚠️ Пропало с parent {len(missing)} из {local_count}: отключение после 2-го "
+            f"подтверждения подряд, удаление — после {QUARANTINE_FETCHES}")
+    if quarantine:
+        log(f"🔒 Карантин: {len(quarantine)} отсутствуют на parent, к удалению готовы {len(expired)}")
+    return quarantine, expired[:QUARANTINE_DELETE_BATCH]
+
+
+# ============================================================================
+# ОЧЕРЕДЬ ПОБОЧНЫХ ЭФФЕКТОВ USERS-ЦИКЛА
+# ============================================================================
+
+OPERATION_CLASSES = ('activate', 'deactivate', 'delete', 'update', 'sweep')
+CRITICAL_OPERATIONS = frozenset({'activate', 'deactivate'})
+OPERATIONS_STATE = 'operations'
+
+
+class OperationQueue:
+    """
+    Операции одного users-цикла по классам OPERATION_CLASSES: классы выполняются
+    строго по приоритету, внутри класса — в порядке добавления.
+
+    Операция — func(deadline) → False при неудаче. У некритичного класса дедлайн —
+    min(дедлайн конвейера, начало класса + OPS_BUDGET_<КЛАСС>); операции после
+    дедлайна откладываются. Исключение операции откладывает остальные операции
+    класса, кроме добавленных с always=True (например, Xray для уже записанного).
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.ops = {name: [] for name in OPERATION_CLASSES}
+        self.stats = {}
+
+    def add(self, op_class, label, func, size=1, always=False):
+        """size — сколько пользователей покрывает операция (для статистики)."""
+        self.ops[op_class].append((label, func, size, always))
+
+    def _class_deadline(self, op_class, started):
+        budget = globals()[f'OPS_BUDGET_{op_class.upper()}']
+        if op_class in CRITICAL_OPERATIONS:
+            return None, budget
+        if budget and (self.deadline is None or started + budget < self.deadline):
+            return started + budget, budget
+        return self.deadline, budget
+
+    def run(self):
+        """Выполняет очередь. Returns: False, если хотя бы одна операция не удалась."""
+        ok = True
+        for op_class in OPERATION_CLASSES:
+            ops = self.ops[op_class]
+            if not ops:
+                continue
+            started = time.monotonic()
+            deadline, budget = self._class_deadline(op_class, started)
+            done = deferred = 0
+            failed = False
+            for label, func, size, always in ops:
+                if not always and (failed or deadline_passed(deadline)):
+                    deferred += size
+                    continue
+                try:
+                    if func(deadline) is False:
+                        ok = False
+                except Exception as e:
+                    log(f"❌ Ошибка операции {op_class}/{label}: {e} "
+                        f"(остальные операции класса — в следующем цикле)")
+                    traceback.print_exc()
+                    ok = False
+                    failed = True
+                    deferred += size
+                    continue
+                done += size
+            elapsed = time.monotonic() - started
+            self.stats[op_class] = {'done': done, 'deferred': deferred, 'ms': round(elapsed * 1000, 1)}
+            if deferred:
+                log(f"⏱ {op_class}: выполнено {done}, отложено {deferred} до следующего цикла")
+                note_deferred(op_class, deferred)
+            elif op_class in CRITICAL_OPERATIONS and budget and elapsed > budget:
+                log(f"⚠️ {op_class}: {elapsed:.1f}с при бюджете {budget}с")
+        return ok
+
+    def merge(self, stats):
+        """Добавляет статистику очереди другого процесса (шарда) к классам этой."""
+        for op_class, shard_stats in stats.items():
+            own = self.stats.setdefault(op_class, {'done': 0, 'deferred': 0, 'ms': 0})
+            own['done'] += shard_stats['done']
+            own['deferred'] += shard_stats['deferred']
+            note_deferred(op_class, shard_stats['deferred'])
+
+    def save(self, **extra):
+        """Статистика цикла по классам (и extra, например шарды) для /status."""
+        save_state(OPERATIONS_STATE, {'at': int(time.time()), 'classes': self.stats, **extra})
+
+
+class RateLimiter:
+    """Потокобезопасный ограничитель частоты: не чаще rate операций в секунду."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+def _delete_user_via_api(uuid, deadline=None):
+    """DELETE одного пользователя через локальный admin-API child."""
+    try:
+        response = get_http_session().delete(
+            f"{CHILD_URL}/api/v2/admin/user/{uuid}/",
+            # Без явного Host: локальный admin-API (127.0.0.1:9000) принимает
+            # дефолтный Host запроса — механизм не привязан к конкретному домену.
+            timeout=request_timeout(deadline, 30)
+        )
+        if response.status_code in (200, 204, 404):
+            # 404: уже удалён (например, прерванным ранее запуском) — цель достигнута
+            return True
+        log(f"  ⚠️ Не удалён {uuid[:8]}…: HTTP {response.status_code}")
+    except Exception as e:
+        log(f"  ⚠️ Ошибка удаления {uuid[:8]}…: {e}")
+    return False
+
+
+def _delete_users_direct(uuids, deadline=None):
+    """
+    Быстрый путь: удаление из работающего Xray по gRPC, затем пачка одной
+    SQL-транзакцией (тот же каскад, что делает Hiddify: user_detail → user).
+    Из БД удаляются только подтверждённые helper'ом: без записи в БД оставшегося
+    в Xray клиента уже никто не уберёт.
+
+    Returns:
+        list: UUID, удалённые из БД (Xray недоступен или ошибка SQL — пусто, пачка
+        уйдёт через API; не подтверждённые Xray остаются в очереди)
+    """
+    removed = _xray_helper_done('/opt/hiddify-manager/deactivate_users_direct.py', uuids,
+                                'удаление', deadline)
+    if not removed:
+        log("  ⚠️ Удаление пачки из Xray не подтверждено, fallback на admin-API")
+        return []
+    try:
+        placeholders = ', '.join(['%s'] * len(removed))
+        with get_db().step('delete_direct') as conn, conn.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM user_detail WHERE user_id IN "
+                f"(SELECT id FROM user WHERE uuid IN ({placeholders}))", removed)
+            cursor.execute(f"DELETE FROM user WHERE uuid IN ({placeholders})", removed)
+    except Exception as e:
+        log(f"  ⚠️ Прямое удаление пачки не удалось ({e}), fallback на admin-API")
+        return []
+    return removed
+
+
+def _delete_missing_users(missing_uuids, present_uuids, deadline=None):
+    """Удаляет юзеров, отсутствующих на parent (очередь с checkpoint в STATE_DIR).
+    Через ЛОКАЛЬНЫЙ admin-API child Hiddify сам делает каскад БД (user_detail) + удаление из
+    работающего Xray (gRPC RemoveUser); DELETE_METHOD='direct' — то же пачками без Flask.
+    Раньше таких БЛОКИРОВАЛИ (enable=0) -> они висели на child и попадали в агрегацию подписки.
+
+    Очередь переживает прерывание (дедлайн, рестарт): недоудалённые продолжаются в следующем
+    цикле. Вернувшиеся на parent (present_uuids) из очереди исключаются.
+    """
+    with update_state(DELETE_QUEUE, []) as queue:
+        queued = [u for u in queue if u not in present_uuids]
+        seen = set(queued)
+        queued += [u for u in missing_uuids if u not in seen]
+        queue[:] = queued
+    if not queued:
+        return 0
+    log(f"🗑️  Очередь удаления: {len(queued)} (метод {DELETE_METHOD})")
+
+    done = []
+
+    def checkpoint():
+        with update_state(DELETE_QUEUE, []) as queue:
+            removed = set(done)
+            queue[:] = [u for u in queue if u not in removed]
+
+    remaining = list(queued)
+    if DELETE_METHOD == 'direct':
+        while remaining and not deadline_passed(deadline):
+            batch, remaining = remaining[:DELETE_BATCH_SIZE], remaining[DELETE_BATCH_SIZE:]
+            deleted = _delete_users_direct(batch, deadline)
+            if not deleted:
+                remaining = batch + remaining
+                break
+            done.extend(deleted)
+            checkpoint()
+
+    limiter = RateLimiter(DELETE_RATE_PER_SEC)
+
+    def delete_one(uuid):
+        # Дедлайн проверяется и в потоке: задачи, ждавшие в пуле и лимитере, не
+        # выходят за бюджет, а остаются в очереди до следующего цикла
+        if deadline_passed(deadline):
+            return uuid, False
+        limiter.wait()
+        if deadline_passed(deadline):
+            return uuid, False
+        return uuid, _delete_user_via_api(uuid, deadline)
+
+    if remaining:
+        with ThreadPoolExecutor(max_workers=max(1, DELETE_CONCURRENCY)) as pool:
+            futures = []
+            for uuid in remaining:
+                if deadline_passed(deadline):
+                    break
+                futures.append(pool.submit(delete_one, uuid))
+            for i, future in enumerate(as_completed(futures), 1):
+                uuid, ok = future.result()
+                if ok:
+                    done.append(uuid)
+                    log(f"🗑️  Удалён отсутствующий на parent: {uuid[:8]}…")
+                if i % 50 == 0:
+                    checkpoint()
+
+    checkpoint()
+    left = len(queued) - len(done)
+    if left:
+        log(f"⏱ Удаление: {left} осталось в очереди — продолжится в следующем цикле")
+        note_deferred('delete', left)
+    return len(done)
+
+
+def _run_xray_helper(script_path, uuids, label, deadline=None, args=(), run_empty=False):
+    """
+    Запускает helper активации/деактивации Xray (subprocess; venv-питон в shebang скрипта).
+    Идемпотентные операции над работающим Xray по gRPC. uuids — список UUID,
+    args — опции helper'а перед списком; run_empty — запускать и без UUID.
+    Возвращает True, только если helper обработал все UUID.
+    """
+    done = _xray_helper_done(script_path, uuids, label, deadline, args, run_empty)
+    return len(done) == len(uuids) if done is not None else False
+
+
+def _xray_helper_done(script_path, uuids, label, deadline=None, args=(), run_empty=False):
+    """
+    Как _run_xray_helper, но возвращает список UUID, обработку которых helper
+    подтвердил (при частичном успехе — xray_direct.EXIT_PARTIAL — все, кроме
+    перечисленных им как необработанные), или None — helper не отработал.
+    """
+    if not uuids and not run_empty:
+        return []
+    try:
+        import subprocess
+        result = subprocess.run(
+            [script_path, *args] + list(uuids),
+            capture_output=True, text=True, timeout=request_timeout(deadline, 120)
+        )
+        summary = (result.stdout.strip().splitlines() or [''])[-1]
+        if result.returncode == 0:
+            log(f"✅ Xray {label}: {summary}")
+            return list(uuids)
+        if result.returncode == xray_direct.EXIT_PARTIAL:
+            failed = xray_direct.parse_failed(result.stdout)
+            log(f"⚠️ Xray {label}: {summary} — не обработаны: {len(failed)}")
+            return [u for u in uuids if u not in failed]
+        log(f"⚠️ Ошибка {label} в Xray: {(result.stderr or summary)[:200]}")
+    except Exception as e:
+        log(f"⚠️ Сбой {label} в Xray: {e}")
+    return None
+
+
+XRAY_STATE = 'xray_state'
+XRAY_SWEEP = 'xray_sweep'
+
+
+def check_xray_restart():
+    """
+    Перезапуск Xray сбрасывает всех клиентов, добавленных через API (активации
+    stable_sync и webhook), — до реконсиляции Hiddify они не могут подключиться.
+    Время запуска Xray (по /proc, без gRPC) сравнивается с сохранённым; после
+    перезапуска все включённые пользователи возвращаются параллельно
+    (activate_new_users_direct.py --reprovision). Метрика восстановления
+    (от запуска Xray до возврата пользователей) — в STATE_DIR/xray_state.json и /health.
+    """
+    started_at = xray_direct.xray_started_at()
+    if started_at is None:
+        return
+    state = load_state(XRAY_STATE, {})
+    known = state.get('started_at')
+    if known is None or xray_direct.same_process(started_at, known):
+        if known is None:
+            # Первое наблюдение: Xray мог быть запущен до установки — только запоминаем
+            save_state(XRAY_STATE, dict(state, started_at=started_at))
+        return
+
+    detected_at = time.time()
+    log(f"🔄 Xray перезапущен {int(detected_at - started_at)}с назад — "
+        f"возврат активных пользователей")
+    if not _run_xray_helper('/opt/hiddify-manager/activate_new_users_direct.py', [],
+                            'восстановление после перезапуска', args=('--reprovision',),
+                            run_empty=True):
+        # started_at не обновляется: следующий цикл повторит восстановление
+        return
+    # --reprovision вернул всех enable=1, в том числе локально ограниченных —
+    # конвейер enforce уберёт их заново
+    clear_state(ENFORCED)
+    recovered_at = time.time()
+    state.update(started_at=started_at, last_restart={
+        'started_at': int(started_at),
+        'detected_at': int(detected_at),
+        'recovered_at': int(recovered_at),
+        'recovery_seconds': round(recovered_at - started_at, 1),
+        'reprovision_seconds': round(recovered_at - detected_at, 1),
+    }, restarts=state.get('restarts', 0) + 1)
+    save_state(XRAY_STATE, state)
+    log(f"✅ Xray восстановлен через {recovered_at - started_at:.1f}с после перезапуска")
 
 
 # ============================================================================
-# ГЛАВНАЯ ФУНКЦИЯ
-# ============================================================================
+# ЛОКАЛЬНОЕ ОГРАНИЧЕНИЕ КВОТЫ И СРОКА (МЕЖДУ ЦИКЛАМИ)
+#
+# Parent выставляет is_active=False только после того, как получит трафик child
+# (traffic-конвейер) и отдаст новый список (users-конвейер) — до этого child
+# продолжает обслуживать превысившего квоту. Конвейер enforce каждые
+# ENFORCE_SYNC_INTERVAL секунд считает по снимку parent и локальному current_usage
+# (ещё не отправленная дельта) и убирает нарушителей из Xray. БД не меняется:
+# источник истины — parent; users-конвейер по свежему списку либо подтверждает
+# ограничение (is_active=False), либо возвращает пользователя (лимит продлён).
+# ============================================================================
+
+ENFORCED = 'enforced'
+
+# Кандидаты из снимка parent (пересчитываются при смене снимка или дня)
+_enforce_candidates = {'key': None, 'expired': {}, 'near': {}}
 
-def main():
+
+def _parse_date(value):
+    """Дата из поля start_date parent ('YYYY-MM-DD' или с временем) или None."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _quota_state(parent_user, today):
     """
-    Главная функция накопительной синхронизации v4.3.
+    Состояние пользователя по данным parent: ('expired', None), ('quota', остаток
+    байт до лимита) или None — пользователь не близок к ограничению / уже неактивен.
+    """
+    if not parent_user.get('is_active', parent_user.get('enable')):
+        return None
+    start = _parse_date(parent_user.get('start_date'))
+    package_days = parent_user.get('package_days') or 0
+    if start and package_days and (today - start).days > package_days:
+        return 'expired', None
+    limit_gb = parent_user.get('usage_limit_GB') or 0
+    if limit_gb <= 0:
+        return None
+    remaining_gb = limit_gb - (parent_user.get('current_usage_GB') or 0)
+    if remaining_gb < ENFORCE_HEADROOM_GB:
+        return 'quota', int(remaining_gb * 1024**3)
+    return None
+
+
+def _cached_parent_users():
+    """Снимок parent из памяти или с диска без обращения к parent: (users, fetched_at)."""
+    with _parent_snapshot_lock:
+        users, fetched_at = _parent_snapshot['users'], _parent_snapshot['fetched_at']
+    if users is None:
+        users, fetched_at = load_parent_snapshot()
+    return users, fetched_at
 
-    Последовательность операций:
-      1. Получаем список пользователей с parent (один GET-запрос)
-      2. Собираем локальную дельту трафика
-      3. Отправляем дельту на parent (накопительно)
-      4. Сбрасываем локальный трафик в 0
-      5. Синхронизируем last_online (двунаправленно)
-      6. Синхронизируем пользователей (parent → child)
+
+def _enforcement_candidates():
     """
-    log("=== ⚙ Starting Stable Accumulative Sync v4.3 ===")
+    ({uuid: name} истёкших, {uuid: (name, остаток байт)} близких к квоте) по снимку.
+    Обход снимка — только при его смене или смене дня.
+    """
+    users, fetched_at = _cached_parent_users()
+    if users is None or time.time() - fetched_at > PARENT_SNAPSHOT_FALLBACK_MAX_AGE:
+        return None
+    today = date.today()
+    key = (fetched_at, today, ENFORCE_HEADROOM_GB)
+    if _enforce_candidates['key'] != key:
+        expired, near = {}, {}
+        for user in users:
+            state = _quota_state(user, today)
+            if state is None:
+                continue
+            if state[0] == 'expired':
+                expired[user['uuid']] = user['name']
+            else:
+                near[user['uuid']] = (user['name'], state[1])
+        _enforce_candidates.update(key=key, expired=expired, near=near)
+    return _enforce_candidates['expired'], _enforce_candidates['near']
+
+
+def _local_usage(uuids, step):
+    """Локальный (ещё не отправленный) current_usage: {uuid: байт}, запрос по индексу uuid."""
+    usage = {}
+    uuids = list(uuids)
+    with get_db().step(step) as conn, conn.cursor() as cursor:
+        for i in range(0, len(uuids), SYNC_CHUNK_SIZE):
+            chunk = uuids[i:i + SYNC_CHUNK_SIZE]
+            cursor.execute(
+                f"SELECT uuid, current_usage FROM user "
+                f"WHERE uuid IN ({', '.join(['%s'] * len(chunk))}) AND enable = 1",
+                chunk
+            )
+            usage.update((uuid, current or 0) for uuid, current in cursor.fetchall())
+    return usage
+
+
+def run_enforce_pipeline(deadline=None):
+    """
+    Убирает из Xray пользователей, превысивших квоту (parent + локальная дельта)
+    или с истёкшим пакетом. Уже ограниченные (STATE_DIR/enforced.json) повторно не
+    трогаются; helper запускается, только если есть новые нарушители.
+    """
+    holder = read_run_lock('traffic')
+    if holder and not holder['stale']:
+        # Между PATCH на parent и локальным сбросом дельта учтена дважды
+        return True
+
+    candidates = _enforcement_candidates()
+    if candidates is None:
+        return True
+    expired, near = candidates
+    enforced = load_state(ENFORCED, {})
+
+    violators = {uuid: (name, 'expired') for uuid, name in expired.items() if uuid not in enforced}
+    pending = [uuid for uuid in near if uuid not in enforced]
+    if pending:
+        usage = _local_usage(pending, 'enforce_read')
+        for uuid, current in usage.items():
+            name, remaining = near[uuid]
+            if current >= remaining:
+                violators[uuid] = (name, 'quota')
+    if not violators:
+        return True
+
+    for uuid, (name, reason) in violators.items():
+        log(f"⛔ {name}: {'пакет истёк' if reason == 'expired' else 'квота исчерпана'} — "
+            f"отключение в Xray до подтверждения parent")
+    # Учитываются только подтверждённые helper'ом: остальные остаются нарушителями
+    # и повторяются в следующем цикле
+    done = _xray_helper_done('/opt/hiddify-manager/deactivate_users_direct.py', list(violators),
+                             'ограничение', deadline)
+    if not done:
+        return False
+    now = int(time.time())
+    with update_state(ENFORCED, {}) as state:
+        for uuid in done:
+            name, reason = violators[uuid]
+            state[uuid] = {'name': name, 'reason': reason, 'at': now}
+    return len(done) == len(violators)
+
+
+def reconcile_enforced(parent_users, inactive_uuids):
+    """
+    Сверка локально ограниченных со свежим списком parent (users-конвейер).
+
+    Неактивные на parent и пропавшие из списка снимаются с учёта (их ведёт обычная
+    синхронизация); всё ещё нарушающие остаются ограниченными; остальные
+    (квота/срок продлены) возвращаются.
 
+    Returns:
+        tuple: (UUID для возврата в Xray, UUID, которые остаются ограниченными)
+    """
+    enforced = load_state(ENFORCED, {})
+    if not enforced:
+        return [], set()
+    inactive = set(inactive_uuids)
+    fresh = {u['uuid']: u for u in parent_users if u['uuid'] in enforced}
+    today = date.today()
+    release, keep = [], {}
+    near = {}
+    for uuid, record in enforced.items():
+        user = fresh.get(uuid)
+        if user is None or uuid in inactive:
+            continue
+        state = _quota_state(user, today)
+        if state is None:
+            release.append(uuid)
+        elif state[0] == 'expired':
+            keep[uuid] = record
+        else:
+            near[uuid] = state[1]
+    if near:
+        usage = _local_usage(near, 'enforce_reconcile')
+        for uuid, remaining in near.items():
+            if usage.get(uuid, 0) >= remaining:
+                keep[uuid] = enforced[uuid]
+            else:
+                release.append(uuid)
+
+    save_state(ENFORCED, keep)
+    if release:
+        log(f"↩️ Локальное ограничение снято по данным parent: {len(release)} пользователей")
+    return release, set(keep)
+
+
+# ============================================================================
+# СИНХРОНИЗАЦИЯ ПОЛЬЗОВАТЕЛЕЙ (PARENT → CHILD)
+#
+# Parent — единственный источник истины для:
+#   - Списка пользователей (создание/блокировка)
+#   - Лимитов, пакетов, статусов, ключей
+#
+# Child управляет локально:
+#   - current_usage (сбрасывается после отправки на parent)
+#   - last_online (синхронизируется отдельно в sync_last_online)
+# ============================================================================
+
+def _apply_parent_users_chunk(cursor, chunk, local_enable):
+    """
+    Запись одного чанка пользователей parent (INSERT новых / UPDATE существующих)
+    в текущей транзакции. local_enable — {uuid: enable} локальной БД, прочитанный
+    заранее одним запросом (без SELECT на каждого пользователя).
+
+    Returns:
+        dict: счётчики чанка и UUID для Xray (activate / inactive)
+    """
+    stats = {'synced': 0, 'created': 0, 'blocked': 0, 'unblocked': 0,
+             'activate': [], 'inactive': []}
+    for parent_user in chunk:
+        uuid = parent_user['uuid']
+
+        # is_active = ground-truth parent: enable И не истёк срок И не превышена квота.
+        # Именно он (а НЕ голый enable) определяет, должен ли юзер быть подключаем на child:
+        # при исчерпании трафика/дней parent оставляет enable=1, но is_active=False.
+        is_active = bool(parent_user.get('is_active', parent_user['enable']))
+        desired_enable = 1 if is_active else 0
+        if not is_active:
+            stats['inactive'].append(uuid)
+
+        existing_enable = local_enable.get(uuid)
+
+        if existing_enable is None:
+            # Создаём нового пользователя с пустыми username/password
+            # (Hiddify использует UUID-авторизацию, НЕ генерируйте password!)
+            cursor.execute("""
+                INSERT INTO user (
+                    uuid, name, usage_limit, package_days, mode, enable,
+                    comment, start_date, last_reset_time, current_usage,
+                    telegram_id, ed25519_private_key, ed25519_public_key,
+                    wg_pk, wg_psk, wg_pub, added_by, last_online, max_ips,
+                    username, password
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 0, %s, %s, %s, %s, %s, %s, %s, NOW(), 2, '', '')
+            """, (
+                uuid, parent_user['name'], int(parent_user['usage_limit_GB'] * 1024**3),
+                parent_user['package_days'], parent_user['mode'], desired_enable,
+                parent_user.get('comment', ''), parent_user.get('start_date'),
+                parent_user.get('last_reset_time'), parent_user.get('telegram_id'),
+                parent_user.get('ed25519_private_key', ''), parent_user.get('ed25519_public_key', ''),
+                parent_user.get('wg_pk', ''), parent_user.get('wg_psk', ''),
+                parent_user.get('wg_pub', ''), 1
+            ))
+            stats['created'] += 1
+            if is_active:
+                stats['activate'].append(uuid)   # сразу подключаем в Xray
+            log(f"➕ Создан новый пользователь: {parent_user['name']}")
+        else:
+            # Обновляем все поля кроме current_usage и last_online
+            cursor.execute("""
+                UPDATE user SET
+                    name = %s, usage_limit = %s, package_days = %s,
+                    mode = %s, enable = %s, comment = %s, start_date = %s,
+                    last_reset_time = %s, telegram_id = %s,
+                    ed25519_private_key = %s, ed25519_public_key = %s,
+                    wg_pk = %s, wg_psk = %s, wg_pub = %s, added_by = %s
+                WHERE uuid = %s
+            """, (
+                parent_user['name'], int(parent_user['usage_limit_GB'] * 1024**3), parent_user['package_days'],
+                parent_user['mode'], desired_enable, parent_user.get('comment', ''),
+                parent_user.get('start_date'), parent_user.get('last_reset_time'),
+                parent_user.get('telegram_id'),
+                parent_user.get('ed25519_private_key', ''), parent_user.get('ed25519_public_key', ''),
+                parent_user.get('wg_pk', ''), parent_user.get('wg_psk', ''),
+                parent_user.get('wg_pub', ''), 1,
+                uuid
+            ))
+
+            if existing_enable != desired_enable:
+                if desired_enable:
+                    stats['unblocked'] += 1
+                    stats['activate'].append(uuid)   # 0→1: вернуть в Xray
+                    log(f"✅ Разблокирован: {parent_user['name']}")
+                else:
+                    stats['blocked'] += 1
+                    log(f"🚫 Заблокирован: {parent_user['name']}")
+                    # удаление из Xray — через stats['inactive'] (он уже там)
+
+        stats['synced'] += 1
+    return stats
+
+
+def _row_lock_status(cursor):
+    """Глобальные счётчики ожиданий блокировок строк InnoDB (все сессии, в т.ч. панель и Celery)."""
     try:
-        # Шаг 1: Получаем пользователей с parent (один раз для всех шагов)
-        log("Step 1: Получаем список пользователей с parent...")
-        parent_users = fetch_parent_users()
+        cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN "
+                       "('Innodb_row_lock_waits', 'Innodb_row_lock_time')")
+        return {row['Variable_name']: int(row['Value']) for row in cursor.fetchall()}
+    except Exception:
+        return {}
+
+
+def _new_write_result():
+    """Аккумулятор записи пользователей: счётчики, UUID для Xray, длительности чанков."""
+    return {'totals': {'synced': 0, 'created': 0, 'blocked': 0, 'unblocked': 0},
+            'activate': [], 'inactive': [], 'chunk_ms': []}
+
+
+def _merge_write_result(result, other):
+    for key in result['totals']:
+        result['totals'][key] += other['totals'][key]
+    for key in ('activate', 'inactive', 'chunk_ms'):
+        result[key].extend(other[key])
+
+
+def _queue_user_writes(queue, op_class, users, local_enable, result,
+                       still_enforced=frozenset(), released=(), xray=True):
+    """
+    Ставит в очередь запись users чанками по SYNC_CHUNK_SIZE (класс op_class) и,
+    если xray, доведение записанного до Xray: activate — добавление (кроме локально
+    ограниченных, плюс released), deactivate — удаление ставших неактивными.
+    Результаты копятся в result (_new_write_result) по мере выполнения очереди.
+    """
+    def write_chunk(chunk):
+        def op(op_deadline):
+            started = time.perf_counter()
+            with get_db().step('users_sync') as conn, conn.cursor() as cursor:
+                stats = _apply_parent_users_chunk(cursor, chunk, local_enable)
+            result['chunk_ms'].append((time.perf_counter() - started) * 1000)
+            for key in result['totals']:
+                result['totals'][key] += stats[key]
+            result['activate'].extend(stats['activate'])
+            if op_class == 'deactivate':
+                result['inactive'].extend(stats['inactive'])
+        return op
+
+    for i in range(0, len(users), SYNC_CHUNK_SIZE):
+        chunk = users[i:i + SYNC_CHUNK_SIZE]
+        queue.add(op_class, f'запись {i}–{i + len(chunk)}', write_chunk(chunk), len(chunk))
+
+    if not xray:
+        return
+    if op_class == 'activate':
+        # Мгновенная активация в Xray новых и разблокированных (is_active=True) — всегда,
+        # даже после ошибки записи: переход не повторится в следующем цикле.
+        # --enabled: enable=1 уже закоммичен выше, helper не подключается к БД.
+        queue.add('activate', 'Xray', lambda _: _run_xray_helper(
+            '/opt/hiddify-manager/activate_new_users_direct.py',
+            [u for u in result['activate'] if u not in still_enforced] + list(released),
+            'активация', args=('--enabled',)), size=0, always=True)
+    elif op_class == 'deactivate':
+        queue.add('deactivate', 'Xray', lambda op_deadline: _run_xray_helper(
+            '/opt/hiddify-manager/deactivate_users_direct.py', result['inactive'],
+            'деактивация', op_deadline), size=0, always=True)
+
+
+# ============================================================================
+# ШАРДИРОВАННАЯ СИНХРОНИЗАЦИЯ ПОЛЬЗОВАТЕЛЕЙ
+#
+# На десятках тысяч пользователей запись (формирование и отправка UPDATE на
+# каждого) и helper'ы Xray упираются в один поток Python. Пространство UUID
+# делится на шарды по crc32 (стабильно между процессами и циклами), каждый шард
+# обрабатывает свой процесс пула: пишет свои чанки своим соединением с MySQL и
+# сам запускает helper'ы Xray для своих UUID. Классы операций идут в том же
+# порядке, что и в одном процессе (активация → деактивация → удаление →
+# обновление → сверка), поэтому итоговое состояние БД и Xray совпадает.
+#
+# Процессы — forkserver: чистый интерпретатор без унаследованных соединений,
+# блокировок и потоков daemon. Дедлайны — time.monotonic (на Linux общий для
+# всех процессов), поэтому передаются шардам как есть.
+# ============================================================================
+
+# Способ запуска процессов-шардов (тесты используют 'fork', чтобы шарды унаследовали
+# подменённые БД и helper'ы Xray)
+_SHARD_START_METHOD = 'forkserver'
+
+
+def sync_shard_count(user_count):
+    """Число шардов для списка из user_count пользователей (1 — без шардирования)."""
+    shards = SYNC_SHARDS or os.cpu_count() or 1
+    if shards < 2 or user_count < SYNC_SHARD_MIN_USERS:
+        return 1
+    return shards
+
+
+def shard_of(uuid, shards):
+    return zlib.crc32(uuid.encode()) % shards
+
+
+def _shard_worker_init():
+    """
+    Процесс-шард: конфигурация перечитывается (forkserver мог запуститься до
+    SIGHUP), метрики шагов MySQL возвращаются родителю, а не пишутся в файл.
+    """
+    global _db_pool
+    reload_config(quiet=True)
+    _db_pool = sync_db.DatabasePool(lambda: DB_CONFIG, 1)
+
+
+def _sync_shard(task):
+    """
+    Один класс операций одного шарда (выполняется в процессе пула).
+
+    Returns:
+        dict: результат записи, статистика очереди, метрики MySQL и ошибка (или None)
+    """
+    global _log_prefix
+    op_class, shard, users, local_enable, still_enforced, released, deadline = task
+    _log_prefix = f"[шард {shard}] "
+    result = _new_write_result()
+    queue = OperationQueue(deadline)
+    error = None
+    try:
+        _queue_user_writes(queue, op_class, users, local_enable, result, still_enforced, released)
+        if not queue.run():
+            error = f"{op_class}: операция не выполнена (см. лог шарда)"
+    except Exception as e:
+        error = f"{op_class}: {e}"
+        traceback.print_exc()
+    return {'shard': shard, 'result': result, 'stats': queue.stats,
+            'metrics': get_db().take_metrics(), 'error': error}
+
+
+class ShardedSync:
+    """
+    Пул процессов-шардов одного users-цикла. op(op_class, users) — операция для
+    OperationQueue родителя: делит users по шардам, выполняет класс во всех шардах
+    параллельно и сводит счётчики, статистику очереди, метрики MySQL и ошибки.
+    """
+
+    def __init__(self, shards, local_enable, still_enforced, released):
+        self.shards = shards
+        self.local_enable = local_enable
+        self.still_enforced = still_enforced
+        self.released = released
+        self.result = _new_write_result()
+        self.stats = {}
+        self.errors = {}
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.get_context(_SHARD_START_METHOD).Pool(
+                self.shards, initializer=_shard_worker_init)
+        return self._pool
+
+    def _tasks(self, op_class, users, deadline):
+        parts = [[] for _ in range(self.shards)]
+        for user in users:
+            parts[shard_of(user['uuid'], self.shards)].append(user)
+        released = [[] for _ in range(self.shards)]
+        if op_class == 'activate':
+            for uuid in self.released:
+                released[shard_of(uuid, self.shards)].append(uuid)
+        tasks = []
+        for shard, part in enumerate(parts):
+            if not part and not released[shard]:
+                continue
+            uuids = [u['uuid'] for u in part]
+            tasks.append((op_class, shard, part,
+                          {uuid: self.local_enable[uuid] for uuid in uuids if uuid in self.local_enable},
+                          {uuid for uuid in uuids if uuid in self.still_enforced},
+                          released[shard], deadline))
+        return tasks
+
+    def op(self, op_class, users):
+        def run(op_deadline):
+            import multiprocessing
+            tasks = self._tasks(op_class, users, op_deadline)
+            if not tasks:
+                return True
+            ok = True
+            waiting = {task[1] for task in tasks}
+            until = (op_deadline + SYNC_SHARD_GRACE if op_deadline is not None
+                     else time.monotonic() + SYNC_SHARD_TIMEOUT)
+            results = self._get_pool().imap_unordered(_sync_shard, tasks)
+            while waiting:
+                try:
+                    shard_result = results.next(timeout=max(0.0, until - time.monotonic()))
+                except Exception as e:
+                    # Зависший шард (TimeoutError) или исключение вне очереди шарда
+                    reason = 'нет ответа' if isinstance(e, multiprocessing.TimeoutError) else str(e)
+                    log(f"❌ Шарды {sorted(waiting)} ({op_class}): {reason} — пул остановлен")
+                    for shard in waiting:
+                        self.errors.setdefault(str(shard), []).append(f"{op_class}: {reason}")
+                    self.terminate()
+                    return False
+                waiting.discard(shard_result['shard'])
+                _merge_write_result(self.result, shard_result['result'])
+                get_db().merge_metrics(shard_result['metrics'])
+                for name, stats in shard_result['stats'].items():
+                    own = self.stats.setdefault(name, {'done': 0, 'deferred': 0})
+                    own['done'] += stats['done']
+                    own['deferred'] += stats['deferred']
+                if shard_result['error']:
+                    self.errors.setdefault(str(shard_result['shard']), []).append(shard_result['error'])
+                    ok = False
+            return ok
+        return run
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        """Остановка пула с зависшим шардом; следующий класс запустит новый."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+def sync_users_from_parent(parent_users, deadline=None, full=True, requested_at=None):
+    """
+    Полная синхронизация пользователей с parent панели.
+
+    Создаёт новых, обновляет существующих; отсутствующих на parent отправляет в карантин
+    (отключение + удаление из Xray) и УДАЛЯЕТ после QUARANTINE_FETCHES полных циклов подряд.
+    Состояние child-enable и членство в работающем Xray определяются по parent.is_active
+    (ground-truth: учитывает блокировку, исчерпание трафика и истечение срока):
+      - is_active=True  → enable=1, юзер ДОБАВЛЯЕТСЯ в Xray (activate_new_users_direct.py);
+      - is_active=False → enable=0, юзер УДАЛЯЕТСЯ из Xray (deactivate_users_direct.py),
+        соединение рвётся немедленно, не дожидаясь фоновой реконсиляции Hiddify.
+
+    Запись идёт короткими транзакциями по SYNC_CHUNK_SIZE пользователей: блокировки
+    строк user держатся миллисекунды, а не всю синхронизацию — панель и задачи Celery
+    не ждут её окончания.
+
+    Побочные эффекты — через OperationQueue в порядке приоритета: сначала запись и
+    активация в Xray новых/разблокированных, затем запись и удаление из Xray ставших
+    неактивными, удаление отсидевших карантин, обновление остальных полей и в конце
+    идемпотентная сверка Xray. Ошибка чанка откладывает остальные чанки своего класса
+    до следующего цикла, уже закоммиченные доводятся до Xray.
+
+    При SYNC_SHARDS > 1 и не менее SYNC_SHARD_MIN_USERS пользователей запись и Xray
+    активированных, деактивированных и обновляемых выполняют процессы-шарды
+    (ShardedSync) — результат тот же, что в одном процессе.
+
+    Args:
+        parent_users: Список пользователей с parent (из fetch_parent_users)
+        full: False — точечная синхронизация подмножества (webhook): parent_users
+              не полный список, поэтому отсутствующие в нём локальные НЕ удаляются
+        requested_at: время запроса полного списка (None — неизвестно): записанные
+              webhook'ом после него не считаются отсутствующими на parent
+    """
+    try:
+        parent_uuids = {u['uuid'] for u in parent_users}
+        with get_db().step('users_read') as conn, sync_db.dict_cursor(conn) as cursor:
+            if full:
+                cursor.execute("SELECT uuid, enable FROM user")
+                rows = cursor.fetchall()
+            else:
+                rows = []
+                wanted = list(parent_uuids)
+                for i in range(0, len(wanted), SYNC_CHUNK_SIZE):
+                    chunk = wanted[i:i + SYNC_CHUNK_SIZE]
+                    cursor.execute(
+                        f"SELECT uuid, enable FROM user WHERE uuid IN ({', '.join(['%s'] * len(chunk))})",
+                        chunk
+                    )
+                    rows.extend(cursor.fetchall())
+            lock_before = _row_lock_status(cursor)
+        local_enable = {u['uuid']: u['enable'] for u in rows}
+        local_uuids = set(local_enable)
+
+        # Разбор по классам: переходы состояния (новые, разблокированные, ставшие
+        # неактивными) пишутся и доводятся до Xray первыми, остальные поля — после
+        activating, deactivating, updating = [], [], []
+        inactive_all = set()
+        for parent_user in parent_users:
+            is_active = bool(parent_user.get('is_active', parent_user['enable']))
+            if not is_active:
+                inactive_all.add(parent_user['uuid'])
+            existing = local_enable.get(parent_user['uuid'])
+            if existing is not None and bool(existing) == is_active:
+                updating.append(parent_user)
+            elif is_active:
+                activating.append(parent_user)
+            else:
+                deactivating.append(parent_user)
+
+        # Локально ограниченные (конвейер enforce): по свежему списку parent либо
+        # остаются вне Xray, либо возвращаются (квота/срок продлены)
+        if full:
+            released, still_enforced = reconcile_enforced(parent_users, inactive_all)
+        else:
+            released, still_enforced = [], set()
+
+        result = _new_write_result()
+        queue = OperationQueue(deadline)
+        shards = sync_shard_count(len(parent_users))
+        sharded = None
+        if shards > 1:
+            # Запись и Xray переходов/обновлений — в процессах-шардах; глобальные
+            # шаги (карантин, удаление, сверка) остаются здесь, порядок классов тот же
+            sharded = ShardedSync(shards, local_enable, still_enforced, released)
+            for op_class, users in (('activate', activating), ('deactivate', deactivating),
+                                    ('update', updating)):
+                queue.add(op_class, f'шарды ×{shards}', sharded.op(op_class, users),
+                          size=0, always=True)
+        else:
+            _queue_user_writes(queue, 'activate', activating, local_enable, result,
+                               still_enforced, released)
+            # Ставшие неактивными — в Xray вместе с карантином (ниже), одним helper'ом
+            _queue_user_writes(queue, 'deactivate', deactivating, local_enable, result, xray=False)
+            _queue_user_writes(queue, 'update', updating, local_enable, result)
+        newly_inactive = result['inactive']   # записанные 1→0 и новые неактивные
+
+        # Отсутствующих на parent — карантин: отключаем и убираем из Xray сразу,
+        # УДАЛЯЕМ только после QUARANTINE_FETCHES полных получений подряд.
+        delete_uuids = []
+        quarantine_uuids = []
+        quarantined = []
+        if full and not parent_uuids:
+            # SAFEGUARD: пустой список parent — сбой fetch, а не удаление всех
+            log(f"⚠️ Карантин ПРОПУЩЕН (safeguard): parent вернул пустой список, local={len(local_uuids)}")
+            full = False
+        elif full:
+            missing = local_uuids - parent_uuids
+            if missing:
+                recent = _targeted_since(requested_at) & missing
+                if recent:
+                    log(f"Созданы webhook'ом после запроса списка parent — не в карантин: {len(recent)}")
+                    missing -= recent
+            quarantine_uuids, delete_uuids = _update_quarantine(missing, len(local_uuids))
+            to_disable = [u for u in quarantine_uuids if local_enable.get(u)]
+            for i in range(0, len(to_disable), SYNC_CHUNK_SIZE):
+                chunk = to_disable[i:i + SYNC_CHUNK_SIZE]
+
+                def disable(_, chunk=chunk):
+                    with get_db().step('users_quarantine') as conn, conn.cursor() as cursor:
+                        cursor.execute(
+                            f"UPDATE user SET enable = 0 WHERE uuid IN ({', '.join(['%s'] * len(chunk))})",
+                            chunk
+                        )
+                    quarantined.extend(chunk)
+                queue.add('deactivate', 'карантин', disable, len(chunk))
+
+        # Ставшие неактивными в этом цикле (is_active=False: блокировка/квота/срок,
+        # карантин) — из Xray сразу после записи, до удалений и массовых обновлений
+        queue.add('deactivate', 'Xray', lambda op_deadline: _run_xray_helper(
+            '/opt/hiddify-manager/deactivate_users_direct.py', newly_inactive + quarantined,
+            'деактивация', op_deadline), size=0, always=True)
+
+        # Удаление отсидевших карантин (каскад БД + Xray).
+        # Только в полном режиме: по неполному списку нельзя судить об отсутствии.
+        deleted = []
+        if full and delete_uuids:
+            queue.add('delete', 'карантин', lambda op_deadline: deleted.append(
+                _delete_missing_users(delete_uuids, parent_uuids, op_deadline)), len(delete_uuids))
+
+        # Деактивация в Xray всех неактивных — идемпотентно и КАЖДЫЙ цикл
+        # (самовосстановление), не дожидаясь фоновой реконсиляции Hiddify.
+        # Уже отсутствующие в Xray = no-op; только что убранные не повторяются.
+        def sweep(op_deadline):
+            inactive = sorted(inactive_all | set(quarantine_uuids))
+            digest = hashlib.blake2b('\n'.join(inactive).encode(), digest_size=16).hexdigest()
+            started_at = xray_direct.xray_started_at()
+            swept = load_state(XRAY_SWEEP, {})
+            if (swept.get('digest') == digest
+                    and xray_direct.same_process(started_at, swept.get('started_at'))
+                    and time.time() - swept.get('at', 0) < XRAY_SWEEP_INTERVAL):
+                return True
+            handled = set(newly_inactive) | set(quarantined)
+            if sharded is not None:
+                handled |= set(sharded.result['inactive'])
+            targets = [u for u in inactive if u not in handled]
+            done = _xray_helper_done('/opt/hiddify-manager/deactivate_users_direct.py', targets,
+                                     'деактивация (сверка)', op_deadline)
+            # Кэш — только если каждый UUID подтверждён: иначе сверка повторится в
+            # следующем цикле, а не через XRAY_SWEEP_INTERVAL
+            ok = done is not None and len(done) == len(targets)
+            if ok:
+                save_state(XRAY_SWEEP, {'digest': digest, 'started_at': started_at, 'at': time.time()})
+            return ok
+        queue.add('sweep', 'Xray', sweep, len(inactive_all) + len(quarantine_uuids))
+
+        try:
+            ok = queue.run()
+        finally:
+            if sharded is not None:
+                sharded.close()
+        if sharded is not None:
+            queue.merge(sharded.stats)
+            _merge_write_result(result, sharded.result)
+            queue.save(shards={'count': shards, 'errors': sharded.errors})
+        else:
+            queue.save()
+
+        totals, chunk_ms = result['totals'], result['chunk_ms']
+        log(f"✅ Синхронизация: {totals['synced']} синхр, {totals['created']} создано, "
+            f"{totals['blocked']} заблок, {totals['unblocked']} разблок, {len(quarantined)} в карантин"
+            + (f" (шардов: {shards})" if sharded is not None else ""))
+        if sharded is not None and sharded.errors:
+            log("⚠️ Ошибки в шардах: " + "; ".join(
+                f"{shard}: {', '.join(errors)}" for shard, errors in sorted(sharded.errors.items())))
+        if deleted and deleted[0]:
+            log(f"🗑️  Удалено отсутствующих на parent: {deleted[0]}")
+
+        if chunk_ms:
+            with get_db().step('users_read') as conn, sync_db.dict_cursor(conn) as cursor:
+                lock_after = _row_lock_status(cursor)
+            lock_waits = lock_after.get('Innodb_row_lock_waits', 0) - lock_before.get('Innodb_row_lock_waits', 0)
+            lock_time = lock_after.get('Innodb_row_lock_time', 0) - lock_before.get('Innodb_row_lock_time', 0)
+            get_db().annotate('users_sync', chunks=len(chunk_ms), chunk_size=SYNC_CHUNK_SIZE, shards=shards,
+                              max_chunk_ms=round(max(chunk_ms), 1),
+                              row_lock_waits=lock_waits, row_lock_time_ms=lock_time)
+            log(f"Запись: {len(chunk_ms)} транзакций по ≤{SYNC_CHUNK_SIZE}, самая долгая "
+                f"{max(chunk_ms):.0f}мс; ожиданий блокировок строк InnoDB за запись: "
+                f"{lock_waits} ({lock_time}мс)")
+
+        return ok
+
+    except Exception as e:
+        log(f"❌ Ошибка синхронизации пользователей: {e}")
+        traceback.print_exc()
+        return False
+
+
+def fetch_parent_users_by_uuid(uuids, deadline=None):
+    """
+    Точечно получает пользователей с parent по UUID (GET /api/v2/admin/user/<uuid>/).
+
+    Новый пользователь ещё не в карте владельцев: при нескольких источниках
+    его ищут во всех по очереди (известный владелец — первым).
+
+    Returns:
+        list | None: найденные пользователи; None, если parent недоступен —
+        отсутствующие (404) просто пропускаются, их удалит полный цикл.
+    """
+    sources = get_parent_sources()
+    with _parent_snapshot_lock:
+        owners = _parent_snapshot['owners']
+    found = []
+    for uuid in uuids:
+        owner = owners.get(uuid)
+        for source in sorted(sources, key=lambda src: src['name'] != owner):
+            try:
+                response = parent_request(source, 'GET', f'/api/v2/admin/user/{uuid}/',
+                                          critical=True, deadline=deadline)
+            except Exception as e:
+                log(f"❌ Ошибка запроса пользователя {uuid[:8]}… с parent {source['name']}: {e}")
+                return None
+            if response.status_code == 200:
+                user = response.json()
+                user['_parent'] = source['name']
+                found.append(user)
+                break
+            elif response.status_code != 404:
+                log(f"❌ Ошибка получения пользователя {uuid[:8]}…: HTTP {response.status_code}")
+                return None
+        else:
+            log(f"⚠️  Пользователь {uuid[:8]}… не найден на parent — пропущен")
+    return found
+
+
+# UUID, записанные точечной синхронизацией (webhook): {uuid: время}. Полный цикл по
+# списку parent, запрошенному раньше этого времени, не видит таких пользователей —
+# они не считаются отсутствующими на parent (иначе ушли бы в карантин).
+TARGETED_SYNCED = 'targeted_synced'
+
+
+def _targeted_since(requested_at):
+    """
+    UUID точечной синхронизации, записанные не раньше запроса списка parent
+    (requested_at=None — все). Более старые этим списком уже покрыты и забываются.
+    """
+    if not load_state(TARGETED_SYNCED, {}):
+        return set()
+    with update_state(TARGETED_SYNCED, {}) as synced:
+        if requested_at is not None:
+            for uuid in [u for u, at in synced.items() if at < requested_at]:
+                del synced[uuid]
+        return set(synced)
+
+
+def sync_users_targeted(uuids, deadline=None):
+    """
+    Точечная синхронизация parent → child для перечисленных UUID (push-уведомление).
+    Та же логика sync_users_from_parent (создание/обновление/активация в Xray),
+    но без удаления отсутствующих — это остаётся за полным (polling) циклом.
+    Выполняется под блокировкой users-конвейера (см. webhook в sync_health_api.py).
+    """
+    parent_users = fetch_parent_users_by_uuid(uuids, deadline=deadline)
+    if parent_users is None:
+        return False
+    if not parent_users:
+        log("Точечная синхронизация: на parent не найдено ни одного из пользователей")
+        return True
+    # До записи: пользователь уже есть на parent, поэтому любой список, запрошенный
+    # позже этой отметки, его содержит
+    with update_state(TARGETED_SYNCED, {}) as synced:
+        now = time.time()
+        synced.update((u['uuid'], now) for u in parent_users)
+    log(f"Точечная синхронизация {len(parent_users)} пользователей с parent...")
+    return sync_users_from_parent(parent_users, deadline=deadline, full=False)
+
+
+# ============================================================================
+# КОНВЕЙЕРЫ
+#
+# users   — parent → child (частый: новые пользователи подключаются за секунды)
+# traffic — child → parent (редкий: дельта трафика, сброс, last_online)
+#
+# Конвейеры независимы: медленная отправка трафика не задерживает активацию новых
+# пользователей и наоборот. Общие ресурсы — HTTP-пул (get_http_session) и снимок
+# пользователей parent (get_parent_snapshot).
+# ============================================================================
+
+def run_users_pipeline(deadline=None, parent_users=None):
+    """Конвейер parent → child: получение пользователей и полная синхронизация."""
+    # До обращения к parent: восстановление Xray не зависит от его доступности
+    check_xray_restart()
+
+    if parent_users is None:
+        parent_users = fetch_parent_users(deadline=deadline)
         if parent_users is None:
-            log("❌ Невозможно продолжить без данных с parent")
+            log("❌ users: невозможно продолжить без данных с parent")
             return False
+    with _parent_snapshot_lock:
+        requested_at = (_parent_snapshot['requested_at']
+                        if _parent_snapshot['users'] is parent_users else None)
+
+    if sync_users_from_parent(parent_users, deadline=deadline, requested_at=requested_at):
+        log("✅ Синхронизация пользователей завершена успешно")
+        return True
+    log("❌ Ошибка синхронизации пользователей")
+    return False
+
 
-        # Шаг 2: Собираем локальную статистику
-        log("Step 2: Собираем локальную дельта статистику...")
+def run_traffic_pipeline(deadline=None):
+    """
+    Конвейер child → parent: сбор дельты трафика, накопительная отправка,
+    сброс отправленного и двунаправленная синхронизация last_online.
+    """
+    ok = True
+    budget = PushBudget(TRAFFIC_PUSH_BUDGET)
+    if TRAFFIC_AGGREGATION == 'client':
+        # Сначала неподтверждённая пачка: пока она не учтена, её трафик
+        # ещё числится в current_usage и не должен попасть в новую пачку
+        if flush_pending_aggregator_batch(deadline):
+            usage_deltas = collect_local_usage_delta()
+            if usage_deltas:
+                ok = push_deltas_to_aggregator(usage_deltas, deadline)
+            else:
+                log("Нет дельта статистики для отправки")
+        else:
+            ok = False
+    elif not recover_usage_journal(deadline):
+        # Без сверки журнала новая отправка могла бы повторить уже применённую дельту
+        log("⚠️ Отправка трафика отложена: журнал не сверен с parent")
+        ok = False
+    else:
+        log("Сбор локальной дельта статистики...")
         usage_deltas = collect_local_usage_delta()
         log(f"Собрано дельта статистики для {len(usage_deltas)} пользователей")
+        if TRAFFIC_AGGREGATION == 'aggregator':
+            usage_deltas = merge_with_aggregator_spool(usage_deltas)
 
-        # Шаг 3-4: Отправляем на parent и сбрасываем локально
         if usage_deltas:
-            log("Step 3: Отправляем дельта статистику на parent...")
-            success, updated_count = send_usage_deltas_to_parent(usage_deltas)
-
-            if success:
-                log("Step 4: Сбрасываем локальную статистику в ноль...")
-                if reset_local_usage(usage_deltas):
-                    log(f"✅ Локальная статистика сброшена для {len(usage_deltas)} пользователей")
+            success, pushed = send_usage_deltas_to_parent(usage_deltas, deadline=deadline, budget=budget)
+            ok = finalize_pushed_usage(pushed) and success
         else:
-            log("Step 3: Нет дельта статистики для отправки")
+            log("Нет дельта статистики для отправки")
 
-        # Шаг 5: Двунаправленная синхронизация last_online
-        log("Step 5: Синхронизация last_online (child ↔ parent)...")
-        if sync_last_online(parent_users):
-            log("✅ Синхронизация last_online завершена")
-        else:
-            log("⚠️ Ошибка синхронизации last_online")
+    # last_online не требует свежайшего списка: снимок users-конвейера подходит
+    parent_users = get_parent_snapshot(PARENT_SNAPSHOT_MAX_AGE, deadline=deadline)
+    if parent_users is None:
+        log("⚠️ last_online пропущен: нет данных с parent")
+        return False
+
+    log("Синхронизация last_online (child ↔ parent)...")
+    if sync_last_online(parent_users, deadline=deadline, budget=budget):
+        log("✅ Синхронизация last_online завершена")
+    else:
+        log("⚠️ Ошибка синхронизации last_online")
+        ok = False
+    return ok
+
+
+class Pipeline:
+    """
+    Периодический конвейер для режима --daemon: свой интервал, таймаут и блокировка.
+
+    Запуск не начинается, пока предыдущий не завершился (lock). Таймаут передаётся
+    в функцию конвейера как дедлайн (ограничивает HTTP-таймауты и прерывает обход
+    пользователей); зависший дольше таймаута запуск логируется, а новые тики
+    пропускаются до его завершения.
+    """
+
+    def __init__(self, name, func, interval, timeout):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.next_run = 0.0
+        self.started_at = None
+        self.overrun_logged = False
+
+    def due(self, now):
+        return now >= self.next_run
+
+    def start(self):
+        """Запускает конвейер в отдельном потоке, если он не выполняется."""
+        if not self.lock.acquire(blocking=False):
+            if (self.started_at is not None and not self.overrun_logged
+                    and time.monotonic() - self.started_at > self.timeout):
+                log(f"⚠️ Конвейер {self.name} превысил таймаут {self.timeout}с, тики пропускаются")
+                self.overrun_logged = True
+            return
+        self.started_at = time.monotonic()
+        self.overrun_logged = False
+        self.next_run = self.started_at + self.interval
+        threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def _run(self):
+        try:
+            run_pipeline(self.name, self.func, self.timeout)
+        finally:
+            self.started_at = None
+            self.lock.release()
+
+
+PIPELINE_RUNS = 'pipeline_runs'
+# Длительностей последних проходов на конвейер (перцентили в /node и сводке парка)
+PIPELINE_HISTORY = 50
+
+
+def record_pipeline_run(name, ok, duration, deferred=None):
+    """
+    История проходов конвейера: время последнего и последнего успешного,
+    длительности, отложенное последним проходом до следующего цикла.
+    """
+    try:
+        with update_state(PIPELINE_RUNS, {}) as runs:
+            now = time.time()
+            run = runs.setdefault(name, {})
+            run['last_run'] = now
+            run['ok'] = bool(ok)
+            run['deferred'] = deferred or {}
+            if ok:
+                run['last_ok'] = now
+            run['durations'] = (run.get('durations', []) + [round(duration, 2)])[-PIPELINE_HISTORY:]
+    except OSError:
+        pass
+
+
+def format_deferred(deferred):
+    return ', '.join(f"{kind} {count}" for kind, count in sorted(deferred.items()))
+
+
+def run_pipeline(name, func, timeout, deadline=None, cycle=None, lock=None, busy=True, **kwargs):
+    """
+    Выполняет один проход конвейера под дедлайном и логирует длительность.
+    Дедлайн — started + timeout, но не позже deadline (бюджет цикла); отложенное
+    проходом (note_deferred) пишется в историю и в отчёт цикла cycle (CycleBudget).
+    Если конвейер уже выполняется другим процессом (run_lock) — проход пропускается
+    и возвращается busy. lock — чужая блокировка вместо своей (webhook пишет тех же
+    пользователей, что и users-конвейер, и не должен выполняться одновременно с ним).
+    """
+    lock = lock or name
+    with run_lock(lock) as acquired:
+        if not acquired:
+            holder = read_run_lock(lock) or {}
+            log(f"⏭ Конвейер {name} уже выполняется (pid {holder.get('pid')} на {holder.get('host')}, "
+                f"{holder.get('age_seconds')}с) — пропуск")
+            if holder.get('stale'):
+                log(f"⚠️ Конвейер {lock} выполняется дольше {RUN_LOCK_STALE_AFTER}с — процесс завис?")
+            return busy
+
+        started = time.monotonic()
+        pipeline_deadline = started + timeout if deadline is None else min(started + timeout, deadline)
+        _run_context.deferred = {}
+        try:
+            ok = func(deadline=pipeline_deadline, **kwargs)
+        except Exception as e:
+            log(f"❌ Критическая ошибка конвейера {name}: {e}")
+            traceback.print_exc()
+            ok = False
+        finally:
+            deferred, _run_context.deferred = _run_context.deferred, None
+        duration = time.monotonic() - started
+        log(f"{'✅' if ok else '⚠️'} Конвейер {name} завершён за {duration:.1f}с"
+            + (f", отложено до следующего цикла: {format_deferred(deferred)}" if deferred else ""))
+        record_pipeline_run(name, ok, duration, deferred)
+        if cycle is not None:
+            cycle.record(name, ok, duration, deferred)
+        if _parent_gates:
+            save_parent_health()
+        return ok
+
+
+CYCLE_REPORT = 'cycle'
+
+
+class CycleBudget:
+    """
+    Общий дедлайн однократного запуска (CYCLE_BUDGET). step_deadline(timeout, reserve)
+    — дедлайн шага: не дольше его таймаута и не позже конца цикла минус reserve
+    (время, которое остаётся следующим шагам). Шаги, на которые бюджета не осталось,
+    пропускаются целиком; отложенное шагами сводится в отчёт STATE_DIR/cycle.json.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.started = time.monotonic()
+        self.deadline = self.started + budget if budget else None
+        self.steps = {}
+
+    def step_deadline(self, timeout, reserve=0):
+        deadline = time.monotonic() + timeout
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline - reserve)
+        return deadline
+
+    def exhausted(self, reserve=0):
+        """Бюджета на шаг не осталось (до конца цикла минус reserve — меньше секунды)."""
+        return self.deadline is not None and time.monotonic() >= self.deadline - reserve - 1
+
+    def record(self, step, ok, duration, deferred=None):
+        self.steps[step] = {'ok': bool(ok), 'seconds': round(duration, 1), 'deferred': deferred or {}}
+
+    def skip(self, step):
+        log(f"⏱ Бюджет цикла ({self.budget}с) исчерпан: шаг {step} — в следующем цикле")
+        self.steps[step] = {'ok': None, 'skipped': True, 'deferred': {}}
+
+    def finish(self):
+        """Сохраняет отчёт цикла и логирует отложенное. Returns: отчёт."""
+        elapsed = time.monotonic() - self.started
+        deferred = {}
+        for step in self.steps.values():
+            for kind, count in step['deferred'].items():
+                deferred[kind] = deferred.get(kind, 0) + count
+        report = {
+            'at': int(time.time()),
+            'budget': self.budget,
+            'elapsed': round(elapsed, 1),
+            'overrun': bool(self.budget and elapsed > self.budget),
+            'steps': self.steps,
+            'skipped': [name for name, step in self.steps.items() if step.get('skipped')],
+            'deferred': deferred,
+        }
+        save_state(CYCLE_REPORT, report)
+        if report['skipped'] or deferred:
+            log(f"⏱ Цикл {elapsed:.1f}с из {self.budget or '∞'}с; отложено до следующего цикла: "
+                + ', '.join(filter(None, [format_deferred(deferred),
+                                          ' '.join(f"шаг {name}" for name in report['skipped'])])))
+        if report['overrun']:
+            log(f"⚠️ Цикл превысил бюджет: {elapsed:.1f}с при CYCLE_BUDGET={self.budget}с")
+        return report
+
+
+def run_daemon():
+    """
+    Постоянный режим: users, traffic и enforce по своим интервалам до SIGTERM/SIGINT.
+    Конфигурационный файл перечитывается по SIGHUP или при изменении (mtime);
+    новые интервалы и таймауты действуют со следующего запуска конвейера.
+    """
+    stop = threading.Event()
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGHUP, lambda *_: reload_requested.set())
+
+    pipelines = [
+        Pipeline('users', run_users_pipeline, USERS_SYNC_INTERVAL, USERS_SYNC_TIMEOUT),
+        Pipeline('traffic', run_traffic_pipeline, TRAFFIC_SYNC_INTERVAL, TRAFFIC_SYNC_TIMEOUT),
+        Pipeline('enforce', run_enforce_pipeline, ENFORCE_SYNC_INTERVAL, ENFORCE_SYNC_TIMEOUT),
+    ]
+    log(f"=== ⚙ Daemon: users каждые {USERS_SYNC_INTERVAL}с, traffic каждые {TRAFFIC_SYNC_INTERVAL}с, "
+        f"enforce каждые {ENFORCE_SYNC_INTERVAL or '—'}с ===")
+    config_mtime = sync_config.config_mtime()
+
+    while not stop.is_set():
+        mtime = sync_config.config_mtime()
+        if reload_requested.is_set() or mtime != config_mtime:
+            reload_requested.clear()
+            config_mtime = mtime
+            if reload_config():
+                pipelines[0].interval, pipelines[0].timeout = USERS_SYNC_INTERVAL, USERS_SYNC_TIMEOUT
+                pipelines[1].interval, pipelines[1].timeout = TRAFFIC_SYNC_INTERVAL, TRAFFIC_SYNC_TIMEOUT
+                pipelines[2].interval, pipelines[2].timeout = ENFORCE_SYNC_INTERVAL, ENFORCE_SYNC_TIMEOUT
+
+        now = time.monotonic()
+        for pipeline in pipelines:
+            if pipeline.interval and pipeline.due(now):
+                pipeline.start()
+        stop.wait(1)
+
+    log("🛑 Daemon остановлен")
+    return True
+
+
+# ============================================================================
+# ГЛАВНАЯ ФУНКЦИЯ
+# ============================================================================
+
+def main(argv=None):
+    """
+    Главная функция накопительной синхронизации v4.3.
+
+    Однократный запуск (systemd timer), последовательность операций:
+      1. Получаем список пользователей с parent (один GET-запрос, общий снимок)
+      2. Конвейер traffic: дельта трафика → parent, сброс отправленного, last_online
+         и конвейер enforce: локальное ограничение превысивших квоту / с истёкшим пакетом
+      3. Конвейер users: синхронизация пользователей (parent → child) по тому же снимку
+
+    Все шаги — под общим дедлайном цикла (CYCLE_BUDGET, CycleBudget): шаги 1–2 оставляют
+    CYCLE_USERS_RESERVE секунд users-конвейеру, не уложившееся откладывается до
+    следующего цикла и попадает в отчёт STATE_DIR/cycle.json.
+
+    --pipeline users|traffic|enforce запускает один конвейер, --daemon — все по своим интервалам.
+    """
+    parser = argparse.ArgumentParser(description="Hiddify child ↔ parent sync")
+    parser.add_argument('--daemon', action='store_true',
+                        help="постоянный режим: конвейеры по своим интервалам")
+    parser.add_argument('--pipeline', choices=('all', 'users', 'traffic', 'enforce'), default='all',
+                        help="какой конвейер выполнить в однократном режиме")
+    args = parser.parse_args(argv)
+
+    if args.daemon:
+        return run_daemon()
+
+    log("=== ⚙ Starting Stable Accumulative Sync v4.3 ===")
 
-        # Шаг 6: Полная синхронизация пользователей
-        log("Step 6: Полная синхронизация пользователей с parent...")
-        if sync_users_from_parent(parent_users):
-            log("✅ Синхронизация пользователей завершена успешно")
+    cycle = CycleBudget(CYCLE_BUDGET)
+    try:
+        if args.pipeline == 'users':
+            return run_pipeline('users', run_users_pipeline, USERS_SYNC_TIMEOUT,
+                                deadline=cycle.step_deadline(USERS_SYNC_TIMEOUT), cycle=cycle)
+        if args.pipeline == 'traffic':
+            return run_pipeline('traffic', run_traffic_pipeline, TRAFFIC_SYNC_TIMEOUT,
+                                deadline=cycle.step_deadline(TRAFFIC_SYNC_TIMEOUT), cycle=cycle)
+        if args.pipeline == 'enforce':
+            return run_pipeline('enforce', run_enforce_pipeline, ENFORCE_SYNC_TIMEOUT,
+                                deadline=cycle.step_deadline(ENFORCE_SYNC_TIMEOUT), cycle=cycle)
+
+        # Шаг 1: Получаем пользователей с parent (один раз для обоих конвейеров)
+        log("Step 1: Получаем список пользователей с parent...")
+        started = time.monotonic()
+        parent_users = fetch_parent_users(
+            deadline=cycle.step_deadline(PARENT_FETCH_TIMEOUT, CYCLE_USERS_RESERVE))
+        cycle.record('fetch', parent_users is not None, time.monotonic() - started)
+
+        # Шаг 2: Трафик и last_online (снимок из шага 1; если parent недоступен —
+        # последний успешный снимок с диска, отправка трафика идёт с повторами).
+        # Неотправленная дельта остаётся в current_usage и уйдёт в следующем цикле.
+        log("Step 2: Конвейер traffic (child → parent)...")
+        if cycle.exhausted(CYCLE_USERS_RESERVE):
+            cycle.skip('traffic')
         else:
-            log("❌ Ошибка синхронизации пользователей")
+            run_pipeline('traffic', run_traffic_pipeline, TRAFFIC_SYNC_TIMEOUT,
+                         deadline=cycle.step_deadline(TRAFFIC_SYNC_TIMEOUT, CYCLE_USERS_RESERVE),
+                         cycle=cycle)
+
+        # Шаг 2а: локальное ограничение квоты/срока (после сброса отправленного трафика)
+        if ENFORCE_SYNC_INTERVAL:
+            if cycle.exhausted(CYCLE_USERS_RESERVE):
+                cycle.skip('enforce')
+            else:
+                run_pipeline('enforce', run_enforce_pipeline, ENFORCE_SYNC_TIMEOUT,
+                             deadline=cycle.step_deadline(ENFORCE_SYNC_TIMEOUT, CYCLE_USERS_RESERVE),
+                             cycle=cycle)
+
+        # Шаг 3: Полная синхронизация пользователей — только по свежим данным.
+        # Не пропускается и при исчерпанном бюджете: активация и деактивация в Xray
+        # выполняются всегда, остальные классы операций откладываются по дедлайну.
+        if parent_users is None:
+            log("❌ Синхронизация пользователей пропущена: нет свежих данных с parent")
+            return False
+        log("Step 3: Конвейер users (parent → child)...")
+        run_pipeline('users', run_users_pipeline, USERS_SYNC_TIMEOUT,
+                     deadline=cycle.step_deadline(USERS_SYNC_TIMEOUT), cycle=cycle,
+                     parent_users=parent_users)
 
         log("✅ Stable sync completed successfully!")
         return True
@@ -657,6 +3757,11 @@ def main():
         log(f"❌ Критическая ошибка в синхронизации: {e}")
         traceback.print_exc()
         return False
+    finally:
+        cycle.finish()
+
+
+reload_config(quiet=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Общий конфигурационный файл Hiddify Child Sync (TOML) для stable_sync.py,
+sync_health_api.py и Xray-helper'ов.
+
+Файл: /etc/hiddify-child-sync/config.toml (путь переопределяется переменной
+окружения HIDDIFY_SYNC_CONFIG). Значения по умолчанию — константы модулей;
+файл переопределяет только указанные в нём ключи, удалённый из файла ключ при
+перечитывании возвращается к умолчанию.
+
+Типы проверяются по умолчаниям: ключ неверного типа или неизвестный ключ
+пропускается с предупреждением, остальной файл применяется. Файл с синтаксической
+ошибкой не применяется целиком — действуют прежние значения.
+
+СЕКЦИИ:
+  [parent]      url, api_key, sources (массив таблиц name/url/api_key) → stable_sync.py
+  [database]    параметры pymysql.connect → DB_CONFIG всех модулей
+  [sync]        константы stable_sync.py в нижнем регистре (min_traffic_threshold, ...)
+  [health_api]  константы sync_health_api.py (api_port, webhook_enabled, ...)
+  [xray]        api_host, api_port → Xray-helper'ы (XRAY_API_HOST, XRAY_API_PORT)
+
+Чтение TOML: tomllib (Python 3.11+) или пакет tomli на более старом Python. Без
+них при существующем файле модуль не запускается, а не работает на умолчаниях.
+
+Пример со всеми параметрами: config.example.toml
+"""
+
+import os
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: тот же парсер из пакета tomli
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+CONFIG_PATH = os.environ.get('HIDDIFY_SYNC_CONFIG', '/etc/hiddify-child-sync/config.toml')
+
+# Ключи секции [parent] → константы stable_sync.py
+PARENT_KEYS = {'url': 'PARENT_URL', 'api_key': 'API_KEY', 'sources': 'PARENT_SOURCES'}
+
+
+def _warn(message):
+    print(f"⚠️ Конфигурация {CONFIG_PATH}: {message}", flush=True)
+
+
+def load_config(path=None):
+    """
+    Читает конфигурационный файл.
+
+    Returns:
+        dict | None: разобранный файл ({} если его нет) или None при ошибке чтения/разбора
+    """
+    path = path or CONFIG_PATH
+    if tomllib is None:
+        if os.path.exists(path):
+            # Молча работать на умолчаниях (чужой parent, пустой API-ключ) опаснее,
+            # чем не запуститься
+            raise RuntimeError(f"{path}: для чтения TOML нужен Python 3.11+ или пакет tomli")
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        _warn(f"не применена: {e}")
+        return None
+
+
+def config_mtime(path=None):
+    """Время изменения файла (для перечитывания при изменении) или None."""
+    try:
+        return os.stat(path or CONFIG_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def _type_matches(default, value):
+    """Значение из файла подходит к типу умолчания (bool не считается числом)."""
+    if isinstance(default, bool) or isinstance(value, bool):
+        return isinstance(default, bool) and isinstance(value, bool)
+    if isinstance(default, float):
+        return isinstance(value, (int, float))
+    if isinstance(default, (list, tuple)):
+        return isinstance(value, list)
+    return isinstance(value, type(default))
+
+
+def _constant_name(section, key):
+    if section == 'parent':
+        return PARENT_KEYS.get(key)
+    if section == 'xray':
+        return 'XRAY_' + key.upper()
+    return key.upper()
+
+
+def apply_config(namespace, config, sections, names=None):
+    """
+    Применяет секции config к константам модуля (namespace — его globals()).
+    names — какие константы можно задавать (по умолчанию все в верхнем регистре).
+
+    Умолчания запоминаются при первом вызове (_CONFIG_DEFAULTS), заданные файлом
+    имена — в _CONFIG_NAMES. Объекты (сессии, пулы) не пересоздаются: модуль сам
+    решает, что делать с изменившимися значениями.
+
+    Returns:
+        set: имена констант, значение которых изменилось
+    """
+    defaults = namespace.setdefault('_CONFIG_DEFAULTS', {
+        name: value for name, value in namespace.items()
+        if name.isupper() and not name.startswith('_') and (names is None or name in names)
+    })
+    wanted = {}
+    for section in sections:
+        values = config.get(section, {})
+        if not isinstance(values, dict):
+            _warn(f"[{section}] должна быть таблицей")
+            continue
+        if section == 'database':
+            if 'DB_CONFIG' in defaults and values:
+                wanted['DB_CONFIG'] = dict(defaults['DB_CONFIG'], **values)
+            continue
+        for key, value in values.items():
+            name = _constant_name(section, key)
+            if name not in defaults:
+                _warn(f"неизвестный параметр [{section}] {key}")
+                continue
+            default = defaults[name]
+            if not _type_matches(default, value):
+                _warn(f"[{section}] {key}: ожидается {type(default).__name__}, "
+                      f"получено {type(value).__name__}")
+                continue
+            if isinstance(default, tuple):
+                value = tuple(value)
+            elif isinstance(default, float):
+                value = float(value)
+            wanted[name] = value
+
+    previous = namespace.get('_CONFIG_NAMES', set())
+    changed = set()
+    for name in previous | set(wanted):
+        value = wanted.get(name, defaults[name])
+        if namespace[name] != value:
+            namespace[name] = value
+            changed.add(name)
+    namespace['_CONFIG_NAMES'] = set(wanted)
+    return changed
+
+
+def is_configured(namespace, name):
+    """Задана ли константа конфигурационным файлом (при последнем применении)."""
+    return name in namespace.get('_CONFIG_NAMES', ())
+
+
+def configure_module(namespace, sections):
+    """Однократное применение файла при импорте модуля (helper'ы, health API)."""
+    config = load_config()
+    if config:
+        apply_config(namespace, config, sections)
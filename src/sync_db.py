@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Общий доступ к локальной MySQL для stable_sync.py и sync_health_api.py.
+
+Небольшой пул соединений, переиспользуемых между шагами синхронизации (вместо
+connect/close в каждом шаге), транзакция на шаг (commit при успехе, rollback
+при исключении), переподключение после обрыва и метрики по шагам: число
+подключений и их время, число SQL-запросов, длительность.
+
+pymysql импортируется при первом подключении: процессы и шаги, не работающие
+с БД (пропущенный запуск, health API без запросов к БД), его не загружают.
+
+ИСПОЛЬЗОВАНИЕ:
+    db = DatabasePool(lambda: DB_CONFIG, size=2, metrics_path='/var/lib/.../db_metrics.json')
+    with db.step('collect_usage') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(...)
+        with dict_cursor(conn) as cursor:    # строки — словари
+            cursor.execute(...)
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Соединение, простоявшее в пуле дольше, перед выдачей проверяется ping'ом
+# (MySQL закрывает неактивные по wait_timeout; unix socket ping — микросекунды)
+PING_AFTER = 30
+
+
+_counting_connection = None
+
+
+def _connection_class():
+    """
+    CountingConnection — соединение, считающее SQL-запросы (все cursor.execute
+    проходят через query). Класс создаётся при первом подключении вместе с импортом pymysql.
+    """
+    global _counting_connection
+    if _counting_connection is None:
+        import pymysql
+
+        class CountingConnection(pymysql.connections.Connection):
+            statements = 0
+
+            def query(self, sql, unbuffered=False):
+                self.statements += 1
+                return super().query(sql, unbuffered)
+
+        _counting_connection = CountingConnection
+    return _counting_connection
+
+
+def dict_cursor(conn):
+    """Курсор, возвращающий строки словарями (pymysql DictCursor)."""
+    import pymysql
+    return conn.cursor(pymysql.cursors.DictCursor)
+
+
+class DatabasePool:
+    """
+    Пул соединений к локальной MySQL. config — функция, возвращающая параметры
+    pymysql.connect: после перечитывания конфигурации соединения со старыми
+    параметрами закрываются при следующей выдаче.
+    """
+
+    def __init__(self, config, size=2, metrics_path=None):
+        self.config = config
+        self.size = size
+        self.metrics_path = metrics_path
+        self.metrics = {}
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self, params):
+        started = time.perf_counter()
+        conn = _connection_class()(**params)
+        return conn, (time.perf_counter() - started) * 1000
+
+    def _acquire(self):
+        """Соединение из пула (с проверкой) или новое: (conn, params, connect_ms | None)."""
+        params = self.config()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, conn_params, idle_since = self._idle.pop()
+            if conn_params != params:
+                self._close(conn)
+                continue
+            if time.monotonic() - idle_since > PING_AFTER:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close(conn)
+                    continue
+            return conn, params, None
+        conn, connect_ms = self._connect(params)
+        return conn, params, connect_ms
+
+    def _release(self, conn, params, broken):
+        if not broken and conn.open:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, params, time.monotonic()))
+                    return
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def step(self, name):
+        """
+        Соединение на шаг синхронизации: одна транзакция (commit при выходе,
+        rollback при исключении), затем возврат в пул. Обрыв соединения
+        (OperationalError / InterfaceError) — соединение выбрасывается, следующий
+        шаг подключится заново.
+        """
+        conn, params, connect_ms = self._acquire()
+        statements = conn.statements
+        started = time.perf_counter()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            import pymysql
+            broken = isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self._record(name, connect_ms, conn.statements - statements,
+                         (time.perf_counter() - started) * 1000, broken)
+            self._release(conn, params, broken)
+
+    def _step_metrics(self, name):
+        return self.metrics.setdefault(name, {
+            'runs': 0, 'connects': 0, 'connect_ms': 0.0, 'statements': 0, 'errors': 0,
+        })
+
+    def annotate(self, name, **values):
+        """Дополнительные метрики шага (например, чанки и ожидания блокировок)."""
+        with self._lock:
+            self._step_metrics(name).update(values)
+            snapshot = json.dumps(self.metrics)
+        if self.metrics_path:
+            self._save_metrics(snapshot)
+
+    def take_metrics(self):
+        """Накопленные метрики шагов с обнулением (передача родителю — см. merge_metrics)."""
+        with self._lock:
+            metrics, self.metrics = self.metrics, {}
+        return metrics
+
+    def merge_metrics(self, metrics):
+        """Метрики шагов пула другого процесса (шарда синхронизации): счётчики суммируются."""
+        with self._lock:
+            for name, other in metrics.items():
+                step = self._step_metrics(name)
+                for key in ('runs', 'connects', 'statements', 'errors'):
+                    step[key] += other.get(key, 0)
+                step['connect_ms'] = round(step['connect_ms'] + other.get('connect_ms', 0), 2)
+                if 'last' in other:
+                    step['last'] = other['last']
+            snapshot = json.dumps(self.metrics)
+        if self.metrics_path:
+            self._save_metrics(snapshot)
+
+    def _record(self, name, connect_ms, statements, duration_ms, broken):
+        with self._lock:
+            step = self._step_metrics(name)
+            step['runs'] += 1
+            step['statements'] += statements
+            if connect_ms is not None:
+                step['connects'] += 1
+                step['connect_ms'] = round(step['connect_ms'] + connect_ms, 2)
+            if broken:
+                step['errors'] += 1
+            step['last'] = {
+                'at': int(time.time()), 'statements': statements,
+                'duration_ms': round(duration_ms, 1),
+                'connect_ms': None if connect_ms is None else round(connect_ms, 2),
+            }
+            snapshot = json.dumps(self.metrics)
+        if self.metrics_path:
+            self._save_metrics(snapshot)
+
+    def _save_metrics(self, snapshot):
+        """
+        Метрики для health API (другой процесс): атомарная запись JSON. Шаги других
+        процессов (таймер, daemon, webhook в health API) в файле сохраняются.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.metrics_path), exist_ok=True)
+            merged = read_metrics(self.metrics_path)
+            merged.update(json.loads(snapshot))
+            tmp_path = f"{self.metrics_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(merged, f)
+            os.replace(tmp_path, self.metrics_path)
+        except OSError:
+            pass
+
+
+def read_metrics(path):
+    """Метрики шагов, сохранённые процессом синхронизации ({} если их нет)."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
@@ -8,8 +8,28 @@ ENDPOINTS:
 - GET /api/v2/hiddify-sync/health - основная проверка здоровья системы
 - GET /api/v2/hiddify-sync/status - детальный статус всех компонентов
 - GET /api/v2/hiddify-sync/logs - последние логи синхронизации
-
-ПОРТ: 8081 (localhost only для безопасности)
+- GET /api/v2/hiddify-sync/usage?hours=24&top=10 - отправленный трафик из журнала
+  usage_ring: топ потребителей, суммы по часам, перцентили на пользователя
+- GET /api/v2/hiddify-sync/node - компактная сводка узла только из STATE_DIR (без
+  systemctl/journalctl/MySQL): проходы конвейеров, очередь трафика, breaker'ы parent
+- GET /api/v2/hiddify-sync/fleet - сводка парка (только при заданном FLEET_NODES)
+
+ПОРТ: 8081 (localhost only для безопасности; API_BIND — для опроса агрегатором
+по частной сети, тогда с API_TOKEN)
+
+АГРЕГАТОР ПАРКА (опционально, FLEET_NODES):
+  Тот же сервис на выделенном узле опрашивает /node всех child параллельно
+  (FLEET_CONCURRENCY, таймаут FLEET_TIMEOUT), кэширует результат на FLEET_CACHE_TTL
+  и отдаёт одну сводку: недоступные узлы, устаревшие синхронизации, очередь
+  трафика, перцентили длительности циклов по конвейерам, открытые breaker'ы.
+
+WEBHOOK (опционально, WEBHOOK_ENABLED):
+- POST /api/v2/hiddify-sync/users-changed - уведомление «пользователи изменились»
+  {"uuids": ["...", ...]} → точечная синхронизация и активация в Xray только этих
+  пользователей (stable_sync.sync_users_targeted). Отдельный порт WEBHOOK_PORT,
+  авторизация заголовком X-Sync-Token. Polling-цикл по таймеру остаётся fallback'ом.
+- POST /api/v2/hiddify-sync/usage-deltas - пачка дельт трафика от child на узле-агрегаторе
+  (stable_sync.TRAFFIC_AGGREGATION = 'aggregator'), суммируется в спул по UUID.
 
 ИСПОЛЬЗОВАНИЕ:
 curl http://localhost:8081/api/v2/hiddify-sync/health | jq
@@ -18,20 +38,37 @@ curl http://localhost:8081/api/v2/hiddify-sync/health | jq
 ЛИЦЕНЗИЯ: MIT
 """
 
+import sys
 import json
+import hmac
+import uuid as uuid_lib
+import threading
 import subprocess
 import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
-import pymysql
+import sync_config
+import sync_db
 
 # ============================================================================
 # КОНФИГУРАЦИЯ
+# Значения по умолчанию; переопределяются секциями [database] и [health_api]
+# файла /etc/hiddify-child-sync/config.toml (см. sync_config.py)
 # ============================================================================
 
 # Порт для HTTP сервера (только localhost)
 API_PORT = 8081
 
+# Адрес HTTP сервера. Для опроса агрегатором парка — адрес в частной сети
+# (WireGuard/VPC) вместе с API_TOKEN: запросы не с localhost должны передавать
+# его в заголовке X-Sync-Token.
+API_BIND = '127.0.0.1'
+API_TOKEN = ''
+
+_LOOPBACK = ('127.0.0.1', '::1', 'localhost')
+
 # Конфигурация подключения к базе данных
 DB_CONFIG = {
     'unix_socket': '/var/run/mysqld/mysqld.sock',
@@ -40,6 +77,51 @@ DB_CONFIG = {
     'charset': 'utf8mb4'
 }
 
+# Webhook «users changed» (push-распространение новых пользователей).
+# Если parent шлёт уведомления с другого хоста — укажите WEBHOOK_BIND = '0.0.0.0'
+# и обязательно задайте WEBHOOK_TOKEN. Без токена запросы отклоняются.
+WEBHOOK_ENABLED = False
+WEBHOOK_BIND = '127.0.0.1'
+WEBHOOK_PORT = 8082
+WEBHOOK_TOKEN = ''
+
+# Уведомления, пришедшие за это окно (секунды), объединяются в одну синхронизацию
+WEBHOOK_DEBOUNCE = 1.0
+
+# Максимум UUID в одном уведомлении
+WEBHOOK_MAX_UUIDS = 500
+
+# Таймаут одной точечной синхронизации (секунды)
+WEBHOOK_SYNC_TIMEOUT = 60
+
+# Пауза перед повтором пачки, пока идёт полный users-проход (секунды)
+WEBHOOK_BUSY_RETRY = 5
+
+# Агрегатор парка: health API child-узлов, опрашиваемые этим узлом.
+# Элемент — URL ("http://10.8.0.2:8081") или таблица {name, url, token}.
+FLEET_NODES = []
+# Таймаут опроса одного узла и число одновременных опросов
+FLEET_TIMEOUT = 3.0
+FLEET_CONCURRENCY = 16
+# Сводка парка пересобирается не чаще раза в N секунд (между опросами — из кэша)
+FLEET_CACHE_TTL = 30
+# Конвейер без успешного прохода дольше N секунд — синхронизация устарела
+FLEET_STALE_AFTER = 900
+# Неотправленный трафик старше N секунд — очередь трафика узла отстаёт
+FLEET_BACKLOG_MAX_AGE = 3600
+
+sync_config.configure_module(globals(), ('database', 'health_api'))
+
+# Синхронизация запускается либо таймером (однократные запуски), либо daemon'ом;
+# юниты конфликтуют (Conflicts=), активен один из них
+SYNC_TIMER_UNIT = 'hiddify-child-sync.timer'
+SYNC_DAEMON_UNIT = 'hiddify-child-sync-daemon.service'
+# Логи синхронизации в обоих режимах
+SYNC_LOG_UNITS = ('-u', 'hiddify-child-sync.service', '-u', SYNC_DAEMON_UNIT)
+
+# Соединения с БД переиспользуются между запросами (тот же механизм, что у stable_sync.py)
+db = sync_db.DatabasePool(lambda: DB_CONFIG, size=2)
+
 # ============================================================================
 # HTTP REQUEST HANDLER
 # ============================================================================
@@ -51,15 +133,31 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         """Обработка GET запросов"""
         parsed = urlparse(self.path)
 
+        if not self.authorized():
+            self.send_json_response({"error": "unauthorized"}, 401)
+            return
+
         if parsed.path == '/api/v2/hiddify-sync/health':
             self.handle_health()
         elif parsed.path == '/api/v2/hiddify-sync/status':
             self.handle_status()
         elif parsed.path == '/api/v2/hiddify-sync/logs':
             self.handle_logs()
+        elif parsed.path == '/api/v2/hiddify-sync/usage':
+            self.handle_usage(parse_qs(parsed.query))
+        elif parsed.path == '/api/v2/hiddify-sync/node':
+            self.send_json_response(self.get_node_summary())
+        elif parsed.path == '/api/v2/hiddify-sync/fleet':
+            self.handle_fleet()
         else:
             self.send_error(404, "Not Found")
 
+    def authorized(self):
+        """Запросы не с localhost — только с X-Sync-Token; без API_TOKEN — отказ"""
+        if self.client_address[0] in _LOOPBACK:
+            return True
+        return bool(API_TOKEN) and hmac.compare_digest(self.headers.get('X-Sync-Token', ''), API_TOKEN)
+
     def handle_health(self):
         """
         Основной endpoint для проверки здоровья синхронизации
@@ -68,9 +166,15 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         {
             "status": "healthy" | "unhealthy",
             "timestamp": "ISO datetime",
-            "sync_service": {"active": bool, "enabled": bool},
+            "sync_service": {"active": bool, "enabled": bool, "unit": str, "mode": "timer"|"daemon"},
             "database": {"accessible": bool, "user_count": int},
             "last_sync": {"last_log": str},
+            "parent_snapshot": {"available": bool, "users": int, "age_seconds": int},
+            "sync_runs": {"users" | "traffic" | "enforce":
+                          {"running": bool, "pid", "host", "command", "age_seconds", "stale"}},
+            "xray": {"started_at": str, "restarts": int,
+                     "last_restart": {"recovery_seconds": float, ...}},
+            "enforcement": {"enforced_users": int, "expired": int, "quota": int},
             "users_summary": {
                 "enabled_users": int,
                 "disabled_users": int,
@@ -85,6 +189,11 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
                 "sync_service": self.get_sync_service_status(),
                 "database": self.get_database_status(),
                 "last_sync": self.get_last_sync_info(),
+                "parent_snapshot": self.get_parent_snapshot_status(),
+                "sync_runs": self.get_sync_runs_status(),
+                "xray": self.get_xray_status(),
+                "enforcement": self.get_enforcement_status(),
+                "parent_client": self.get_parent_client_status(),
                 "users_summary": self.get_users_summary()
             }
 
@@ -111,8 +220,12 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         Возвращает:
         {
             "sync_timer": {"status_output": str},
-            "sync_service": {"active": bool, "enabled": bool},
-            "database": {"accessible": bool, "user_count": int},
+            "sync_service": {"active": bool, "enabled": bool, "unit": str, "mode": "timer"|"daemon"},
+            "database": {"accessible": bool, "user_count": int,
+                         "steps": {шаг: {"runs", "connects", "connect_ms", "statements", "last"}}},
+            "operations": {"at": int, "classes": {класс: {"done", "deferred", "ms"}},
+                           "shards": {"count", "errors"}},   # только при шардировании
+            "cycle": {"at", "budget", "elapsed", "overrun", "steps", "skipped", "deferred"},
             "configuration": {"files": {...}}
         }
         """
@@ -120,7 +233,9 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
             status_data = {
                 "sync_timer": self.get_timer_status(),
                 "sync_service": self.get_sync_service_status(),
-                "database": self.get_database_status(),
+                "database": dict(self.get_database_status(), steps=self.get_database_metrics()),
+                "operations": self.get_operations_status(),
+                "cycle": self.get_cycle_status(),
                 "configuration": self.get_config_status()
             }
             self.send_json_response(status_data)
@@ -144,7 +259,7 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         }
         """
         try:
-            cmd = ['journalctl', '-u', 'hiddify-child-sync.service', '--no-pager', '-n', '20', '--output=json']
+            cmd = ['journalctl', *SYNC_LOG_UNITS, '--no-pager', '-n', '20', '--output=json']
             result = subprocess.run(cmd, capture_output=True, text=True)
 
             logs = []
@@ -165,29 +280,136 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
 
+    def handle_usage(self, query):
+        """
+        Отчёт по отправленному трафику из журнала usage_ring (без запросов к MySQL)
+
+        Параметры: hours (окно, по умолчанию 24, до 720), top (по умолчанию 10, до 1000)
+
+        Возвращает:
+        {
+            "total_bytes": int,
+            "users": int,
+            "top": [{"uuid": str, "name": str, "bytes": int}, ...],
+            "hourly": [{"hour": int, "bytes": int}, ...],
+            "per_user_percentiles": {"p50": int, "p90": int, "p99": int},
+            ...
+        }
+        """
+        try:
+            hours = min(max(int(query.get('hours', ['24'])[0]), 1), 720)
+            top = min(max(int(query.get('top', ['10'])[0]), 1), 1000)
+        except ValueError:
+            self.send_json_response({"error": "hours и top должны быть целыми"}, 400)
+            return
+        try:
+            import stable_sync
+            import usage_ring
+            self.send_json_response(usage_ring.summary(stable_sync.get_usage_ring(), hours, top))
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+
+    def handle_fleet(self):
+        """
+        Сводка парка child-узлов (режим агрегатора, FLEET_NODES)
+
+        Возвращает:
+        {
+            "nodes_total": int, "nodes_ok": int,
+            "unreachable": [{"node": str, "error": str}],
+            "stale_syncs": [{"node": str, "pipeline": str, "age_seconds": int | null}],
+            "traffic_backlog": {"pending_users": int, "lagging": [{"node", "pending_users",
+                                "oldest_pending_seconds"}]},
+            "cycle_seconds": {конвейер: {"p50", "p90", "p99", "max", "runs"}},
+            "breakers_open": [{"node": str, "source": str}],
+            "nodes": {узел: {...}}
+        }
+        """
+        if not fleet_nodes():
+            self.send_json_response({"error": "fleet mode is disabled (FLEET_NODES)"}, 404)
+            return
+        try:
+            self.send_json_response(fleet.view())
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+
     # ========================================================================
     # HELPER METHODS
     # ========================================================================
 
+    def get_node_summary(self):
+        """
+        Сводка узла для агрегатора парка: только файлы STATE_DIR (без systemctl,
+        journalctl и MySQL), чтобы частый опрос ничего не стоил узлу.
+        Возраст — в секундах на момент ответа (часы узлов могут расходиться).
+        """
+        import time
+        import socket
+        import stable_sync
+        now = time.time()
+
+        pipelines = {}
+        for name, run in stable_sync.load_state(stable_sync.PIPELINE_RUNS, {}).items():
+            pipelines[name] = {
+                "ok": run.get("ok"),
+                "last_run_age": round(now - run["last_run"]) if run.get("last_run") else None,
+                "last_ok_age": round(now - run["last_ok"]) if run.get("last_ok") else None,
+                "durations": run.get("durations", []),
+                "deferred": run.get("deferred", {})
+            }
+        cycle = stable_sync.load_state(stable_sync.CYCLE_REPORT, {})
+
+        pending = stable_sync.load_state(stable_sync.TRAFFIC_PENDING, {})
+        snapshot = stable_sync.read_parent_snapshot_header()
+        return {
+            "node": socket.gethostname(),
+            "timestamp": datetime.datetime.now().isoformat(),
+            "pipelines": pipelines,
+            "cycle": {
+                "age_seconds": round(now - cycle["at"]) if cycle.get("at") else None,
+                "elapsed": cycle.get("elapsed"),
+                "overrun": cycle.get("overrun"),
+                "skipped": cycle.get("skipped", [])
+            },
+            "traffic_backlog": {
+                "pending_users": len(pending),
+                "oldest_pending_seconds": round(now - min(pending.values())) if pending else 0,
+                "aggregator_batch_pending": bool(stable_sync.load_state(stable_sync.AGGREGATOR_PENDING, None))
+            },
+            "parent_snapshot_age": snapshot["age_seconds"] if snapshot else None,
+            "parent_breakers": {source: state.get("breaker")
+                                for source, state in self.get_parent_client_status().items()
+                                if isinstance(state, dict)},
+            "enforced_users": self.get_enforcement_status().get("enforced_users"),
+            "xray_restarts": self.get_xray_status().get("restarts")
+        }
+
     def get_sync_service_status(self):
-        """Получить статус systemd сервиса синхронизации"""
+        """
+        Получить статус systemd юнита синхронизации: активного из таймера и daemon'а
+        (mode — 'daemon' или 'timer'; если не активен ни один — 'timer').
+        """
         try:
-            cmd = ['systemctl', 'is-active', 'hiddify-child-sync.timer']
+            units = [SYNC_DAEMON_UNIT, SYNC_TIMER_UNIT]
+            cmd = ['systemctl', 'is-active'] + units
             result = subprocess.run(cmd, capture_output=True, text=True)
-            active = result.stdout.strip() == 'active'
+            active = dict(zip(units, (line.strip() == 'active' for line in result.stdout.splitlines())))
+            unit = SYNC_DAEMON_UNIT if active.get(SYNC_DAEMON_UNIT) else SYNC_TIMER_UNIT
 
-            cmd = ['systemctl', 'is-enabled', 'hiddify-child-sync.timer']
+            cmd = ['systemctl', 'is-enabled', unit]
             result = subprocess.run(cmd, capture_output=True, text=True)
             enabled = result.stdout.strip() == 'enabled'
 
-            return {"active": active, "enabled": enabled}
+            return {"active": active.get(unit, False), "enabled": enabled, "unit": unit,
+                    "mode": 'daemon' if unit == SYNC_DAEMON_UNIT else 'timer'}
         except:
             return {"active": False, "enabled": False}
 
     def get_timer_status(self):
-        """Получить детальный статус таймера"""
+        """Получить детальный статус юнита синхронизации (таймер или daemon)"""
         try:
-            cmd = ['systemctl', 'status', 'hiddify-child-sync.timer', '--no-pager', '-l']
+            unit = self.get_sync_service_status().get('unit', SYNC_TIMER_UNIT)
+            cmd = ['systemctl', 'status', unit, '--no-pager', '-l']
             result = subprocess.run(cmd, capture_output=True, text=True)
             return {"status_output": result.stdout}
         except:
@@ -196,11 +418,9 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
     def get_database_status(self):
         """Получить статус подключения к базе данных"""
         try:
-            conn = pymysql.connect(**DB_CONFIG)
-            with conn.cursor() as cursor:
+            with db.step('health') as conn, conn.cursor() as cursor:
                 cursor.execute("SELECT COUNT(*) FROM user")
                 user_count = cursor.fetchone()[0]
-            conn.close()
             return {"accessible": True, "user_count": user_count}
         except Exception as e:
             return {"accessible": False, "error": str(e)}
@@ -208,8 +428,7 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
     def get_users_summary(self):
         """Получить краткую сводку по пользователям"""
         try:
-            conn = pymysql.connect(**DB_CONFIG)
-            with conn.cursor() as cursor:
+            with db.step('health') as conn, conn.cursor() as cursor:
                 cursor.execute("SELECT COUNT(*) FROM user WHERE enable = 1")
                 enabled_count = cursor.fetchone()[0]
 
@@ -219,7 +438,6 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
                 cursor.execute("SELECT COUNT(*) FROM user WHERE current_usage > 1000000")
                 with_traffic_count = cursor.fetchone()[0]
 
-            conn.close()
             return {
                 "enabled_users": enabled_count,
                 "disabled_users": disabled_count,
@@ -231,7 +449,7 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
     def get_last_sync_info(self):
         """Получить информацию о последней синхронизации"""
         try:
-            cmd = ['journalctl', '-u', 'hiddify-child-sync.service', '--no-pager', '-n', '1']
+            cmd = ['journalctl', *SYNC_LOG_UNITS, '--no-pager', '-n', '1']
             result = subprocess.run(cmd, capture_output=True, text=True)
 
             if result.returncode == 0 and result.stdout.strip():
@@ -243,13 +461,126 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         except Exception as e:
             return {"error": str(e)}
 
+    def get_parent_snapshot_status(self):
+        """Возраст последнего успешного снимка пользователей parent (только заголовок файла)"""
+        try:
+            import stable_sync
+            header = stable_sync.read_parent_snapshot_header()
+            if header is None:
+                return {"available": False}
+            return {
+                "available": True,
+                "users": header["users"],
+                "fetched_at": datetime.datetime.fromtimestamp(header["fetched_at"]).isoformat(),
+                "age_seconds": header["age_seconds"],
+                "size_bytes": header["size_bytes"]
+            }
+        except Exception as e:
+            return {"available": False, "error": str(e)}
+
+    def get_sync_runs_status(self):
+        """
+        Кто сейчас держит блокировку запуска каждого конвейера (stable_sync.run_lock).
+        Webhook своей блокировки не имеет — он идёт под блокировкой users, и тогда её
+        держатель — этот процесс (command: sync_health_api.py).
+        """
+        try:
+            import stable_sync
+            runs = {}
+            for name in ('users', 'traffic', 'enforce'):
+                holder = stable_sync.read_run_lock(name)
+                if holder is None:
+                    runs[name] = {"running": False}
+                    continue
+                runs[name] = {
+                    "running": True,
+                    "pid": holder["pid"],
+                    "host": holder["host"],
+                    "command": holder.get("command"),
+                    "started": datetime.datetime.fromtimestamp(holder["started"]).isoformat(),
+                    "age_seconds": holder["age_seconds"],
+                    "stale": holder["stale"]
+                }
+            return runs
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_xray_status(self):
+        """Время запуска Xray и последнее восстановление после перезапуска (stable_sync.check_xray_restart)"""
+        try:
+            import stable_sync
+            state = stable_sync.load_state(stable_sync.XRAY_STATE, {})
+            started_at = state.get("started_at")
+            return {
+                "started_at": (datetime.datetime.fromtimestamp(started_at).isoformat()
+                               if started_at else None),
+                "restarts": state.get("restarts", 0),
+                "last_restart": state.get("last_restart")
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_enforcement_status(self):
+        """Пользователи, локально убранные из Xray до подтверждения parent (конвейер enforce)"""
+        try:
+            import stable_sync
+            enforced = stable_sync.load_state(stable_sync.ENFORCED, {})
+            reasons = [record.get("reason") for record in enforced.values()]
+            return {
+                "enforced_users": len(enforced),
+                "expired": reasons.count("expired"),
+                "quota": reasons.count("quota")
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_parent_client_status(self):
+        """Адаптивный клиент parent по источникам: breaker, лимит параллельности, задержка"""
+        try:
+            import stable_sync
+            health = stable_sync.load_state(stable_sync.PARENT_HEALTH, {})
+            now = datetime.datetime.now().timestamp()
+            for state in health.values():
+                # Сохранённое состояние breaker'а могло устареть: open истекает по open_until
+                if state.get("breaker") == "open" and (state.get("open_until") or 0) <= now:
+                    state["breaker"] = "half-open"
+            return health
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_operations_status(self):
+        """Очередь побочных эффектов последнего users-цикла: выполнено/отложено по классам"""
+        try:
+            import stable_sync
+            return stable_sync.load_state(stable_sync.OPERATIONS_STATE, {})
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_cycle_status(self):
+        """Отчёт последнего однократного запуска: бюджет, шаги, отложенное до следующего цикла"""
+        try:
+            import stable_sync
+            return stable_sync.load_state(stable_sync.CYCLE_REPORT, {})
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_database_metrics(self):
+        """Метрики шагов синхронизации по БД: подключения, их время, число запросов"""
+        try:
+            import stable_sync
+            return sync_db.read_metrics(stable_sync._state_path(stable_sync.DB_METRICS))
+        except Exception as e:
+            return {"error": str(e)}
+
     def get_config_status(self):
         """Получить статус конфигурационных файлов"""
         import os
         files_to_check = [
             '/opt/hiddify-manager/stable_sync.py',
+            sync_config.CONFIG_PATH,
             '/etc/systemd/system/hiddify-child-sync.service',
-            '/etc/systemd/system/hiddify-child-sync.timer'
+            '/etc/systemd/system/hiddify-child-sync.timer',
+            f'/etc/systemd/system/{SYNC_DAEMON_UNIT}'
         ]
 
         file_status = {}
@@ -276,24 +607,335 @@ class SyncHealthHandler(BaseHTTPRequestHandler):
         """Отключаем стандартное логирование запросов (используем journald)"""
         pass
 
+# ============================================================================
+# АГРЕГАТОР ПАРКА
+# ============================================================================
+
+def fleet_nodes():
+    """FLEET_NODES в виде [{name, url, token}] (URL-строки — имя по адресу)."""
+    nodes = []
+    for node in FLEET_NODES:
+        if isinstance(node, str):
+            node = {"url": node}
+        if not isinstance(node, dict) or not node.get("url"):
+            continue
+        url = node["url"].rstrip("/")
+        nodes.append({"name": node.get("name") or urlparse(url).netloc or url,
+                      "url": url, "token": node.get("token", "")})
+    return nodes
+
+
+class FleetAggregator:
+    """
+    Сводка парка: параллельный опрос /node всех узлов с таймаутом, результат
+    кэшируется на FLEET_CACHE_TTL. Одновременные запросы сводки ждут один опрос.
+    Недоступный узел сохраняет последний успешный ответ (с его возрастом).
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def poll(self, node):
+        """Опрос одного узла: (сводка | None, ошибка | None, задержка мс)."""
+        import time
+        started = time.monotonic()
+        headers = {"X-Sync-Token": node["token"]} if node["token"] else {}
+        request = urllib.request.Request(f"{node['url']}/api/v2/hiddify-sync/node", headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=FLEET_TIMEOUT) as response:
+                summary = json.load(response)
+            return summary, None, round((time.monotonic() - started) * 1000)
+        except Exception as e:
+            return None, str(e), round((time.monotonic() - started) * 1000)
+
+    def refresh(self):
+        import time
+        nodes = fleet_nodes()
+        with ThreadPoolExecutor(max_workers=max(1, min(FLEET_CONCURRENCY, len(nodes))),
+                                thread_name_prefix='fleet') as pool:
+            results = list(pool.map(self.poll, nodes))
+        now = time.monotonic()
+        previous, self.nodes = self.nodes, {}
+        for node, (summary, error, latency_ms) in zip(nodes, results):
+            entry = previous.get(node["name"], {})
+            if summary is not None:
+                entry = {"summary": summary, "fetched_at": now}
+            entry.update(error=error, latency_ms=latency_ms)
+            self.nodes[node["name"]] = entry
+        self.refreshed_at = now
+
+    def view(self):
+        import time
+        with self.lock:
+            if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= FLEET_CACHE_TTL:
+                self.refresh()
+            return self.merge(time.monotonic())
+
+    def merge(self, now):
+        """Одна сводка из ответов узлов (возрасты — с поправкой на время в кэше)."""
+        import usage_ring
+        view = {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "cache_age_seconds": round(now - self.refreshed_at),
+            "nodes_total": len(self.nodes),
+            "nodes_ok": 0,
+            "unreachable": [],
+            "stale_syncs": [],
+            "traffic_backlog": {"pending_users": 0, "lagging": []},
+            "cycle_seconds": {},
+            "breakers_open": [],
+            "nodes": {}
+        }
+        durations = {}
+        for name, entry in sorted(self.nodes.items()):
+            summary = entry.get("summary")
+            if entry["error"]:
+                view["unreachable"].append({"node": name, "error": entry["error"]})
+            else:
+                view["nodes_ok"] += 1
+            if summary is None:
+                view["nodes"][name] = {"reachable": False, "error": entry["error"]}
+                continue
+            age = round(now - entry["fetched_at"])
+
+            def aged(seconds):
+                return None if seconds is None else seconds + age
+
+            pipelines = {}
+            for pipeline, run in summary.get("pipelines", {}).items():
+                last_ok_age = aged(run.get("last_ok_age"))
+                if last_ok_age is None or last_ok_age > FLEET_STALE_AFTER:
+                    view["stale_syncs"].append({"node": name, "pipeline": pipeline,
+                                                "age_seconds": last_ok_age})
+                durations.setdefault(pipeline, []).extend(run.get("durations", []))
+                pipelines[pipeline] = {"ok": run.get("ok"), "last_ok_age": last_ok_age,
+                                       "deferred": run.get("deferred", {})}
+
+            backlog = summary.get("traffic_backlog", {})
+            view["traffic_backlog"]["pending_users"] += backlog.get("pending_users", 0)
+            oldest = aged(backlog.get("oldest_pending_seconds") or 0) if backlog.get("pending_users") else 0
+            if oldest > FLEET_BACKLOG_MAX_AGE or backlog.get("aggregator_batch_pending"):
+                view["traffic_backlog"]["lagging"].append({
+                    "node": name, "pending_users": backlog.get("pending_users", 0),
+                    "oldest_pending_seconds": oldest
+                })
+
+            for source, breaker in summary.get("parent_breakers", {}).items():
+                if breaker == "open":
+                    view["breakers_open"].append({"node": name, "source": source})
+
+            view["nodes"][name] = {
+                "reachable": not entry["error"],
+                "error": entry["error"],
+                "latency_ms": entry["latency_ms"],
+                "data_age_seconds": age,
+                "host": summary.get("node"),
+                "pipelines": pipelines,
+                "pending_users": backlog.get("pending_users", 0),
+                "oldest_pending_seconds": oldest,
+                "parent_snapshot_age": aged(summary.get("parent_snapshot_age")),
+                "enforced_users": summary.get("enforced_users"),
+                "xray_restarts": summary.get("xray_restarts"),
+                "cycle": summary.get("cycle")
+            }
+
+        view["traffic_backlog"]["lagging"].sort(key=lambda n: n["oldest_pending_seconds"], reverse=True)
+        for pipeline, values in sorted(durations.items()):
+            view["cycle_seconds"][pipeline] = dict(
+                {f"p{p}": value for p, value in usage_ring.percentiles(values).items()},
+                max=max(values, default=0), runs=len(values)
+            )
+        return view
+
+
+fleet = FleetAggregator()
+
+
+# ============================================================================
+# WEBHOOK: PUSH-РАСПРОСТРАНЕНИЕ ПОЛЬЗОВАТЕЛЕЙ
+# ============================================================================
+
+class TargetedSyncWorker:
+    """
+    Фоновый поток точечной синхронизации: копит UUID из уведомлений и раз в
+    WEBHOOK_DEBOUNCE секунд прогоняет их через stable_sync.sync_users_targeted.
+    Уведомления, пришедшие во время синхронизации, попадут в следующую пачку,
+    а пачка, заставшая полный users-проход, ждёт его окончания.
+    """
+
+    def __init__(self):
+        self.pending = set()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='webhook-sync', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, uuids):
+        with self.cond:
+            self.pending.update(uuids)
+            self.cond.notify()
+
+    def run(self):
+        # stable_sync лежит рядом (/opt/hiddify-manager); импорт здесь, чтобы health API
+        # без включённого webhook не тянул requests и конфигурацию синхронизации
+        import time
+        import stable_sync
+
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(WEBHOOK_DEBOUNCE)
+            # Под блокировкой users-конвейера: полный проход не должен читать локальных
+            # пользователей, пока webhook их пишет. Пока он идёт — пачка ждёт.
+            holder = stable_sync.read_run_lock('users')
+            if holder and not holder['stale']:
+                time.sleep(WEBHOOK_BUSY_RETRY)
+                continue
+            with self.cond:
+                batch = sorted(self.pending)
+                self.pending.clear()
+            result = stable_sync.run_pipeline('webhook', stable_sync.sync_users_targeted,
+                                              WEBHOOK_SYNC_TIMEOUT, lock='users', busy=None,
+                                              uuids=batch)
+            if result is None:
+                self.submit(batch)
+                time.sleep(WEBHOOK_BUSY_RETRY)
+
+
+class SyncWebhookHandler(BaseHTTPRequestHandler):
+    """HTTP handler уведомлений parent → child об изменении пользователей"""
+
+    worker = None
+
+    def do_POST(self):
+        """Обработка POST запросов (users-changed, usage-deltas)"""
+        path = urlparse(self.path).path
+        if path not in ('/api/v2/hiddify-sync/users-changed', '/api/v2/hiddify-sync/usage-deltas'):
+            self.send_error(404, "Not Found")
+            return
+
+        token = self.headers.get('X-Sync-Token', '')
+        if not WEBHOOK_TOKEN or not hmac.compare_digest(token, WEBHOOK_TOKEN):
+            self.send_json_response({"error": "unauthorized"}, 401)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, 400)
+            return
+
+        if path == '/api/v2/hiddify-sync/usage-deltas':
+            self.handle_usage_deltas(payload)
+        else:
+            self.handle_users_changed(payload)
+
+    def handle_users_changed(self, payload):
+        """
+        Уведомление об изменении пользователей на parent.
+
+        Принимает: {"uuids": ["...", ...]}
+        Возвращает: 202 {"accepted": int}
+        """
+        try:
+            uuids = payload.get('uuids')
+            if not isinstance(uuids, list) or not uuids or len(uuids) > WEBHOOK_MAX_UUIDS:
+                raise ValueError(f"'uuids' must be a non-empty list of up to {WEBHOOK_MAX_UUIDS} items")
+            uuids = {str(uuid_lib.UUID(str(u))) for u in uuids}
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json_response({"error": str(e)}, 400)
+            return
+
+        self.worker.submit(uuids)
+        self.send_json_response({"accepted": len(uuids)}, 202)
+
+    def handle_usage_deltas(self, payload):
+        """
+        Пачка дельт трафика от child (только на узле TRAFFIC_AGGREGATION='aggregator').
+
+        Принимает: {"node": str, "batch_id": str, "deltas": [{"uuid": str, "bytes": int, "name": str}]}
+        Возвращает: 200 {"merged": bool} — merged=false для уже учтённого batch_id
+        """
+        import stable_sync
+
+        if stable_sync.TRAFFIC_AGGREGATION != 'aggregator':
+            self.send_json_response({"error": "aggregator mode is disabled"}, 404)
+            return
+
+        try:
+            node = str(payload.get('node', 'unknown'))
+            batch_id = str(uuid_lib.UUID(str(payload['batch_id'])))
+            deltas = payload['deltas']
+            if not isinstance(deltas, list):
+                raise ValueError("'deltas' must be a list")
+            deltas = [{'uuid': str(uuid_lib.UUID(str(d['uuid']))),
+                       'bytes': int(d['bytes']),
+                       'name': str(d.get('name', ''))}
+                      for d in deltas]
+            if any(d['bytes'] < 0 for d in deltas):
+                raise ValueError("'bytes' must be non-negative")
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            self.send_json_response({"error": f"invalid batch: {e}"}, 400)
+            return
+
+        merged = stable_sync.merge_aggregator_batch(node, batch_id, deltas)
+        self.send_json_response({"merged": merged})
+
+    send_json_response = SyncHealthHandler.send_json_response
+    log_message = SyncHealthHandler.log_message
+
+
+def start_webhook_server():
+    """Запускает webhook-сервер в фоновом потоке (если WEBHOOK_ENABLED)."""
+    if not WEBHOOK_TOKEN:
+        print("⚠️ WEBHOOK_ENABLED, но WEBHOOK_TOKEN не задан — webhook не запущен")
+        return None
+
+    SyncWebhookHandler.worker = TargetedSyncWorker()
+    SyncWebhookHandler.worker.start()
+
+    server = ThreadingHTTPServer((WEBHOOK_BIND, WEBHOOK_PORT), SyncWebhookHandler)
+    threading.Thread(target=server.serve_forever, name='webhook-http', daemon=True).start()
+    print(f"📨 Webhook: POST http://{WEBHOOK_BIND}:{WEBHOOK_PORT}/api/v2/hiddify-sync/users-changed")
+    return server
+
+
 # ============================================================================
 # MAIN
 # ============================================================================
 
 def main():
     """Запуск HTTP сервера на localhost:8081"""
-    server_address = ('127.0.0.1', API_PORT)
-    httpd = HTTPServer(server_address, SyncHealthHandler)
+    if API_BIND not in _LOOPBACK and not API_TOKEN:
+        # /status, /logs и /fleet не должны открываться в сеть без авторизации
+        print(f"❌ API_BIND = {API_BIND} без API_TOKEN — задайте токен или слушайте localhost")
+        sys.exit(1)
+    server_address = (API_BIND, API_PORT)
+    # Потоки на запрос: опрос парка не блокирует остальные запросы (в том числе
+    # /node этого же узла, если он есть в FLEET_NODES)
+    httpd = ThreadingHTTPServer(server_address, SyncHealthHandler)
 
     print(f"🔍 Hiddify Sync Health API v2.0 запущен на порту {API_PORT}")
     print(f"📊 Доступные endpoints:")
     print(f"   • GET /api/v2/hiddify-sync/health - основная проверка здоровья")
     print(f"   • GET /api/v2/hiddify-sync/status - детальный статус")
     print(f"   • GET /api/v2/hiddify-sync/logs - последние логи")
+    print(f"   • GET /api/v2/hiddify-sync/node - сводка узла для агрегатора парка")
+    if fleet_nodes():
+        print(f"   • GET /api/v2/hiddify-sync/fleet - сводка парка ({len(fleet_nodes())} узлов)")
     print(f"")
-    print(f"🔒 ВАЖНО: API доступен только на localhost для безопасности!")
+    if API_BIND in _LOOPBACK:
+        print(f"🔒 ВАЖНО: API доступен только на localhost для безопасности!")
     print(f"")
 
+    if WEBHOOK_ENABLED:
+        start_webhook_server()
+
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
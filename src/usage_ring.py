@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Поколоночный журнал отправленного трафика (кольцевой буфер на диске).
+
+Каждый traffic-цикл добавляет по записи на пользователя: (индекс UUID, байты,
+время). Колонки хранятся отдельными массивами фиксированной ёмкости в одном
+файле, старые записи перезаписываются по кругу. Чтение — три array.frombytes
+без разбора строк, агрегаты (топ потребителей, суммы по часам, перцентили)
+считаются по колонкам без обращения к MySQL и без разбора логов.
+
+ФАЙЛЫ (STATE_DIR):
+  usage_ring.bin        заголовок + колонки idx (uint32), bytes (uint64), ts (uint32)
+  usage_ring.uuids.json словарь индексов: {"uuids": [...], "names": [...]}
+
+Словарь не растёт бесконечно: при переходе записи через конец буфера индексы,
+на которые не ссылается ни одна запись (удалённые и сменившие UUID пользователи),
+освобождаются (null) и отдаются новым UUID. Занятые индексы не меняются, поэтому
+колонки не перезаписываются, а читатель без блокировки не видит чужих имён.
+
+Запись — под flock (таймер, daemon и webhook могут писать одновременно).
+Заголовок обновляется последним: при сбое посреди записи новые записи просто
+не видны. Чтение без блокировки.
+
+ИСПОЛЬЗОВАНИЕ:
+    ring = UsageRing('/var/lib/hiddify-child-sync/usage_ring.bin', capacity=200000)
+    ring.append([(uuid, name, usage_bytes), ...])
+    summary(ring, hours=24, top=10)
+"""
+
+import os
+import json
+import time
+import fcntl
+import bisect
+import struct
+from array import array
+
+RING_MAGIC = b'HCUR'
+RING_VERSION = 1
+# magic, версия, ёмкость, всего записей добавлено (позиция = written % capacity)
+RING_HEADER = struct.Struct('<4sHIQ')
+
+PERCENTILES = (50, 90, 99)
+
+
+def _column(typecode, itemsize):
+    """Пустой array с гарантированным размером элемента (I/Q зависят от платформы)."""
+    for code in typecode:
+        column = array(code)
+        if column.itemsize == itemsize:
+            return column
+    raise RuntimeError(f"нет типа array размером {itemsize} байт")
+
+
+def _columns():
+    return _column('IL', 4), _column('QL', 8), _column('IL', 4)
+
+
+class UsageRing:
+    """Кольцевой буфер записей (uuid, bytes, ts) с колонками фиксированной ёмкости."""
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.uuids_path = os.path.splitext(path)[0] + '.uuids.json'
+
+    # --- Раскладка файла ---
+
+    def _offsets(self, capacity):
+        idx, usage, _ = _columns()
+        idx_at = RING_HEADER.size
+        usage_at = idx_at + capacity * idx.itemsize
+        ts_at = usage_at + capacity * usage.itemsize
+        return idx_at, usage_at, ts_at
+
+    def _read_header(self, fd):
+        raw = os.pread(fd, RING_HEADER.size, 0)
+        if len(raw) < RING_HEADER.size:
+            return None
+        magic, version, capacity, written = RING_HEADER.unpack(raw)
+        if magic != RING_MAGIC or version != RING_VERSION or not capacity:
+            return None
+        return capacity, written
+
+    def _init_file(self, fd):
+        """Новый пустой буфер текущей ёмкости (колонки — разреженный файл)."""
+        _, _, ts_at = self._offsets(self.capacity)
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, ts_at + self.capacity * _columns()[2].itemsize)
+        os.pwrite(fd, RING_HEADER.pack(RING_MAGIC, RING_VERSION, self.capacity, 0), 0)
+        return self.capacity, 0
+
+    # --- Словарь UUID ---
+
+    def load_uuids(self):
+        try:
+            with open(self.uuids_path) as f:
+                data = json.load(f)
+            return data['uuids'], data['names']
+        except (OSError, ValueError, KeyError):
+            return [], []
+
+    def _release_unreferenced(self, fd, capacity, written, uuids, names):
+        """
+        Освобождает индексы словаря, на которые не ссылается ни одна запись буфера
+        (до текущей записи: вытесняемые ею ещё видны читателям).
+
+        Returns:
+            bool: словарь изменился
+        """
+        idx = _columns()[0]
+        raw = os.pread(fd, min(written, capacity) * idx.itemsize, self._offsets(capacity)[0])
+        idx.frombytes(raw[:len(raw) - len(raw) % idx.itemsize])
+        referenced = set(idx)
+        released = False
+        for i, uuid in enumerate(uuids):
+            if uuid is not None and i not in referenced:
+                uuids[i] = names[i] = None
+                released = True
+        while uuids and uuids[-1] is None:
+            uuids.pop()
+            names.pop()
+        return released
+
+    def _save_uuids(self, uuids, names):
+        tmp_path = f"{self.uuids_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'uuids': uuids, 'names': names}, f)
+        os.replace(tmp_path, self.uuids_path)
+
+    # --- Запись ---
+
+    def append(self, records, ts=None):
+        """
+        Добавляет записи одного цикла.
+
+        Args:
+            records: итерируемое (uuid, name, usage_bytes)
+            ts: время записи (по умолчанию сейчас)
+
+        Returns:
+            int: число добавленных записей
+        """
+        records = [r for r in records if r[2] > 0]
+        if not records:
+            return 0
+        ts = int(ts if ts is not None else time.time())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = self._read_header(fd)
+            if header is None or header[0] != self.capacity:
+                # Новый файл, повреждённый заголовок или изменилась ёмкость
+                header = self._init_file(fd)
+            capacity, written = header
+
+            records = records[-capacity:]
+            uuids, names = self.load_uuids()
+            dictionary_changed = False
+            if written % capacity + len(records) >= capacity:
+                # Запись доходит до конца буфера (перезапись по кругу)
+                dictionary_changed = self._release_unreferenced(fd, capacity, written, uuids, names)
+            index = {uuid: i for i, uuid in enumerate(uuids) if uuid is not None}
+            free = [i for i in reversed(range(len(uuids))) if uuids[i] is None]
+            idx, usage, stamps = _columns()
+            for uuid, name, usage_bytes in records:
+                i = index.get(uuid)
+                if i is None:
+                    if free:
+                        i = free.pop()
+                        uuids[i], names[i] = uuid, name
+                    else:
+                        i = len(uuids)
+                        uuids.append(uuid)
+                        names.append(name)
+                    index[uuid] = i
+                    dictionary_changed = True
+                elif name and names[i] != name:
+                    names[i] = name
+                    dictionary_changed = True
+                idx.append(i)
+                usage.append(int(usage_bytes))
+                stamps.append(ts)
+            if dictionary_changed:
+                self._save_uuids(uuids, names)
+
+            # Запись колонок с переходом через конец буфера (не более двух кусков)
+            start = written % capacity
+            first = min(len(idx), capacity - start)
+            for column, offset in zip((idx, usage, stamps), self._offsets(capacity)):
+                size = column.itemsize
+                os.pwrite(fd, column[:first].tobytes(), offset + start * size)
+                if first < len(column):
+                    os.pwrite(fd, column[first:].tobytes(), offset)
+            os.pwrite(fd, RING_HEADER.pack(RING_MAGIC, RING_VERSION, capacity,
+                                           written + len(idx)), 0)
+            return len(idx)
+        finally:
+            os.close(fd)
+
+    # --- Чтение ---
+
+    def read(self, since=None):
+        """
+        Колонки в хронологическом порядке, только записи с ts >= since.
+
+        Returns:
+            tuple: (idx, bytes, ts) — три array одинаковой длины
+        """
+        idx, usage, stamps = _columns()
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return idx, usage, stamps
+        try:
+            header = self._read_header(fd)
+            if header is None:
+                return idx, usage, stamps
+            capacity, written = header
+            count = min(written, capacity)
+            start = written % capacity if written > capacity else 0
+            for column, offset in zip((idx, usage, stamps), self._offsets(capacity)):
+                size = column.itemsize
+                raw = os.pread(fd, capacity * size, offset)
+                if len(raw) < count * size:
+                    return _columns()
+                column.frombytes(raw[start * size:count * size])
+                column.frombytes(raw[:start * size])
+        finally:
+            os.close(fd)
+
+        if since:
+            # Время не убывает в хронологическом порядке — отсечение бинарным поиском
+            first = bisect.bisect_left(stamps, since)
+            idx, usage, stamps = idx[first:], usage[first:], stamps[first:]
+        return idx, usage, stamps
+
+    def info(self):
+        """Ёмкость и заполненность буфера (None, если файла нет)."""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            header = self._read_header(fd)
+        finally:
+            os.close(fd)
+        if header is None:
+            return None
+        capacity, written = header
+        return {'capacity': capacity, 'records': min(written, capacity), 'written': written}
+
+
+# ============================================================================
+# АГРЕГАТЫ
+# ============================================================================
+
+def totals_by_user(idx, usage):
+    """Сумма байт по индексу UUID."""
+    totals = {}
+    get = totals.get
+    for i, value in zip(idx, usage):
+        totals[i] = get(i, 0) + value
+    return totals
+
+
+def top_consumers(totals, n):
+    """n индексов с наибольшим трафиком: [(idx, bytes), ...]."""
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+def hourly_totals(usage, stamps):
+    """Суммы байт по часам (начало часа, UTC epoch) в хронологическом порядке."""
+    hours = {}
+    get = hours.get
+    for value, ts in zip(usage, stamps):
+        hour = ts - ts % 3600
+        hours[hour] = get(hour, 0) + value
+    return sorted(hours.items())
+
+
+def percentiles(values, points=PERCENTILES):
+    """Перцентили (nearest-rank) списка значений: {p: value}."""
+    if not values:
+        return {p: 0 for p in points}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    return {p: ordered[min(last, max(0, -(-p * len(ordered) // 100) - 1))] for p in points}
+
+
+def summary(ring, hours=24, top=10, now=None):
+    """
+    Отчёт по трафику за последние hours часов: общий объём, топ потребителей,
+    суммы по часам и перцентили трафика на пользователя.
+    """
+    now = int(now if now is not None else time.time())
+    since = now - hours * 3600
+    idx, usage, stamps = ring.read(since)
+    totals = totals_by_user(idx, usage)
+    uuids, names = ring.load_uuids()
+
+    def describe(i):
+        if i < len(uuids):
+            return {'uuid': uuids[i], 'name': names[i]}
+        return {'uuid': None, 'name': None}
+
+    return {
+        'since': since,
+        'hours': hours,
+        'records': len(idx),
+        'users': len(totals),
+        'total_bytes': sum(usage),
+        'top': [dict(describe(i), bytes=value) for i, value in top_consumers(totals, top)],
+        'hourly': [{'hour': hour, 'bytes': value} for hour, value in hourly_totals(usage, stamps)],
+        'per_user_percentiles': {f"p{p}": value
+                                 for p, value in percentiles(list(totals.values())).items()},
+        'ring': ring.info(),
+    }
@@ -0,0 +1,276 @@
+#!/opt/hiddify-manager/.venv313/bin/python
+# -*- coding: utf-8 -*-
+"""
+Общий доступ к gRPC API работающего Xray для helper'ов активации/деактивации
+и stable_sync.py.
+
+  - inbound-теги с протоколом кэшируются в файле и проверяются по времени
+    запуска Xray: перечитываются (stats_query) только после перезапуска Xray
+    или по истечении XRAY_TAG_CACHE_TTL;
+  - время запуска Xray — по uptime из системной статистики Xray (GetSysStats),
+    а если она недоступна — по времени старта процесса (/proc);
+  - массовое добавление/удаление пользователей параллельными gRPC-вызовами
+    (XRAY_PROVISION_CONCURRENCY потоков на одном канале).
+
+Перезапуск Xray сбрасывает всех клиентов, добавленных через API: stable_sync.py
+замечает его (xray_started_at) и возвращает активных пользователей
+(activate_new_users_direct.py --reprovision).
+
+xtlsapi импортируется только при обращении к API — stable_sync.py проверяет
+перезапуск через /proc без загрузки gRPC.
+"""
+
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sync_config
+
+# gRPC API работающего Xray
+XRAY_API_HOST = '127.0.0.1'
+XRAY_API_PORT = 10085
+
+# Имя процесса Xray (для времени запуска через /proc)
+XRAY_PROCESS_NAME = 'xray'
+
+# Кэш inbound-тегов и его максимальный возраст (секунды)
+XRAY_TAG_CACHE = '/var/lib/hiddify-child-sync/xray_inbounds.json'
+XRAY_TAG_CACHE_TTL = 3600
+
+# Параллельных gRPC-вызовов при массовом добавлении/удалении
+XRAY_PROVISION_CONCURRENCY = 16
+
+# Время запуска, отличающееся меньше чем на столько секунд, — тот же процесс
+# (uptime округляется до секунды)
+STARTED_AT_TOLERANCE = 2
+
+# Секция [xray] общего конфигурационного файла (sync_config.py)
+sync_config.configure_module(globals(), ('xray',))
+
+# Код выхода helper'а: часть UUID не обработана — они перечислены в stdout
+# строками FAILED_PREFIX + UUID (остальные обработаны)
+EXIT_PARTIAL = 2
+FAILED_PREFIX = '❌ Не обработан в Xray: '
+
+# Протокол по первому совпадению ключевого слова в теге (логика Hiddify xray_api.py)
+PROTOCOL_KEYWORDS = (
+    ('vless', 'vless'),
+    ('realityin', 'vless'),
+    ('xtls', 'vless'),
+    ('quic', 'vless'),
+    ('reality', 'vless'),
+    ('kcp', 'vless'),
+    ('trojan', 'trojan'),
+    ('dispatcher', 'trojan'),
+    ('vmess', 'vmess'),
+    ('ss', 'shadowsocks'),
+    ('v2ray', 'shadowsocks'),
+)
+
+
+def tag_protocol(tag):
+    """Протокол inbound'а по тегу или None (тег не поддерживает клиентов)."""
+    lowered = tag.lower()
+    for keyword, protocol in PROTOCOL_KEYWORDS:
+        if keyword in lowered:
+            return protocol
+    return None
+
+
+def tag_flow(tag):
+    """flow='xtls-rprx-vision' только для realityin_tcp, для остальных — null byte."""
+    return 'xtls-rprx-vision' if 'realityin_tcp' in tag.lower() else '\0'
+
+
+def get_client():
+    """Клиент gRPC API Xray (xtlsapi из venv Hiddify)."""
+    venv = '/opt/hiddify-manager/.venv313/lib/python3.13/site-packages'
+    if venv not in sys.path:
+        sys.path.insert(0, venv)
+    import xtlsapi
+    return xtlsapi.XrayClient(XRAY_API_HOST, XRAY_API_PORT)
+
+
+# ============================================================================
+# ВРЕМЯ ЗАПУСКА XRAY
+# ============================================================================
+
+def _sys_uptime(client):
+    """Uptime Xray (секунды) из GetSysStats или None."""
+    try:
+        from xtlsapi.xray_api.app.stats.command import command_pb2
+        return client.stats_stub.GetSysStats(command_pb2.SysStatsRequest()).Uptime
+    except Exception:
+        return None
+
+
+def _process_started_at():
+    """Время старта процесса Xray по /proc (epoch) или None, если процесс не найден."""
+    try:
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+        ticks = os.sysconf('SC_CLK_TCK')
+        started = []
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            name = stat[stat.find('(') + 1:stat.rfind(')')]
+            if name == XRAY_PROCESS_NAME:
+                # Поле 22 (starttime, такты с загрузки); имя процесса может содержать пробелы
+                started.append(int(stat[stat.rfind(')') + 2:].split()[19]))
+        if not started:
+            return None
+        return boot_time + min(started) / ticks
+    except (OSError, ValueError, StopIteration):
+        return None
+
+
+def xray_started_at(client=None):
+    """
+    Время запуска работающего Xray (epoch) или None, если Xray не запущен.
+    С клиентом — по uptime из системной статистики Xray, иначе по /proc.
+    """
+    if client is not None:
+        uptime = _sys_uptime(client)
+        if uptime:
+            return time.time() - uptime
+    return _process_started_at()
+
+
+def same_process(started_at, known):
+    return (started_at is not None and known is not None
+            and abs(started_at - known) <= STARTED_AT_TOLERANCE)
+
+
+# ============================================================================
+# INBOUND-ТЕГИ (С КЭШЕМ)
+# ============================================================================
+
+def _load_tag_cache():
+    try:
+        with open(XRAY_TAG_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_tag_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(XRAY_TAG_CACHE), exist_ok=True)
+        tmp_path = f"{XRAY_TAG_CACHE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, XRAY_TAG_CACHE)
+    except OSError:
+        pass
+
+
+def get_inbound_tags(client, refresh=False):
+    """
+    Inbound'ы, принимающие клиентов: {tag: protocol}.
+
+    Кэш действителен, пока Xray не перезапускался и не старше XRAY_TAG_CACHE_TTL;
+    иначе теги перечитываются полным stats_query('inbound'). Теги без известного
+    протокола отбрасываются сразу, а не на каждом add_client.
+    """
+    started_at = xray_started_at(client)
+    cache = _load_tag_cache()
+    if (not refresh and cache.get('tags')
+            and same_process(started_at, cache.get('started_at'))
+            and time.time() - cache.get('fetched_at', 0) < XRAY_TAG_CACHE_TTL):
+        return cache['tags']
+
+    try:
+        names = {inb.name.split(">>>")[1] for inb in client.stats_query('inbound')}
+    except Exception as e:
+        print(f"⚠️ Ошибка получения inbound tags: {e}")
+        return {}
+    tags = {tag: tag_protocol(tag) for tag in sorted(names) if tag_protocol(tag)}
+    if tags:
+        _save_tag_cache({'started_at': started_at, 'fetched_at': time.time(), 'tags': tags})
+    return tags
+
+
+# ============================================================================
+# ДОБАВЛЕНИЕ / УДАЛЕНИЕ КЛИЕНТОВ
+# ============================================================================
+
+def add_user(client, uuid, tags, debug=False):
+    """
+    Добавляет UUID во все inbound'ы tags ({tag: protocol}).
+
+    Returns:
+        int: число inbound'ов, где пользователь есть (добавлен или уже был)
+    """
+    import xtlsapi
+    added = 0
+    for tag, protocol in tags.items():
+        try:
+            client.add_client(
+                tag,
+                uuid,
+                f'{uuid}@hiddify.com',
+                protocol=protocol,
+                flow=tag_flow(tag),
+                alter_id=0,
+                cipher='chacha20_poly1305'
+            )
+            added += 1
+        except xtlsapi.xtlsapi.exceptions.EmailAlreadyExists:
+            # UUID уже существует в этом inbound - это нормально
+            added += 1
+        except Exception as e:
+            if debug:
+                print(f"  DEBUG: Не удалось добавить в {tag}: {e}")
+    return added
+
+
+def _not_found(error):
+    """Ошибка Xray «клиента нет в этом inbound» (EmailNotFound / "... not found")."""
+    return 'NotFound' in type(error).__name__ or 'not found' in str(error).lower()
+
+
+def remove_user(client, uuid, tags):
+    """
+    Удаляет UUID из всех inbound'ов tags.
+
+    Returns:
+        bool | None: True — клиент был хотя бы в одном inbound и удалён; False — его
+        нигде не было; None — ошибка Xray (не «не найден»): клиент мог остаться
+    """
+    email = f'{uuid}@hiddify.com'
+    removed = failed = False
+    for tag in tags:
+        try:
+            client.remove_client(tag, email)
+            removed = True
+        except Exception as e:
+            # Клиента нет в этом inbound — цель достигнута
+            if not _not_found(e):
+                failed = True
+    return None if failed else removed
+
+
+def add_users_bulk(client, uuids, tags, concurrency=None):
+    """Параллельно добавляет пользователей: {uuid: число inbound'ов}."""
+    with ThreadPoolExecutor(max_workers=concurrency or XRAY_PROVISION_CONCURRENCY) as pool:
+        return dict(zip(uuids, pool.map(lambda uuid: add_user(client, uuid, tags), uuids)))
+
+
+def remove_users_bulk(client, uuids, tags, concurrency=None):
+    """Параллельно удаляет пользователей: {uuid: результат remove_user}."""
+    with ThreadPoolExecutor(max_workers=concurrency or XRAY_PROVISION_CONCURRENCY) as pool:
+        return dict(zip(uuids, pool.map(lambda uuid: remove_user(client, uuid, tags), uuids)))
+
+
+def parse_failed(stdout):
+    """UUID, перечисленные helper'ом как необработанные (строки FAILED_PREFIX)."""
+    return {line[len(FAILED_PREFIX):].strip() for line in stdout.splitlines()
+            if line.startswith(FAILED_PREFIX)}
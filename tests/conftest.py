@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+# Значения по умолчанию из модулей, а не конфигурация сервера, на котором идут тесты
+os.environ['HIDDIFY_SYNC_CONFIG'] = os.path.join(os.path.dirname(__file__), 'no-config.toml')
+
+
+def parent_user(uuid, **fields):
+    """Запись пользователя parent с обязательными полями (PARENT_REQUIRED_FIELDS)."""
+    user = {'uuid': uuid, 'name': f'user-{uuid[:8]}', 'enable': True, 'is_active': True,
+            'usage_limit_GB': 10.0, 'package_days': 30, 'mode': 'no_reset'}
+    user.update(fields)
+    return user
+
+
+def make_uuids(count, seed=0):
+    import uuid
+    import random
+    rng = random.Random(seed)
+    return [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(count)]
+
+
+@pytest.fixture
+def sync(tmp_path, monkeypatch):
+    """stable_sync с пустым STATE_DIR во временном каталоге."""
+    import stable_sync
+    monkeypatch.setattr(stable_sync, 'STATE_DIR', str(tmp_path))
+    return stable_sync
@@ -0,0 +1,20 @@
+import pytest
+
+
+def test_config_without_toml_parser_fails_loudly(tmp_path, monkeypatch):
+    import sync_config
+    path = tmp_path / 'config.toml'
+    monkeypatch.setattr(sync_config, 'tomllib', None)
+    assert sync_config.load_config(str(path)) == {}
+    path.write_text('[parent]\nurl = "https://parent.example.com/x"\n')
+    with pytest.raises(RuntimeError, match='tomli'):
+        sync_config.load_config(str(path))
+
+
+def test_config_applies_sync_keys(tmp_path):
+    import sync_config
+    path = tmp_path / 'config.toml'
+    path.write_text('[sync]\nsync_chunk_size = 7\nunknown_key = 1\n')
+    namespace = {'SYNC_CHUNK_SIZE': 500}
+    assert sync_config.apply_config(namespace, sync_config.load_config(str(path)), ('sync',)) == {'SYNC_CHUNK_SIZE'}
+    assert namespace['SYNC_CHUNK_SIZE'] == 7
@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+
+from conftest import make_uuids
+
+
+class FakeDb:
+    """get_db(): шаг с курсором, запоминающим удалённые из user UUID."""
+
+    def __init__(self):
+        self.deleted = []
+
+    @contextmanager
+    def step(self, name):
+        yield self
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, sql, params):
+        if sql.startswith('DELETE FROM user WHERE'):
+            self.deleted.extend(params)
+
+
+def test_deadline_stops_queued_api_deletes(sync, monkeypatch):
+    uuids = make_uuids(20)
+    monkeypatch.setattr(sync, 'DELETE_CONCURRENCY', 2)
+    monkeypatch.setattr(sync, 'DELETE_RATE_PER_SEC', 0)
+    monkeypatch.setattr(sync, '_delete_user_via_api', lambda uuid, deadline: time.sleep(0.05) or True)
+
+    deleted = sync._delete_missing_users(uuids, set(), deadline=time.monotonic() + 0.12)
+
+    queue = sync.load_state(sync.DELETE_QUEUE, [])
+    assert 0 < deleted < len(uuids)
+    assert len(queue) == len(uuids) - deleted
+    assert set(queue) < set(uuids)
+
+
+def test_direct_delete_keeps_users_not_removed_from_xray(sync, monkeypatch):
+    uuids = make_uuids(4)
+    db = FakeDb()
+    monkeypatch.setattr(sync, 'DELETE_METHOD', 'direct')
+    monkeypatch.setattr(sync, 'get_db', lambda: db)
+    monkeypatch.setattr(sync, '_xray_helper_done', lambda script, batch, *args: batch[:3])
+    monkeypatch.setattr(sync, '_delete_user_via_api', lambda uuid, deadline: False)
+
+    assert sync._delete_missing_users(uuids, set()) == 3
+    assert db.deleted == uuids[:3]
+    assert sync.load_state(sync.DELETE_QUEUE, []) == uuids[3:]
@@ -0,0 +1,61 @@
+import subprocess
+
+import pytest
+
+
+def _systemctl(active_units):
+    def run(cmd, **kwargs):
+        if cmd[:2] == ['systemctl', 'is-active']:
+            stdout = ''.join(('active' if unit in active_units else 'inactive') + '\n' for unit in cmd[2:])
+        else:
+            stdout = 'enabled\n' if cmd[2] in active_units else 'disabled\n'
+        return subprocess.CompletedProcess(cmd, 0, stdout, '')
+    return run
+
+
+@pytest.mark.parametrize('active_units, unit, mode, active', [
+    ({'hiddify-child-sync.timer'}, 'hiddify-child-sync.timer', 'timer', True),
+    ({'hiddify-child-sync-daemon.service'}, 'hiddify-child-sync-daemon.service', 'daemon', True),
+    (set(), 'hiddify-child-sync.timer', 'timer', False),
+])
+def test_sync_service_status_follows_active_unit(monkeypatch, active_units, unit, mode, active):
+    import sync_health_api
+    monkeypatch.setattr(subprocess, 'run', _systemctl(active_units))
+    handler = object.__new__(sync_health_api.SyncHealthHandler)
+    assert handler.get_sync_service_status() == {
+        'active': active, 'enabled': active, 'unit': unit, 'mode': mode}
+
+
+@pytest.mark.parametrize('client, token, header, allowed', [
+    ('127.0.0.1', '', None, True),
+    ('10.8.0.5', '', None, False),
+    ('10.8.0.5', '', '', False),
+    ('10.8.0.5', 'secret', 'secret', True),
+    ('10.8.0.5', 'secret', 'wrong', False),
+])
+def test_remote_requests_need_a_configured_token(monkeypatch, client, token, header, allowed):
+    import sync_health_api
+    monkeypatch.setattr(sync_health_api, 'API_TOKEN', token)
+    handler = object.__new__(sync_health_api.SyncHealthHandler)
+    handler.client_address = (client, 40000)
+    handler.headers = {} if header is None else {'X-Sync-Token': header}
+    assert handler.authorized() is allowed
+
+
+def test_refuses_to_start_on_network_bind_without_token(monkeypatch):
+    import sync_health_api
+    monkeypatch.setattr(sync_health_api, 'API_BIND', '0.0.0.0')
+    monkeypatch.setattr(sync_health_api, 'API_TOKEN', '')
+    monkeypatch.setattr(sync_health_api, 'ThreadingHTTPServer', lambda *args: pytest.fail('сервер запущен'))
+    with pytest.raises(SystemExit) as exit_info:
+        sync_health_api.main()
+    assert exit_info.value.code == 1
+
+
+def test_sync_runs_report_only_real_locks(sync):
+    import sync_health_api
+    handler = object.__new__(sync_health_api.SyncHealthHandler)
+    with sync.run_lock('users'):
+        runs = handler.get_sync_runs_status()
+    assert set(runs) == {'users', 'traffic', 'enforce'}
+    assert runs['users']['running'] and not runs['traffic']['running']
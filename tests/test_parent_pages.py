@@ -0,0 +1,68 @@
+import pytest
+
+from conftest import make_uuids, parent_user
+
+SOURCE = {'name': 'parent'}
+
+
+class Response:
+    def __init__(self, users, total=None):
+        self.status_code = 200
+        self.users = users
+        self.headers = {'X-Total-Count': str(total)} if total is not None else {}
+
+    def json(self):
+        return [dict(user) for user in self.users]
+
+
+@pytest.fixture
+def pages(sync, monkeypatch):
+    """Стенд parent: serve(page, size) → Response; возвращает список запрошенных страниц."""
+    requested = []
+    monkeypatch.setattr(sync, 'PARENT_PAGE_SIZE', 10)
+    monkeypatch.setattr(sync, 'PARENT_CONCURRENCY_MAX', 4)
+    monkeypatch.setattr(sync, 'transfer_sizes', lambda response: (0, 0, 0))
+
+    def install(serve):
+        def request(source, method, path, params=None, **kwargs):
+            requested.append(params['page'])
+            return serve(params['page'], params['per_page'])
+        monkeypatch.setattr(sync, 'parent_request', request)
+        return requested
+    return install
+
+
+def test_paged_list_without_total(sync, pages):
+    users = [parent_user(uuid) for uuid in make_uuids(25)]
+    requested = pages(lambda page, size: Response(users[(page - 1) * size:page * size]))
+    assert [u['uuid'] for u in sync._fetch_source_pages(SOURCE, None)] == [u['uuid'] for u in users]
+    assert max(requested) <= 6
+
+
+def test_parent_ignoring_page_number_detected(sync, pages):
+    users = [parent_user(uuid) for uuid in make_uuids(25)]
+    pages(lambda page, size: Response(users[:size]))
+    with pytest.raises(RuntimeError, match='повторяет страницу'):
+        sync._fetch_source_pages(SOURCE, None)
+
+
+def test_clamped_page_size_not_taken_as_short_list(sync, pages):
+    users = [parent_user(uuid) for uuid in make_uuids(25)]
+    pages(lambda page, size: Response(users[(page - 1) * 5:page * 5]))
+    with pytest.raises(RuntimeError, match='после неполной'):
+        sync._fetch_source_pages(SOURCE, None)
+
+
+def test_page_cap_stops_endless_list(sync, pages, monkeypatch):
+    monkeypatch.setattr(sync, 'PARENT_PAGE_MAX', 20)
+    requested = pages(lambda page, size: Response([parent_user(uuid) for uuid in make_uuids(size, seed=page)]))
+    with pytest.raises(RuntimeError, match='PARENT_PAGE_MAX'):
+        sync._fetch_source_pages(SOURCE, None)
+    assert max(requested) <= 24
+
+
+def test_deadline_stops_wave_loop(sync, pages):
+    import time
+    pages(lambda page, size: Response([parent_user(uuid) for uuid in make_uuids(size, seed=page)]))
+    with pytest.raises(RuntimeError, match='дедлайн'):
+        sync._fetch_source_pages(SOURCE, time.monotonic() - 1)
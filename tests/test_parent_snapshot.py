@@ -0,0 +1,64 @@
+import os
+import time
+
+from conftest import make_uuids, parent_user
+
+
+def _users(uuids, **fields):
+    return [parent_user(uuid, _parent='parent', last_online=None, current_usage_GB=1.5,
+                        start_date='2026-01-01', last_reset_time=None, **fields) for uuid in uuids]
+
+
+def _save(sync, users, fetched_at=None, builder=None):
+    checksum, error = sync.validate_parent_users(users)
+    assert error is None
+    return sync.save_parent_snapshot(users, fetched_at or time.time(), checksum, builder)
+
+
+def test_snapshot_round_trip(sync):
+    users = _users(make_uuids(50))
+    assert _save(sync, users, fetched_at=1000.0) is None
+    loaded, fetched_at = sync.load_parent_snapshot()
+    assert fetched_at == 1000.0
+    expected = {u['uuid']: {field: u[field] for field in sync.SNAPSHOT_FIELDS} for u in users}
+    assert {u['uuid']: u for u in loaded} == expected
+    assert sync.read_parent_snapshot_header()['users'] == 50
+
+
+def test_snapshot_diff_by_index(sync):
+    uuids = make_uuids(20)
+    users = _users(uuids[:10])
+    _save(sync, users, fetched_at=1000.0)
+
+    unchanged = _save(sync, users, fetched_at=2000.0)
+    assert unchanged == {'added': 0, 'removed': 0, 'changed': 0, 'unchanged': 10}
+    # Без изменений обновляется только время получения
+    assert sync.load_parent_snapshot()[1] == 2000.0
+
+    changed = _users(uuids[1:11])
+    changed[0]['name'] = 'renamed'
+    assert _save(sync, changed) == {'added': 1, 'removed': 1, 'changed': 1, 'unchanged': 8}
+    assert {u['uuid'] for u in sync.load_parent_snapshot()[0]} == set(uuids[1:11])
+
+
+def test_builder_snapshot_matches_plain(sync):
+    users = _users(make_uuids(30))
+    builder = sync.SnapshotBuilder()
+    builder.add(users[:15])
+    builder.add(users[15:])
+    _save(sync, users, builder=builder)
+    from_builder = sorted(sync.load_parent_snapshot()[0], key=lambda u: u['uuid'])
+    # Индекс, построенный по мере получения, совпадает с построенным целиком
+    assert _save(sync, users) == {'added': 0, 'removed': 0, 'changed': 0, 'unchanged': 30}
+    assert sorted(sync.load_parent_snapshot()[0], key=lambda u: u['uuid']) == from_builder
+
+
+def test_corrupted_snapshot_rejected(sync):
+    _save(sync, _users(make_uuids(10)))
+    path = os.path.join(sync.STATE_DIR, sync.SNAPSHOT_FILE)
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    assert sync.load_parent_snapshot() == (None, None)
@@ -0,0 +1,61 @@
+import json
+import subprocess
+import sys
+import time
+
+from conftest import SRC, make_uuids, parent_user
+
+VALIDATE_IN_NEW_PROCESS = '''
+import json, sys
+sys.path.insert(0, {src!r})
+import stable_sync
+stable_sync.STATE_DIR = {state_dir!r}
+users = json.load(open({users_path!r}))
+print(json.dumps(stable_sync.validate_parent_users(users)))
+'''
+
+
+def _save_snapshot(sync, users):
+    checksum, error = sync.validate_parent_users(users)
+    assert error is None
+    sync.save_parent_snapshot(users, time.time(), checksum)
+
+
+def _validate_in_new_process(state_dir, users_path):
+    code = VALIDATE_IN_NEW_PROCESS.format(src=SRC, state_dir=state_dir, users_path=users_path)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_missing_fields_and_duplicates_rejected(sync):
+    uuid = make_uuids(1)[0]
+    assert sync.validate_parent_users([{'uuid': uuid}])[1].startswith('запись без обязательных полей')
+    assert 'дубликат UUID' in sync.validate_parent_users([parent_user(uuid), parent_user(uuid)])[1]
+
+
+def test_checksum_ignores_order(sync):
+    users = [parent_user(uuid) for uuid in make_uuids(20)]
+    assert sync.validate_parent_users(users)[0] == sync.validate_parent_users(users[::-1])[0]
+
+
+def test_shrink_confirmed_across_separate_runs(sync, tmp_path):
+    """Подтверждения сокращения хранятся в STATE_DIR: таймер — новый процесс каждый цикл."""
+    users = [parent_user(uuid) for uuid in make_uuids(100)]
+    _save_snapshot(sync, users)
+    users_path = tmp_path / 'shrunk.json'
+    users_path.write_text(json.dumps(users[:50]))
+
+    checksum, error = _validate_in_new_process(str(tmp_path), str(users_path))
+    assert checksum is None and '(подтверждение 1/2)' in error
+
+    checksum, error = _validate_in_new_process(str(tmp_path), str(users_path))
+    assert error is None and checksum is not None
+    assert not (tmp_path / f'{sync.PARENT_SHRINK}.json').exists()
+
+
+def test_different_shrunk_list_restarts_confirmation(sync):
+    users = [parent_user(uuid) for uuid in make_uuids(100)]
+    _save_snapshot(sync, users)
+    assert '1/2' in sync.validate_parent_users(users[:50])[1]
+    assert '1/2' in sync.validate_parent_users(users[10:60])[1]
+    assert sync.validate_parent_users(users[10:60])[1] is None
@@ -0,0 +1,155 @@
+import sqlite3
+import time
+
+import pytest
+
+from conftest import make_uuids, parent_user
+
+
+class SqliteConnection:
+    """
+    Соединение «MySQL» поверх файла SQLite: INSERT/UPDATE пользователей из
+    _apply_parent_users_chunk сводятся к (uuid, name, enable). Файл общий для
+    процессов-шардов (fork наследует подмену sync_db._counting_connection).
+    """
+    statements = 0
+    open = True
+
+    def __init__(self, database, **params):
+        self.db = sqlite3.connect(database, timeout=30)
+
+    def cursor(self, cursor_class=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        self.statements += 1
+        if sql.strip().startswith('INSERT INTO user'):
+            self.db.execute("INSERT INTO user VALUES (?, ?, ?)", (params[0], params[1], params[5]))
+        else:
+            self.db.execute("UPDATE user SET name = ?, enable = ? WHERE uuid = ?",
+                            (params[0], params[4], params[-1]))
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+def _make_db(path, local):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE user (uuid TEXT PRIMARY KEY, name TEXT, enable INTEGER)")
+    db.execute("CREATE TABLE xray (op TEXT, uuid TEXT)")
+    db.executemany("INSERT INTO user VALUES (?, 'old', ?)", local.items())
+    db.commit()
+    db.close()
+
+
+def _dump(path):
+    db = sqlite3.connect(path)
+    users = sorted(db.execute("SELECT uuid, name, enable FROM user"))
+    xray = sorted(db.execute("SELECT op, uuid FROM xray"))
+    db.close()
+    return users, xray
+
+
+@pytest.fixture
+def shard_env(sync, monkeypatch, tmp_path):
+    import sync_db
+    monkeypatch.setattr(sync, '_SHARD_START_METHOD', 'fork')
+    monkeypatch.setattr(sync, 'SYNC_CHUNK_SIZE', 5)
+    monkeypatch.setattr(sync_db, '_counting_connection', SqliteConnection)
+
+    def use_db(name, local):
+        path = str(tmp_path / name)
+        _make_db(path, local)
+        monkeypatch.setattr(sync, 'DB_CONFIG', {'database': path})
+        monkeypatch.setattr(sync, '_db_pool', None)
+
+        def helper(script, uuids, label, deadline=None, args=(), run_empty=False):
+            db = sqlite3.connect(path, timeout=30)
+            op = 'activate' if 'activate' in script else 'deactivate'
+            db.executemany("INSERT INTO xray VALUES (?, ?)", [(op, uuid) for uuid in uuids])
+            db.commit()
+            db.close()
+            return list(uuids)
+        monkeypatch.setattr(sync, '_xray_helper_done', helper)
+        return path
+    return use_db
+
+
+def _classes(users, local):
+    """Разбиение по классам, как в sync_users_from_parent."""
+    activating, deactivating, updating = [], [], []
+    for user in users:
+        existing = local.get(user['uuid'])
+        if existing is not None and bool(existing) == user['is_active']:
+            updating.append(user)
+        elif user['is_active']:
+            activating.append(user)
+        else:
+            deactivating.append(user)
+    return activating, deactivating, updating
+
+
+def _scenario():
+    uuids = make_uuids(60)
+    users = [parent_user(uuid, name=f'new-{i}', is_active=i % 3 != 0) for i, uuid in enumerate(uuids)]
+    local = {uuid: i % 2 for i, uuid in enumerate(uuids) if i % 5}
+    return users, local
+
+
+def test_sharded_sync_matches_serial(sync, shard_env):
+    users, local = _scenario()
+    activating, deactivating, updating = _classes(users, local)
+
+    serial_db = shard_env('serial.db', local)
+    serial = sync._new_write_result()
+    queue = sync.OperationQueue()
+    sync._queue_user_writes(queue, 'activate', activating, local, serial)
+    sync._queue_user_writes(queue, 'deactivate', deactivating, local, serial, xray=False)
+    sync._queue_user_writes(queue, 'update', updating, local, serial)
+    queue.add('deactivate', 'Xray', lambda deadline: sync._run_xray_helper(
+        'deactivate_users_direct.py', serial['inactive'], 'деактивация'), size=0, always=True)
+    assert queue.run()
+    serial_statements = sync.get_db().metrics['users_sync']['statements']
+
+    sharded_db = shard_env('sharded.db', local)
+    sharded = sync.ShardedSync(4, local, set(), [])
+    queue = sync.OperationQueue()
+    for op_class, part in (('activate', activating), ('deactivate', deactivating), ('update', updating)):
+        queue.add(op_class, 'шарды ×4', sharded.op(op_class, part), size=0, always=True)
+    try:
+        assert queue.run()
+    finally:
+        sharded.close()
+
+    assert sharded.errors == {}
+    assert _dump(sharded_db) == _dump(serial_db)
+    assert sharded.result['totals'] == serial['totals']
+    assert sorted(sharded.result['activate']) == sorted(serial['activate'])
+    assert sync.get_db().metrics['users_sync']['statements'] == serial_statements == len(users)
+
+
+def test_hung_shard_stops_pool_after_timeout(sync, shard_env, monkeypatch):
+    users, local = _scenario()
+    shard_env('hung.db', local)
+    monkeypatch.setattr(sync, 'SYNC_SHARD_TIMEOUT', 1)
+    monkeypatch.setattr(sync, '_xray_helper_done', lambda *args, **kwargs: time.sleep(30))
+    sharded = sync.ShardedSync(2, local, set(), [])
+    started = time.monotonic()
+    try:
+        assert sharded.op('activate', _classes(users, local)[0])(None) is False
+    finally:
+        sharded.close()
+    assert time.monotonic() - started < 10
+    assert set(sharded.errors) == {'0', '1'}
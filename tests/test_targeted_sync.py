@@ -0,0 +1,31 @@
+import time
+
+from conftest import make_uuids
+
+
+def test_webhook_users_not_missing_for_older_parent_list(sync):
+    old, recent = make_uuids(2)
+    with sync.update_state(sync.TARGETED_SYNCED, {}) as synced:
+        synced[old] = 100.0
+        synced[recent] = 200.0
+    # Список запрошен между двумя записями: old в нём уже есть, recent — ещё нет
+    assert sync._targeted_since(150.0) == {recent}
+    assert sync.load_state(sync.TARGETED_SYNCED, {}) == {recent: 200.0}
+    # Неизвестное время запроса — защищены все записанные
+    assert sync._targeted_since(None) == {recent}
+
+
+def test_nothing_recorded_means_nothing_protected(sync):
+    assert sync._targeted_since(time.time()) == set()
+
+
+def test_webhook_waits_for_users_lock(sync):
+    calls = []
+    with sync.run_lock('users') as acquired:
+        assert acquired
+        result = sync.run_pipeline('webhook', lambda **kw: calls.append(kw) or True, 5,
+                                   lock='users', busy=None)
+    assert result is None and calls == []
+    assert sync.run_pipeline('webhook', lambda **kw: calls.append(kw) or True, 5,
+                             lock='users', busy=None) is True
+    assert len(calls) == 1
@@ -0,0 +1,93 @@
+import os
+import threading
+
+import pytest
+
+from conftest import make_uuids
+
+
+def _intent(uuid, expected=1.0):
+    return {'op': 'intent', 'uuid': uuid, 'name': uuid[:8], 'parent': 'parent', 'expected': expected,
+            'usage_delta_GB': 1.0, 'local_bytes': 1024**3, 'spool_bytes': 0}
+
+
+def _journal_size(sync):
+    return os.path.getsize(os.path.join(sync.STATE_DIR, sync.USAGE_JOURNAL))
+
+
+def test_journal_truncated_only_when_all_intents_closed(sync):
+    first, second = make_uuids(2)
+    sync._journal_append([_intent(first), _intent(second)])
+    sync.journal_usage_done([{'uuid': first}])
+    assert set(sync._journal_open_intents()) == {second}
+    sync.journal_usage_done([{'uuid': second}])
+    assert _journal_size(sync) == 0
+
+
+def test_concurrent_done_keeps_intents_of_other_workers(sync):
+    uuids = make_uuids(200)
+
+    def worker(uuid):
+        sync._journal_append([_intent(uuid)])
+        if uuid in closed:
+            sync.journal_usage_done([{'uuid': uuid}])
+
+    closed = set(uuids[::2])
+    threads = [threading.Thread(target=worker, args=(uuid,)) for uuid in uuids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(sync._journal_open_intents()) == set(uuids) - closed
+
+
+def test_recovery_resets_applied_and_closes_the_rest(sync, monkeypatch):
+    applied, lost = make_uuids(2)
+    sync._journal_append([_intent(applied, expected=5.0), _intent(lost, expected=5.0)])
+    parent = {applied: 5.0, lost: 4.0}
+    reset = []
+    monkeypatch.setattr(sync, 'get_parent_user_usage', lambda uuid, deadline=None, source=None: parent[uuid])
+    monkeypatch.setattr(sync, 'reset_local_usage', lambda deltas: reset.extend(deltas) or True)
+
+    assert sync.recover_usage_journal()
+    assert [(d['uuid'], d['usage_bytes']) for d in reset] == [(applied, 1024**3)]
+    assert sync._journal_open_intents() == {}
+    assert _journal_size(sync) == 0
+
+
+def test_recovery_keeps_journal_while_parent_unavailable(sync, monkeypatch):
+    uuid = make_uuids(1)[0]
+    sync._journal_append([_intent(uuid)])
+    monkeypatch.setattr(sync, 'get_parent_user_usage', lambda uuid, deadline=None, source=None: None)
+    monkeypatch.setattr(sync, 'reset_local_usage', lambda deltas: pytest.fail('сброс без сверки'))
+
+    assert sync.recover_usage_journal() is False
+    assert set(sync._journal_open_intents()) == {uuid}
+
+
+def test_torn_last_line_ignored(sync):
+    first, second = make_uuids(2)
+    sync._journal_append([_intent(first)])
+    with open(os.path.join(sync.STATE_DIR, sync.USAGE_JOURNAL), 'a') as f:
+        f.write('{"op": "intent", "uuid": "' + second[:10])
+    assert set(sync._journal_open_intents()) == {first}
+
+
+def test_conflict_then_failed_read_leaves_no_intent_for_recovery(sync, monkeypatch):
+    # 412 (конкурент сдвинул значение), затем GET падает: дельта не доставлена,
+    # и recovery не должен принять сдвиг конкурента за наш PATCH
+    uuid = make_uuids(1)[0]
+    reads = iter([(1.0, '1'), (None, None)])
+    monkeypatch.setattr(sync, 'parent_source_for', lambda uuid: {'name': 'parent'})
+    monkeypatch.setattr(sync, 'get_parent_user_usage',
+                        lambda uuid, deadline=None, with_etag=False, source=None, budget=None: next(reads))
+    monkeypatch.setattr(sync, 'update_parent_user_usage', lambda *args, **kwargs: None)
+    monkeypatch.setattr(sync.time, 'sleep', lambda seconds: None)
+    delta = {'uuid': uuid, 'name': uuid[:8], 'usage_delta_GB': 1.0, 'usage_bytes': 1024**3}
+    assert sync.accumulate_parent_usage(delta) is False
+
+    # К следующему циклу конкурент довёл значение до ожидаемого нами
+    monkeypatch.setattr(sync, 'get_parent_user_usage', lambda uuid, deadline=None, source=None: 5.0)
+    monkeypatch.setattr(sync, 'reset_local_usage', lambda deltas: pytest.fail('сброс недоставленной дельты'))
+    assert sync.recover_usage_journal()
+    assert sync._journal_open_intents() == {}
@@ -0,0 +1,192 @@
+import threading
+
+import pytest
+
+from conftest import make_uuids
+
+
+class FakeParent:
+    """
+    Стенд parent с одним пользователем: current_usage_GB и версия (ETag).
+    script — порядок первых вызовов (поток, 'get'|'patch'); остальные идут свободно.
+    """
+
+    def __init__(self, with_etag, script=()):
+        self.usage = 0.0
+        self.version = 0
+        self.with_etag = with_etag
+        self.script = list(script)
+        self.cond = threading.Condition()
+
+    def _turn(self, op):
+        me = threading.current_thread().name
+        with self.cond:
+            assert self.cond.wait_for(lambda: not self.script or self.script[0] == (me, op), timeout=10)
+            if self.script:
+                self.script.pop(0)
+                self.cond.notify_all()
+
+    def get(self, uuid, deadline=None, with_etag=False, source=None, budget=None):
+        self._turn('get')
+        etag = str(self.version) if self.with_etag else None
+        return (self.usage, etag) if with_etag else self.usage
+
+    def patch(self, uuid, new_usage_gb, name='Unknown', deadline=None, etag=None, source=None, budget=None):
+        self._turn('patch')
+        with self.cond:
+            if etag is not None and etag != str(self.version):
+                return None
+            self.usage = new_usage_gb
+            self.version += 1
+        return True
+
+
+def _push_concurrently(sync, monkeypatch, parent, deltas):
+    monkeypatch.setattr(sync, 'get_parent_user_usage', parent.get)
+    monkeypatch.setattr(sync, 'update_parent_user_usage', parent.patch)
+    monkeypatch.setattr(sync, 'parent_source_for', lambda uuid: {'name': 'parent'})
+    uuid = make_uuids(1)[0]
+    results = {}
+
+    def push(name, gb):
+        delta = {'uuid': uuid, 'name': name, 'usage_delta_GB': gb, 'usage_bytes': int(gb * 1024**3)}
+        results[name] = sync.accumulate_parent_usage(delta)
+
+    threads = [threading.Thread(target=push, args=item, name=item[0]) for item in deltas.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    return results
+
+
+def test_etag_conflict_retried_until_both_applied(sync, monkeypatch):
+    # Оба прочитали 0: второй PATCH получает 412 и повторяет с новым значением
+    parent = FakeParent(with_etag=True, script=[('big', 'get'), ('small', 'get')])
+    results = _push_concurrently(sync, monkeypatch, parent, {'big': 2.0, 'small': 1.0})
+    assert results == {'big': True, 'small': True}
+    assert parent.usage == pytest.approx(3.0)
+
+
+def test_without_etag_overwrite_seen_by_read_back_is_retried(sync, monkeypatch):
+    # small перезаписал big до его контрольного чтения: big видит 1 < 2 и повторяет
+    parent = FakeParent(with_etag=False, script=[
+        ('big', 'get'), ('small', 'get'), ('big', 'patch'), ('small', 'patch'), ('big', 'get')])
+    results = _push_concurrently(sync, monkeypatch, parent, {'big': 2.0, 'small': 1.0})
+    assert results == {'big': True, 'small': True}
+    assert parent.usage == pytest.approx(3.0)
+
+
+def test_without_etag_larger_overwrite_is_lost(sync, monkeypatch):
+    # Ограничение без ETag (см. accumulate_parent_usage): дельта конкурента больше,
+    # контрольное чтение small видит 2 >= 1 и считает свою дельту применённой
+    parent = FakeParent(with_etag=False, script=[
+        ('big', 'get'), ('small', 'get'), ('small', 'patch'), ('big', 'patch'), ('small', 'get')])
+    results = _push_concurrently(sync, monkeypatch, parent, {'big': 2.0, 'small': 1.0})
+    assert results == {'big': True, 'small': True}
+    assert parent.usage == pytest.approx(2.0)
+
+
+class Response:
+    def __init__(self, status_code, body=None, etag=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = {'ETag': etag} if etag else {}
+        self.content = b'{}'
+        self.text = ''
+
+    def json(self):
+        return self.body
+
+
+class FlakySession:
+    """
+    HTTP-сессия parent: самый первый запрос — 503 (повтор parent_request), первый
+    PATCH каждого пользователя — 412 (CAS-повтор). Считает отправленные запросы.
+    """
+
+    def __init__(self):
+        self.usage = {}
+        self.version = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, json=None, headers=None, **kwargs):
+        uuid = url.rstrip('/').rsplit('/', 1)[-1]
+        with self.lock:
+            self.requests += 1
+            version = self.version.setdefault(uuid, 0)
+            if self.requests == 1:
+                return Response(503)
+            self.usage.setdefault(uuid, 0.0)
+            if method == 'GET':
+                return Response(200, {'current_usage_GB': self.usage[uuid]}, etag=str(version))
+            if version == 0 or (headers and headers['If-Match'] != str(version)):
+                self.version[uuid] = version + 1
+                return Response(412)
+            self.usage[uuid] = json['current_usage_GB']
+            self.version[uuid] = version + 1
+            return Response(200)
+
+
+@pytest.fixture
+def flaky_parent(sync, monkeypatch):
+    session = FlakySession()
+    monkeypatch.setattr(sync, 'get_http_session', lambda source=None: session)
+    monkeypatch.setattr(sync, 'parent_source_for', lambda uuid: {'name': 'parent', 'url': 'http://parent'})
+    monkeypatch.setattr(sync, '_parent_gates', {})
+    monkeypatch.setattr(sync, 'PARENT_BACKOFF_BASE', 0.001)
+    return session
+
+
+def _deltas(count):
+    return [{'uuid': uuid, 'name': uuid[:8], 'usage_delta_GB': 1.0, 'usage_bytes': 1024**3}
+            for uuid in make_uuids(count)]
+
+
+def test_budget_charged_per_request_including_retries(sync, flaky_parent):
+    budget = sync.PushBudget(1000)
+    success, pushed = sync.send_usage_deltas_to_parent(_deltas(5), budget=budget)
+    assert success and len(pushed) == 5
+    # GET + 412 + GET + PATCH + контрольный GET на пользователя и один 503
+    assert flaky_parent.requests == 5 * 5 + 1
+    assert budget.used == flaky_parent.requests
+
+
+def test_budget_limit_caps_real_requests(sync, flaky_parent):
+    budget = sync.PushBudget(20)
+    success, pushed = sync.send_usage_deltas_to_parent(_deltas(10), budget=budget)
+    assert not success
+    assert flaky_parent.requests == budget.used <= 20
+
+
+def test_aggregator_batch_not_resent_after_failed_reset(sync, monkeypatch):
+    posted, resets = [], iter([False, True])
+    monkeypatch.setattr(sync, '_post_batch_to_aggregator', lambda batch, deadline=None: posted.append(batch) or True)
+    monkeypatch.setattr(sync, 'reset_local_usage', lambda deltas: next(resets))
+
+    assert sync.push_deltas_to_aggregator(_deltas(2)) is False
+    assert sync.load_state(sync.AGGREGATOR_PENDING, None)['acked']
+
+    # Следующий цикл: агрегатор пачку уже учёл — повторяется только сброс
+    assert sync.flush_pending_aggregator_batch()
+    assert len(posted) == 1
+    assert sync.load_state(sync.AGGREGATOR_PENDING, None) is None
+
+
+def test_worker_exception_fails_only_its_delta(sync, monkeypatch):
+    deltas = _deltas(3)
+    broken = deltas[1]['uuid']
+
+    def accumulate(delta, deadline=None, budget=None):
+        if delta['uuid'] == broken:
+            raise OSError('No space left on device')
+        return True
+    monkeypatch.setattr(sync, 'accumulate_parent_usage', accumulate)
+    monkeypatch.setattr(sync, 'parent_source_for', lambda uuid: None)
+    budget = sync.PushBudget(9)
+
+    success, pushed = sync.send_usage_deltas_to_parent(deltas, budget=budget)
+    assert not success
+    assert {d['uuid'] for d in pushed} == {deltas[0]['uuid'], deltas[2]['uuid']}
+    assert budget.reserve(9) is not None
@@ -0,0 +1,35 @@
+import usage_ring
+
+from conftest import make_uuids
+
+
+def test_dictionary_bounded_under_churn(tmp_path):
+    ring = usage_ring.UsageRing(str(tmp_path / 'usage_ring.bin'), capacity=8)
+    steady = make_uuids(2, seed=1)
+    for cycle, churn in enumerate(make_uuids(100, seed=2)):
+        # Два постоянных пользователя и один новый UUID на цикл
+        ring.append([(steady[0], 'a', 10), (steady[1], 'b', 20), (churn, f'c{cycle}', 30)], ts=cycle)
+
+    uuids, names = ring.load_uuids()
+    assert len(uuids) <= 2 * ring.capacity
+    idx, usage, stamps = ring.read()
+    assert len(idx) == ring.capacity
+    assert all(uuids[i] is not None for i in idx)
+    # Последний цикл подписан своими UUID
+    assert {uuids[i] for i, ts in zip(idx, stamps) if ts == 99} == {steady[0], steady[1], churn}
+
+
+def test_summary_names_survive_compaction(tmp_path):
+    ring = usage_ring.UsageRing(str(tmp_path / 'usage_ring.bin'), capacity=4)
+    gone, kept, fresh = make_uuids(3)
+    ring.append([(gone, 'gone', 100), (kept, 'kept', 1)], ts=1000)
+    ring.append([(kept, 'kept', 2), (fresh, 'fresh', 3)], ts=2000)
+    ring.append([(kept, 'kept', 4), (fresh, 'fresh', 5)], ts=3000)
+    # Записи gone вытеснены этой записью, но освобождается он на следующем переходе:
+    # до записи они ещё видны читателям
+    assert gone in ring.load_uuids()[0]
+    ring.append([(kept, 'kept', 6), (fresh, 'fresh', 7)], ts=3000)
+
+    top = usage_ring.summary(ring, hours=1, now=3000)['top']
+    assert {(entry['uuid'], entry['name']) for entry in top} == {(kept, 'kept'), (fresh, 'fresh')}
+    assert gone not in ring.load_uuids()[0]
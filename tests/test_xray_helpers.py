@@ -0,0 +1,79 @@
+import subprocess
+
+from conftest import make_uuids
+
+
+class FakeXray:
+    """remove_client/add_client: UUID из missing — «not found», из broken — ошибка gRPC."""
+
+    def __init__(self, missing=(), broken=()):
+        self.missing, self.broken = set(missing), set(broken)
+
+    def add_client(self, tag, uuid, email, **kwargs):
+        if uuid in self.broken:
+            raise RuntimeError('failed to connect to all addresses')
+
+    def remove_client(self, tag, email):
+        uuid = email.split('@')[0]
+        if uuid in self.broken:
+            raise RuntimeError('failed to connect to all addresses')
+        if uuid in self.missing:
+            raise RuntimeError(f'User {email} not found.')
+
+
+def test_remove_user_tells_absent_from_failed():
+    import xray_direct
+    present, absent, broken = make_uuids(3)
+    client = FakeXray(missing=[absent], broken=[broken])
+    tags = {'vless-in': 'vless', 'trojan-in': 'trojan'}
+    assert xray_direct.remove_users_bulk(client, [present, absent, broken], tags) == {
+        present: True, absent: False, broken: None}
+
+
+def test_deactivate_helper_lists_failed_uuids(monkeypatch, capsys):
+    import deactivate_users_direct
+    import xray_direct
+    ok, broken = make_uuids(2)
+    monkeypatch.setattr(xray_direct, 'get_client', lambda: FakeXray(broken=[broken]))
+    monkeypatch.setattr(xray_direct, 'get_inbound_tags', lambda client: {'vless-in': 'vless'})
+    assert deactivate_users_direct.deactivate_users([ok, broken]) == (1, [broken])
+    assert xray_direct.parse_failed(capsys.readouterr().out) == {broken}
+
+
+def test_enforce_records_only_confirmed(sync, monkeypatch):
+    import xray_direct
+    ok, broken = make_uuids(2)
+    monkeypatch.setattr(sync, '_enforcement_candidates',
+                        lambda: ({ok: 'ok-user', broken: 'broken-user'}, {}))
+
+    def helper(cmd, **kwargs):
+        stdout = f'{xray_direct.FAILED_PREFIX}{broken}\nДеактивировано в Xray: 1/2, ошибок: 1\n'
+        return subprocess.CompletedProcess(cmd, xray_direct.EXIT_PARTIAL, stdout, '')
+    monkeypatch.setattr(subprocess, 'run', helper)
+
+    assert sync.run_enforce_pipeline() is False
+    assert set(sync.load_state(sync.ENFORCED, {})) == {ok}
+
+
+def test_activate_helper_lists_failed_uuids(monkeypatch, capsys):
+    import activate_new_users_direct
+    import xray_direct
+    ok, broken = make_uuids(2)
+    monkeypatch.setattr(xray_direct, 'get_client', lambda: FakeXray(broken=[broken]))
+    monkeypatch.setattr(xray_direct, 'get_inbound_tags', lambda client: {'vless-in': 'vless'})
+    assert activate_new_users_direct.activate_users([ok, broken], check_db=False) == (1, [broken])
+    assert xray_direct.parse_failed(capsys.readouterr().out) == {broken}
+
+
+def test_partial_reprovision_retried_next_cycle(sync, monkeypatch):
+    import xray_direct
+    sync.save_state(sync.XRAY_STATE, {'started_at': 1000.0})
+    sync.save_state(sync.ENFORCED, {make_uuids(1)[0]: 'user'})
+    monkeypatch.setattr(xray_direct, 'xray_started_at', lambda: 2000.0)
+    monkeypatch.setattr(xray_direct, 'same_process', lambda a, b: a == b)
+    monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: subprocess.CompletedProcess(
+        cmd, 1, 'Восстановлено в Xray: 9/10\n', ''))
+
+    sync.check_xray_restart()
+    assert sync.load_state(sync.XRAY_STATE, {})['started_at'] == 1000.0
+    assert sync.load_state(sync.ENFORCED, {})
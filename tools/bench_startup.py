@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк запуска скриптов синхронизации: время импорта по модулям и время до
+первого HTTP-запроса. Результаты сравниваются с предыдущим релизом из истории.
+
+ЧТО ИЗМЕРЯЕТСЯ (медиана по --repeat запускам, каждый — новый интерпретатор):
+  - import <точка входа> целиком (stable_sync, sync_health_api, helper'ы Xray);
+  - вклад тяжёлых зависимостей (requests, urllib3, pymysql, xtlsapi, grpc)
+    по `python -X importtime` — 0, если точка входа их больше не загружает;
+  - время от запуска интерпретатора до готовой HTTP-сессии parent
+    (или до ответа на GET --url, если он задан).
+
+ИСПОЛЬЗОВАНИЕ:
+    # на child-сервере (рядом с /opt/hiddify-manager или из репозитория)
+    python3 tools/bench_startup.py
+    python3 tools/bench_startup.py --url https://parent.example.com/ADMIN/api/v2/panel/ping/
+    # зафиксировать результат релиза
+    python3 tools/bench_startup.py --record 4.4 --history tools/startup_history.jsonl
+
+Helper'ы Xray запускаются интерпретатором Hiddify (--helper-python), остальные —
+текущим (--python).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO_SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+HIDDIFY_PYTHON = '/opt/hiddify-manager/.venv313/bin/python'
+
+ENTRY_POINTS = (
+    ('stable_sync', False),
+    ('sync_health_api', False),
+    ('activate_new_users_direct', True),
+    ('deactivate_users_direct', True),
+)
+HEAVY_MODULES = ('requests', 'urllib3', 'pymysql', 'xtlsapi', 'grpc')
+
+# Выполняется в дочернем интерпретаторе: время от старта процесса (передано в env)
+# до готовой сессии / ответа parent
+FIRST_REQUEST_CODE = '''
+import os, time
+started = float(os.environ['BENCH_STARTED'])
+import stable_sync
+session = stable_sync.get_http_session(stable_sync.get_parent_sources()[0])
+url = os.environ.get('BENCH_URL')
+if url:
+    session.get(url, timeout=30)
+print(time.time() - started)
+'''
+
+
+def run_python(python, code, cwd, extra_env=None, importtime=False):
+    env = dict(os.environ, **(extra_env or {}))
+    args = [python] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    return subprocess.run(args, cwd=cwd, env=env, capture_output=True, text=True, timeout=120)
+
+
+def parse_importtime(stderr):
+    """Накопленное время импорта (мс) модулей верхнего уровня из вывода -X importtime."""
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        try:
+            _, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+            top = name.split('.')[0]
+            if name == top:
+                cumulative[top] = max(cumulative.get(top, 0), int(cumulative_us) / 1000)
+        except ValueError:
+            continue
+    return cumulative
+
+
+def bench_import(python, module, cwd, repeat):
+    """Медиана полного импорта точки входа и вклад тяжёлых зависимостей (мс)."""
+    totals = []
+    heavy = {name: [] for name in HEAVY_MODULES}
+    for _ in range(repeat):
+        result = run_python(python, f'import {module}', cwd, importtime=True)
+        if result.returncode != 0:
+            return {'error': (result.stderr.strip().splitlines() or ['?'])[-1]}
+        times = parse_importtime(result.stderr)
+        totals.append(times.get(module, 0))
+        for name in HEAVY_MODULES:
+            heavy[name].append(times.get(name, 0))
+    return {
+        'import_ms': round(statistics.median(totals), 1),
+        'deps_ms': {name: round(statistics.median(values), 1)
+                    for name, values in heavy.items() if any(values)},
+    }
+
+
+def bench_first_request(python, cwd, repeat, url):
+    samples = []
+    for _ in range(repeat):
+        env = {'BENCH_STARTED': repr(time.time())}
+        if url:
+            env['BENCH_URL'] = url
+        result = run_python(python, FIRST_REQUEST_CODE, cwd, env)
+        if result.returncode != 0:
+            return {'error': (result.stderr.strip().splitlines() or ['?'])[-1]}
+        samples.append(float(result.stdout.strip().splitlines()[-1]) * 1000)
+    return {'first_request_ms': round(statistics.median(samples), 1), 'url': url or None}
+
+
+def load_last(history):
+    try:
+        with open(history) as f:
+            lines = [line for line in f if line.strip()]
+        return json.loads(lines[-1]) if lines else None
+    except (OSError, ValueError):
+        return None
+
+
+def delta(current, previous):
+    if previous is None or current is None:
+        return ''
+    diff = current - previous
+    return f" ({'+' if diff >= 0 else ''}{diff:.1f} к {previous:.1f})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк запуска скриптов синхронизации')
+    parser.add_argument('--src', default=REPO_SRC if os.path.isdir(REPO_SRC) else '/opt/hiddify-manager',
+                        help='каталог со скриптами')
+    parser.add_argument('--python', default=sys.executable)
+    parser.add_argument('--helper-python',
+                        default=HIDDIFY_PYTHON if os.path.exists(HIDDIFY_PYTHON) else sys.executable)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--url', help='GET для измерения времени до первого ответа parent')
+    parser.add_argument('--history', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'startup_history.jsonl'))
+    parser.add_argument('--record', metavar='RELEASE', help='дописать результат в историю')
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    args = parser.parse_args()
+
+    result = {
+        'release': args.record,
+        'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': subprocess.run([args.python, '-c', 'import sys; print(sys.version.split()[0])'],
+                                 capture_output=True, text=True).stdout.strip(),
+        'entry_points': {},
+    }
+    for module, helper in ENTRY_POINTS:
+        if not os.path.exists(os.path.join(args.src, f'{module}.py')):
+            continue
+        python = args.helper_python if helper else args.python
+        result['entry_points'][module] = bench_import(python, module, args.src, args.repeat)
+    result['first_request'] = bench_first_request(args.python, args.src, args.repeat, args.url)
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        last = load_last(args.history)
+        previous = (last or {}).get('entry_points', {})
+        print(f"Python {result['python']}, медиана {args.repeat} запусков"
+              + (f", сравнение с {last.get('release') or last.get('at')}" if last else ''))
+        for module, stats in result['entry_points'].items():
+            if 'error' in stats:
+                print(f"  {module:28} ошибка: {stats['error']}")
+                continue
+            before = previous.get(module, {}).get('import_ms')
+            deps = ', '.join(f"{name} {ms:.1f}" for name, ms in stats['deps_ms'].items()) or '—'
+            print(f"  {module:28} {stats['import_ms']:7.1f} мс{delta(stats['import_ms'], before)}"
+                  f"  [зависимости: {deps}]")
+        first = result['first_request']
+        if 'error' in first:
+            print(f"  {'первый запрос':28} ошибка: {first['error']}")
+        else:
+            before = (last or {}).get('first_request', {}).get('first_request_ms')
+            print(f"  {'первый запрос':28} {first['first_request_ms']:7.1f} мс"
+                  f"{delta(first['first_request_ms'], before)}"
+                  f"  ({'GET ' + first['url'] if first['url'] else 'до готовой сессии'})")
+
+    if args.record:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+        print(f"Записано в {args.history}")
+
+
+if __name__ == '__main__':
+    main()